@@ -107,5 +107,9 @@ setup(
     #         'sample=sample:main',
     #     ],
     # },
-    entry_points={}
+    entry_points={
+        'console_scripts': [
+            'task-semaphore=task_semaphore.cli:main',
+        ],
+    }
 )
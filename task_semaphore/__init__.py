@@ -1,8 +1,14 @@
 from .utils.storage import RedisStorage
+from .utils.async_storage import AsyncRedisStorage
 from .services.scheduler import Scheduler
+from .services.async_scheduler import AsyncScheduler
 from .services.slot import AbstractSlot
-from .services.prio_backend import AbstractPrioBackend
+from .services.prio_backend import AbstractPrioBackend, AsyncPrioBackend
+from .services.redis_queue import RedisQueueBackend
+from .services.dispatcher import CallbackDispatcher
 from .exceptions import TaskTimeoutError, WrongTaskIdError
 
-__all__ = ['Scheduler', 'AbstractSlot', 'RedisSlot', 'AbstractPrioBackend',
-           'RedisStorage', 'TaskTimeoutError', 'WrongTaskIdError']
+__all__ = ['Scheduler', 'AsyncScheduler', 'AbstractSlot', 'RedisSlot',
+           'AbstractPrioBackend', 'AsyncPrioBackend', 'RedisQueueBackend',
+           'CallbackDispatcher', 'RedisStorage', 'AsyncRedisStorage',
+           'TaskTimeoutError', 'WrongTaskIdError']
@@ -0,0 +1,110 @@
+"""Runs a scheduler until SIGTERM, eg:
+
+    task-semaphore --name my_scheduler --config slots.json \\
+        --import my_project.backends --redis-url redis://localhost:6379/0
+
+`--config` being a JSON file holding the list of slots configurations as
+expected by `Scheduler.init_from_config`. Without it, the config published
+in the storage is used, see `Scheduler.publish_config`.
+"""
+import argparse
+import importlib
+import json
+import logging
+
+from .services.dispatcher import DEFAULT_CALLBACK_DEADLINE, CallbackDispatcher
+from .services.runner import DEFAULT_MAX_INTERVAL, DEFAULT_MIN_INTERVAL
+from .services.scheduler import (LOCK_OPTIMISTIC, LOCK_SCHEDULER, LOCK_SLOT,
+                                 Scheduler)
+from .stats import AdaptiveTimeoutPolicy
+from .utils.storage import (KEY_LAYOUT_FLAT, KEY_LAYOUT_HASH_TAG,
+                            RedisHashStorage, RedisStorage)
+
+STORAGES = {'pickle': RedisStorage, 'hash': RedisHashStorage}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='task-semaphore',
+                                     description='Runs a task scheduler')
+    parser.add_argument('--name', required=True, help='scheduler name')
+    parser.add_argument('--config', default=None,
+                        help='path to the JSON slots configuration, '
+                             'defaults to the one published in redis')
+    parser.add_argument('--import', dest='imports', action='append',
+                        default=[], metavar='MODULE',
+                        help='module to import to register backends')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+    parser.add_argument('--redis-cluster', action='store_true',
+                        help='--redis-url points to a redis cluster')
+    parser.add_argument('--storage', choices=sorted(STORAGES),
+                        default='pickle')
+    parser.add_argument('--key-layout', default=None,
+                        choices=[KEY_LAYOUT_FLAT, KEY_LAYOUT_HASH_TAG],
+                        help='defaults to %s with --redis-cluster, %s '
+                             'otherwise' % (KEY_LAYOUT_HASH_TAG,
+                                            KEY_LAYOUT_FLAT))
+    parser.add_argument('--lock-mode', default=LOCK_SCHEDULER,
+                        choices=[LOCK_SCHEDULER, LOCK_SLOT, LOCK_OPTIMISTIC])
+    parser.add_argument('--poll-workers', type=int, default=0)
+    parser.add_argument('--refill-on-stop', action='store_true')
+    parser.add_argument('--min-interval', type=float,
+                        default=DEFAULT_MIN_INTERVAL)
+    parser.add_argument('--max-interval', type=float,
+                        default=DEFAULT_MAX_INTERVAL)
+    parser.add_argument('--reap-interval', type=float, default=None)
+    parser.add_argument('--leases', action='store_true',
+                        help='timeout tasks as soon as their lease expires, '
+                             'needs redis keyspace notifications for '
+                             'expired keys')
+    parser.add_argument('--adaptive-timeout-factor', type=float,
+                        default=None, metavar='K',
+                        help='timeout tasks after K times the 99th '
+                             'percentile of their backend\'s durations')
+    parser.add_argument('--adaptive-timeout-floor', type=float, default=5,
+                        metavar='MINUTES')
+    parser.add_argument('--callback-workers', type=int, default=0,
+                        help='call the backends\' callbacks in that many '
+                             'threads, off the locks')
+    parser.add_argument('--callback-deadline', type=float,
+                        default=DEFAULT_CALLBACK_DEADLINE, metavar='SECONDS')
+    parser.add_argument('--log-level', default='INFO')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    import redis  # only needed here, the library itself doesn't require it
+
+    for module in args.imports:
+        importlib.import_module(module)
+    config = None
+    if args.config:
+        with open(args.config) as config_file:
+            config = json.load(config_file)
+
+    if args.redis_cluster:
+        import redis.cluster
+        redis_c = redis.cluster.RedisCluster.from_url(args.redis_url)
+    else:
+        redis_c = redis.StrictRedis.from_url(args.redis_url)
+    storage = STORAGES[args.storage](redis_c, key_layout=args.key_layout)
+    timeout_policy = None
+    if args.adaptive_timeout_factor:
+        timeout_policy = AdaptiveTimeoutPolicy(
+                factor=args.adaptive_timeout_factor,
+                floor=args.adaptive_timeout_floor)
+    callback_dispatcher = None
+    if args.callback_workers:
+        callback_dispatcher = CallbackDispatcher(
+                workers=args.callback_workers,
+                deadline=args.callback_deadline)
+    scheduler = Scheduler(args.name, storage, lock_mode=args.lock_mode,
+                          poll_workers=args.poll_workers,
+                          refill_on_stop=args.refill_on_stop,
+                          timeout_policy=timeout_policy,
+                          leases=args.leases,
+                          callback_dispatcher=callback_dispatcher)
+    scheduler.init_from_config(config).run_forever(
+            min_interval=args.min_interval, max_interval=args.max_interval,
+            reap_interval=args.reap_interval)
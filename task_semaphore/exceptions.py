@@ -14,3 +14,22 @@ class TaskTimeoutError(TaskSemaphoreError, TimeoutError):
     def __init__(self, slot):
         super().__init__("%r on %r timeouted for %r" % (
                 slot.current_task_id, slot.current_backend, slot))
+
+
+class LockLostError(TaskSemaphoreError):
+
+    def __init__(self, lock):
+        super().__init__("%r expired before being renewed" % lock)
+
+
+class ConflictError(TaskSemaphoreError):
+
+    def __init__(self, model):
+        super().__init__("%r has been changed by someone else" % model)
+
+
+class CallbackTimeoutError(TaskSemaphoreError, TimeoutError):
+
+    def __init__(self, backend, method, task_id):
+        super().__init__("%r.%s(%r) overran its deadline" % (
+                backend, method, task_id))
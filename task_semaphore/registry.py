@@ -1,3 +1,5 @@
+from importlib import import_module
+
 REGISTRY = {}
 
 
@@ -8,3 +10,19 @@ class TaskSemaphoreMetaRegisterer(type):
         assert name not in REGISTRY, \
                 "Conflicting name for %r and %r" % (self, REGISTRY[name])
         REGISTRY[name] = self
+
+
+def get_backend_cls(ref):
+    """Return the backend class for `ref`, either the name of a registered
+    backend or a "package.module:ClassName" path, the module being imported
+    (and its backends registered) on first use."""
+    if ':' in ref:
+        module_name, _, cls_name = ref.partition(':')
+        try:
+            return getattr(import_module(module_name), cls_name)
+        except (ImportError, AttributeError) as error:
+            raise AssertionError("TaskSemaphore: couldn't load backend %r: %r"
+                                 % (ref, error)) from error
+    assert ref in REGISTRY, \
+            "TaskSemaphore: %r is not a registered backend!" % ref
+    return REGISTRY[ref]
@@ -1,4 +1,9 @@
 from .scheduler import Scheduler
-from .prio_backend import AbstractPrioBackend
+from .async_scheduler import AsyncScheduler
+from .prio_backend import AbstractPrioBackend, AsyncPrioBackend
+from .redis_queue import RedisQueueBackend
+from .dispatcher import CallbackDispatcher
 
-__all__ = ['Scheduler', 'AbstractSlot', 'AbstractPrioBackend']
+__all__ = ['Scheduler', 'AsyncScheduler', 'AbstractSlot',
+           'AbstractPrioBackend', 'AsyncPrioBackend', 'RedisQueueBackend',
+           'CallbackDispatcher']
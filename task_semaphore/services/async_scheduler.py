@@ -0,0 +1,192 @@
+import asyncio
+import logging
+
+from ..exceptions import WrongTaskIdError
+from ..stats.recorder import DEFAULT_STATS_WINDOW
+from .async_slot import AsyncSlot, call_backend
+from .scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def _not_async(name):
+    """Stands for the Scheduler method `name`, which has no asyncio
+    counterpart and would silently do nothing on an AbstractAsyncStorage"""
+    def method(self, *args, **kwargs):
+        raise NotImplementedError("TaskSemaphore: %s isn't supported by %s"
+                                  % (name, type(self).__name__))
+    method.__name__ = name
+    return method
+
+
+class AsyncScheduler(Scheduler):
+    """Scheduler for asyncio, to be used with an AbstractAsyncStorage.
+
+    Slots are reviewed, polled and saved concurrently. Backends can either
+    be AsyncPrioBackend or plain AbstractPrioBackend, the latter being run
+    in threads. Only the scheduler wide lock is supported, pools, published
+    configs, reaping and `run_forever` aren't."""
+    slot_cls = AsyncSlot
+
+    def __init__(self, name, storage, stats_window=DEFAULT_STATS_WINDOW,
+                 timeout_policy=None):
+        super().__init__(name, storage, stats_window=stats_window,
+                         timeout_policy=timeout_policy)
+        # slot id => slot to save at the end of the pass or signal
+        self._pending_saves = None
+
+    publish_config = _not_async('publish_config')
+    sync_config = _not_async('sync_config')
+    reap_timeouts = _not_async('reap_timeouts')
+    reap_expired_leases = _not_async('reap_expired_leases')
+    run_forever = _not_async('run_forever')
+    add_pool = _not_async('add_pool')
+
+    async def init_from_config(self, config):
+        self.config = config
+        for slot_config in config:
+            self.add_slot(slot_config['slot_id'],
+                          slot_config['backends'],
+                          slot_config.get('slot_kwargs'))
+        await self.storage.reload_many(self.slots.values())
+        return self
+
+    async def _flush_saves(self):
+        pending, self._pending_saves = self._pending_saves, None
+        if pending:
+            await self.storage.save_many(pending.values())
+        stats = self.stats.pop_pending()
+        if stats:
+            await self.storage.incr_stats(self, stats, self.stats.retention)
+
+    async def schedule(self):
+        """ Schedules new tasks for available slots """
+        if self.timeout_policy is not None:
+            await self.timeout_policy.refresh_if_needed_async(self)
+        async with self.storage.lock_on(self) as lock:
+            logger.info('starting reviewing slots for scheduling')
+            self._pending_saves = {}
+            try:
+                await self.storage.reload_many(self.slots.values())
+                slots = list(self.slots.values())
+                are_idle = await asyncio.gather(*(self._is_idle(slot)
+                                                  for slot in slots))
+                await lock.renew_if_needed()
+                await self._fill([slot for slot, is_idle
+                                  in zip(slots, are_idle) if is_idle])
+            finally:
+                await self._flush_saves()
+
+    async def _is_idle(self, slot):
+        if slot.current_task_id:
+            if not slot.is_late:
+                logger.debug('slot %s is busy', slot)
+                return False
+            await slot.timeout(slot.current_task_id)
+        return True
+
+    async def _fill(self, slots):
+        """Same as Scheduler._fill, each group of slots being filled
+        concurrently"""
+        slots_by_backends = {}
+        for slot in slots:
+            slots_by_backends.setdefault(tuple(slot._backends_names), []) \
+                    .append(slot)
+        started = set()  # shared so groups don't start the same task
+        await asyncio.gather(*(
+                self._fill_group(backends_names, idle_slots, started)
+                for backends_names, idle_slots in slots_by_backends.items()))
+
+    async def _fill_group(self, backends_names, slots, started):
+        for backend_name in backends_names:
+            if not slots:
+                break
+            slots = await self._fill_from(backend_name, slots, started)
+        for slot in slots:
+            logger.debug('nothing to do for slot %r', slot)
+
+    @staticmethod
+    async def _fill_from(backend_name, slots, started):
+        backend = slots[0]._backends[backend_name]
+        while slots:
+            task_ids = [task_id for task_id in await call_backend(
+                            backend, 'poll_many', len(slots))
+                        if task_id not in started]
+            if not task_ids:
+                break
+            started.update(task_ids)
+            await asyncio.gather(*(
+                    slot.start(task_id, slot._backends[backend_name])
+                    for task_id, slot in zip(task_ids, slots)))
+            slots = slots[len(task_ids):]
+        return slots
+
+    async def _find_slots(self, task_ids):
+        task_ids, found = list(task_ids), {}
+        if self.storage.indexes_tasks:
+            slot_refs = await self.storage.find_tasks(self, task_ids)
+            found = {task_id: self._slots_by_ref[slot_ref]
+                     for task_id, slot_ref in zip(task_ids, slot_refs)
+                     if slot_ref in self._slots_by_ref}
+            task_ids = [task_id for task_id in task_ids
+                        if task_id not in found]
+            if not task_ids:
+                return found
+        await self.storage.reload_many(self.slots.values())
+        slots_by_task = {slot.current_task_id: slot
+                         for slot in self.slots.values()
+                         if slot.current_task_id}
+        for task_id in task_ids:
+            if task_id not in slots_by_task:
+                continue
+            found[task_id] = slot = slots_by_task[task_id]
+            if self.storage.indexes_tasks:
+                await self.storage.index_task(self, task_id, slot.id_)
+        return found
+
+    async def _transmit_to_slot(self, method, task_id):
+        result = await self._transmit_to_slots(method, [task_id])
+        if not result[task_id]:
+            raise WrongTaskIdError(self, task_id)
+
+    async def _transmit_to_slots(self, method, task_ids):
+        task_ids = list(task_ids)
+        async with self.storage.lock_on(self):
+            self._pending_saves = {}
+            try:
+                targets = await self._find_slots(task_ids)
+                await self.storage.reload_many(set(targets.values()))
+                transmitted = await asyncio.gather(*(
+                        self._transmit(targets.get(task_id), method, task_id)
+                        for task_id in task_ids))
+            finally:
+                await self._flush_saves()
+        return dict(zip(task_ids, transmitted))
+
+    async def _transmit(self, slot, method, task_id):
+        try:
+            if slot is None:
+                raise WrongTaskIdError(self, task_id)
+            logger.debug('passing %r to %r(%r)', method, slot, task_id)
+            await getattr(slot, method)(task_id)
+        except WrongTaskIdError:
+            logger.info('%r is unknown, ignoring %r', task_id, method)
+            return False
+        return True
+
+    async def keepalive(self, task_id):
+        await self._transmit_to_slot('keepalive', task_id)
+
+    async def stop(self, task_id):
+        await self._transmit_to_slot('stop', task_id)
+
+    async def keepalive_many(self, task_ids):
+        return await self._transmit_to_slots('keepalive', task_ids)
+
+    async def stop_many(self, task_ids):
+        return await self._transmit_to_slots('stop', task_ids)
+
+    async def inspect(self):
+        inspected = self._inspect_state()
+        inspected['stats'] = await self.stats.query_async()
+        return inspected
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from datetime import UTC, datetime
+
+from ..exceptions import TaskTimeoutError, WrongTaskIdError
+from .slot import AbstractSlot
+
+logger = logging.getLogger(__name__)
+
+
+async def call_backend(backend, method, *args):
+    """Call `method` on `backend`, in a thread if it isn't a coroutine so
+    synchronous backends don't block the loop"""
+    func = getattr(backend, method)
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args)
+    return await asyncio.to_thread(func, *args)
+
+
+async def call_backend_method(backend, method, task_id):
+    """Same as slot.call_backend_method, see call_backend"""
+    try:
+        return await call_backend(backend, method, task_id), False
+
+    except Exception as error:
+        free_slot = False
+        try:
+            logger.warn('something bad happend while calling %r: %r(%s), '
+                        'calling error callback: %r', backend,
+                        method, task_id, error)
+            free_slot = await call_backend(
+                    backend, 'backend_error_callback',
+                    task_id, error, method)
+        except Exception:
+            logger.exception('an error occured while calling '
+                             'on error handler, ignoring, freeing slot:')
+            free_slot = True
+        if free_slot or method == 'start_callback':
+            logger.warn('backend_error_callback returned True, '
+                        'freeing slot')
+            return None, True
+        return None, False
+
+
+class AsyncSlot(AbstractSlot):
+    """AbstractSlot for the AsyncScheduler, see AbstractSlot for the
+    documentation of each method"""
+
+    async def poll(self):
+        logger.info('polling for slot %r', self)
+        for backend_name in self._backends_names:
+            backend = self._backends[backend_name]
+            task_id = await call_backend(backend, 'poll')
+            if task_id:
+                return task_id, backend
+        return None, None
+
+    async def backend_method_wrapper(self, method):
+        result, free_slot = await call_backend_method(
+                self.current_backend, method, self.current_task_id)
+        if free_slot:
+            await self._free_slot()
+        return result
+
+    async def timeout_if_late(self, unique_task_id):
+        if self.current_task_id != unique_task_id:
+            raise WrongTaskIdError(self, unique_task_id)
+        if self.is_late:
+            logger.warn('Deadline was %s (last keep alive on %s) for %s. '
+                        'Timeouting', self.deadline, self._last_keepalive_at,
+                        self)
+            self.scheduler.stats.record_timeout(self._current_backend_name)
+            await self.backend_method_wrapper('timeout_callback')
+            raise TaskTimeoutError(self)
+
+    async def timeout(self, unique_task_id):
+        if self.current_task_id != unique_task_id:
+            raise WrongTaskIdError(self, unique_task_id)
+        logger.warn('Deadline was %s (last keep alive on %s) for %s. '
+                    'Timeouting', self.deadline, self._last_keepalive_at,
+                    self)
+        backend = self.current_backend
+        await self._free_slot()
+        self.scheduler.stats.record_timeout(backend.get_name())
+        for method in 'timeout_callback', 'stop_callback':
+            await call_backend_method(backend, method, unique_task_id)
+
+    async def keepalive(self, unique_task_id):
+        if self.current_task_id != unique_task_id:
+            raise WrongTaskIdError(self, unique_task_id)
+        logger.debug('bumping keepalive %r(%s)', self, unique_task_id)
+        self._last_keepalive_at = datetime.now(UTC).replace(tzinfo=None)
+        await self.backend_method_wrapper('keepalive_callback')
+        await self.save()
+
+    async def start(self, unique_task_id, backend):
+        self._current_task_id = unique_task_id
+        self._current_backend_name = backend.get_name()
+        self._started_at = datetime.now(UTC).replace(tzinfo=None)
+        self._last_keepalive_at = datetime.now(UTC).replace(tzinfo=None)
+        await self.storage.index_task(self.scheduler, unique_task_id,
+                                      self.id_)
+        logger.warn('starting %r(%s)', self, unique_task_id)
+        self.scheduler.stats.record_start(backend, unique_task_id,
+                                          self._started_at)
+        await self.backend_method_wrapper('start_callback')
+        await self.save()
+
+    async def _free_slot(self):
+        task_id = self._current_task_id
+        self._current_task_id = None
+        self._current_backend_name = None
+        self._started_at = None
+        self._last_keepalive_at = None
+        await self.save()
+        if task_id is not None:
+            await self.storage.unindex_task(self.scheduler, task_id)
+
+    async def stop(self, unique_task_id):
+        if self.current_task_id != unique_task_id:
+            raise WrongTaskIdError(self, unique_task_id)
+        logger.warn('stopping %r(%s)', self, unique_task_id)
+        self.scheduler.stats.record_stop(self._current_backend_name,
+                                         self._started_at)
+        await self.backend_method_wrapper('stop_callback')
+        await self._free_slot()
+
+    async def save(self):
+        if self.scheduler._pending_saves is not None:
+            self.scheduler._pending_saves[self.id_] = self
+        else:
+            await self.storage.save(self)
+
+    async def reload(self):
+        await self.storage.reload(self)
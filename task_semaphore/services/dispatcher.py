@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ..exceptions import CallbackTimeoutError
+from .slot import call_backend_method, handle_backend_error
+
+logger = logging.getLogger(__name__)
+DEFAULT_CALLBACK_DEADLINE = 30  # in seconds
+
+
+class CallbackDispatcher:
+    """Calls the backends' callbacks in a pool of `workers` threads once the
+    slots' state has been written, so that slow callbacks don't hold the
+    scheduler's locks, see Scheduler's `callback_dispatcher`.
+
+    Callbacks not done `deadline` seconds after being dispatched
+    (`deadlines[method]` if set) are reported to their backend's
+    `backend_error_callback` with a CallbackTimeoutError, as are those
+    raising. Either way the tasks the backend gives up on (and those whose
+    `start_callback` failed) are released on the next pass, see `collect`.
+
+    The callbacks of a same task are called one after the other, in the
+    order they were dispatched in. Those of different tasks run concurrently,
+    alongside the scheduler's own calls, so backends used with a dispatcher
+    must be thread safe.
+    """
+
+    def __init__(self, workers=4, deadline=DEFAULT_CALLBACK_DEADLINE,
+                 deadlines=None):
+        self.deadline = deadline
+        self.deadlines = deadlines or {}
+        self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='task_semaphore.cb')
+        # future => (backend, method, task id, deadline in monotonic time)
+        self._running = {}
+        self._to_release = []
+        # task id => calls waiting for the one running for that task
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, backend, method, task_id):
+        deadline = time.monotonic() + self.deadlines.get(method,
+                                                         self.deadline)
+        call = (backend, method, task_id, deadline)
+        with self._lock:
+            if task_id in self._waiting:
+                self._waiting[task_id].append(call)
+                return
+            self._waiting[task_id] = []
+            future = self._start(call)
+        future.add_done_callback(partial(self._done, task_id))
+
+    def _start(self, call):
+        """Submit `call` to the threads, the lock being held"""
+        future = self._executor.submit(call_backend_method, *call[:3])
+        self._running[future] = call
+        return future
+
+    def _done(self, task_id, future):
+        with self._lock:
+            call = self._running.pop(future, None)
+            # else reported as overrun
+            if call is not None and not future.cancelled():
+                _, free_slot = future.result()
+                if free_slot:
+                    self._to_release.append(task_id)
+            future = self._start_next(task_id)
+        if future is not None:
+            future.add_done_callback(partial(self._done, task_id))
+
+    def _start_next(self, task_id):
+        """Start the next call waiting for `task_id`, the lock being held.
+        Return its future, None if none was waiting."""
+        waiting = self._waiting[task_id]
+        if waiting:
+            return self._start(waiting.pop(0))
+        del self._waiting[task_id]
+        if not self._waiting:
+            self._idle.notify_all()
+        return None
+
+    def collect(self):
+        """Report the callbacks that overran their deadline, those not
+        started yet being cancelled. Return the ids of the tasks to release.
+        """
+        now = time.monotonic()
+        with self._lock:
+            overran = [(future, call) for future, call
+                       in self._running.items() if call[3] < now]
+            for future, _ in overran:
+                del self._running[future]
+            to_release, self._to_release = self._to_release, []
+        for future, (backend, method, task_id, _) in overran:
+            future.cancel()
+            error = CallbackTimeoutError(backend, method, task_id)
+            if handle_backend_error(backend, method, task_id, error):
+                to_release.append(task_id)
+        return to_release
+
+    def close(self, timeout=None):
+        """Wait for the dispatched callbacks to be done, `timeout` seconds at
+        most, the longest of the deadlines by default. Those not started by
+        then are cancelled, those running left to end in their threads.
+
+        Return whether all the callbacks were done."""
+        if timeout is None:
+            timeout = max([self.deadline, *self.deadlines.values()])
+        queued = []
+        with self._idle:
+            done = self._idle.wait_for(lambda: not self._waiting, timeout)
+            if not done:
+                for waiting in self._waiting.values():
+                    queued.extend(waiting)
+                    waiting.clear()
+                not_started = [(future, call) for future, call
+                               in self._running.items()
+                               if not future.running()]
+        if not done:
+            # cancelling calls _done, which takes the lock
+            queued.extend(call for future, call in not_started
+                          if future.cancel())
+            logger.warn('callbacks still pending on close, cancelled: %r',
+                        [call[:3] for call in queued])
+        self._executor.shutdown(wait=done, cancel_futures=True)
+        return done
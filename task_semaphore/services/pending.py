@@ -0,0 +1,54 @@
+import copy
+
+
+class PendingWrites:
+    """Slot saves and callbacks deferred until the end of a pass or signal,
+    see Scheduler._saving_in_bulk. Each call has its own, so passes, reaping
+    and signals can run in several threads of the same process.
+
+    Slots are kept as they were when saved, so a reload by another thread
+    before the writes doesn't change what's written."""
+
+    def __init__(self, saves=True):
+        # slot id => (slot as saved, fields to save or None for all of them),
+        # None if each save decides whether the slot can change, see
+        # LOCK_OPTIMISTIC
+        self.saves = {} if saves else None
+        # slot id => (slot as saved, deadline), see AbstractSlot._set_deadline
+        self.deadlines = {}
+        # (scheduler, task id) => slot id or pool ref, None once freed, see
+        # AbstractStorage.save_many
+        self.indexes = {}
+        # (backend, method, task id) to dispatch, see Scheduler.call_backend
+        self.callbacks = []
+
+    def save(self, slot, fields=None):
+        """Have `slot` saved as it is now, only `fields` if given each time
+        it's saved"""
+        if slot.id_ in self.saves:
+            saved_fields = self.saves[slot.id_][1]
+            if saved_fields is None or fields is None:
+                fields = None
+            else:
+                fields = saved_fields + tuple(fields)
+        elif fields is not None:
+            fields = tuple(fields)
+        saved = copy.copy(slot)
+        self.saves[slot.id_] = (saved, fields)
+        deadline = slot._pop_deadline()
+        if deadline is not None:
+            self.deadlines[slot.id_] = (saved, deadline[slot])
+        self.indexes.update(slot._pop_indexes() or {})
+
+    def write(self, storage):
+        """Write the saved slots and the task index, in a single call to
+        `storage`"""
+        saves = self.saves or {}
+        if not saves and not self.indexes:
+            return
+        storage.save_many(
+                [slot for slot, _ in saves.values()],
+                fields={slot: fields for slot, fields in saves.values()
+                        if fields is not None},
+                deadlines=dict(self.deadlines.values()),
+                indexes=self.indexes)
@@ -0,0 +1,51 @@
+import threading
+import time
+
+
+class PrefetchBuffer:
+    """Task ids polled ahead from a backend, oldest first, see
+    AbstractPrioBackend.prefetch_depth. Ids are only used within
+    `prefetch_ttl` seconds of being polled."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        # task id => when it was polled, in monotonic time
+        self._task_ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._task_ids)
+
+    def __contains__(self, task_id):
+        return task_id in self._task_ids
+
+    @property
+    def missing(self):
+        """How many ids to poll to fill the buffer up"""
+        return max(0, self.backend.prefetch_depth - len(self._task_ids))
+
+    def add(self, task_ids):
+        now = time.monotonic()
+        with self._lock:
+            for task_id in task_ids:
+                self._task_ids.setdefault(task_id, now)
+
+    def take(self, count):
+        """Return up to `count` fresh ids, removed from the buffer, and the
+        stale ones, dropped, which should be released"""
+        expired_before = time.monotonic() - self.backend.prefetch_ttl
+        with self._lock:
+            stale = [task_id for task_id, polled_at
+                     in self._task_ids.items() if polled_at < expired_before]
+            for task_id in stale:
+                del self._task_ids[task_id]
+            task_ids = list(self._task_ids)[:count]
+            for task_id in task_ids:
+                del self._task_ids[task_id]
+        return task_ids, stale
+
+    def clear(self):
+        """Return every id, the buffer being emptied"""
+        with self._lock:
+            task_ids, self._task_ids = list(self._task_ids), {}
+        return task_ids
@@ -7,6 +7,11 @@ logger = logging.getLogger(__name__)
 
 class AbstractPrioBackend(metaclass=TaskSemaphoreMetaRegisterer):
     """Logic to priorize the next task to be executed"""
+    # how many task ids the scheduler polls ahead at the end of its passes,
+    # to start them as soon as a slot frees, and for how many seconds they
+    # can be used, see PrefetchBuffer. Unused ones go to `release_many`.
+    prefetch_depth = 0
+    prefetch_ttl = 30
 
     @classmethod
     def get_name(cls):
@@ -23,6 +28,22 @@ class AbstractPrioBackend(metaclass=TaskSemaphoreMetaRegisterer):
         If not task is available for queueing, return anything false."""
         raise NotImplementedError()
 
+    def poll_many(self, count):
+        """Return a list of at most `count` unique task ids, to override if
+        your backend can fetch several tasks in a single query.
+
+        By default will call `poll` once: the scheduler polls again while
+        it has idle slots, and a task may not change until started."""
+        task_id = self.poll()
+        return [task_id] if task_id else []
+
+    def release_many(self, task_ids):
+        """Called with task ids returned by `poll` or `poll_many` that the
+        scheduler won't start after all, for instance because the slots were
+        filled by a higher priority backend. To override if polling claims
+        the tasks, so they can be given back."""
+        pass
+
     def start_callback(self, unique_task_id):  # pragma: no cover
         """This method will be called once the slot has been attributed to a
         task, that's where you should put your code to actually launch the task
@@ -57,5 +78,40 @@ class AbstractPrioBackend(metaclass=TaskSemaphoreMetaRegisterer):
         """
         return False
 
+    def enqueued_at(self, unique_task_id):
+        """Return when the task has been enqueued (a naive datetime in UTC)
+        so the scheduler can measure how long tasks wait for a slot, or None
+        if unknown. Called on every start, it must be cheap."""
+        return None
+
     def inspect(self):
         return {}
+
+
+class AsyncPrioBackend(AbstractPrioBackend):
+    """AbstractPrioBackend for the AsyncScheduler, its methods being
+    coroutines. Plain AbstractPrioBackend can still be used with the
+    AsyncScheduler, their methods will then be run in threads."""
+
+    async def poll(self):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def poll_many(self, count):
+        task_id = await self.poll()
+        return [task_id] if task_id else []
+
+    async def start_callback(self, unique_task_id):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def stop_callback(self, unique_task_id):  # pragma: no cover
+        return NotImplemented
+
+    async def timeout_callback(self, unique_task_id):  # pragma: no cover
+        return NotImplemented
+
+    async def keepalive_callback(self, unique_task_id):  # pragma: no cover
+        return NotImplemented
+
+    async def backend_error_callback(self, unique_task_id, error,
+                                     method_name):
+        return False
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+from ..utils.lock import redis_client
+from .prio_backend import AbstractPrioBackend
+
+logger = logging.getLogger(__name__)
+
+# requeues the tasks claimed before ARGV[3] if given, then pops the
+# `ARGV[1]` tasks of lowest score, remembering their score in the claimed
+# hash so they can be requeued and the claim time `ARGV[2]` in KEYS[3]
+CLAIM_SCRIPT = """
+if ARGV[3] ~= '' then
+    local stale = redis.call('zrangebyscore', KEYS[3], '-inf', ARGV[3])
+    for i = 1, #stale do
+        local score = redis.call('hget', KEYS[2], stale[i])
+        if score then
+            redis.call('zadd', KEYS[1], score, stale[i])
+            redis.call('hdel', KEYS[2], stale[i])
+        end
+        redis.call('zrem', KEYS[3], stale[i])
+    end
+end
+local popped = redis.call('zpopmin', KEYS[1], ARGV[1])
+for i = 1, #popped, 2 do
+    redis.call('hset', KEYS[2], popped[i], popped[i + 1])
+    redis.call('zadd', KEYS[3], ARGV[2], popped[i])
+end
+return popped
+"""
+# enqueues (task id, priority) pairs, skipping the tasks being run
+ENQUEUE_SCRIPT = """
+local added = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('hexists', KEYS[2], ARGV[i]) == 0 then
+        added = added + redis.call('zadd', KEYS[1], ARGV[i + 1], ARGV[i])
+    end
+end
+return added
+"""
+# puts claimed tasks back in the queue with their priority
+REQUEUE_SCRIPT = """
+local requeued = 0
+for i = 1, #ARGV do
+    local score = redis.call('hget', KEYS[2], ARGV[i])
+    if score then
+        redis.call('zadd', KEYS[1], score, ARGV[i])
+        redis.call('hdel', KEYS[2], ARGV[i])
+        redis.call('zrem', KEYS[3], ARGV[i])
+        requeued = requeued + 1
+    end
+end
+return requeued
+"""
+
+
+class RedisQueueBackend(AbstractPrioBackend):
+    """Backend polling task ids from a redis sorted set, lowest priority
+    first. Tasks are claimed atomically when polled, in a single round trip
+    whatever the number of slots to fill, and stay claimed until stopped.
+
+    `redis_c` (a client, cluster client or connection pool) and
+    `queue_name` default to the class attributes of the same name, so
+    subclasses can be referenced by name in the config. `start_callback`
+    still has to be implemented to actually launch the tasks.
+
+    If `requeue_on_timeout`, timeouted tasks are put back in the queue with
+    their priority instead of being dropped. Tasks whose start failed are
+    dropped.
+
+    If `claim_ttl` is set, tasks claimed more than `claim_ttl` seconds ago,
+    for instance by a process that died before starting them, are requeued
+    when polling. Keepalives renew the claims, so it must be longer than
+    the timeout of the slots running the tasks, and subclasses overriding
+    `keepalive_callback` must call it."""
+    redis_c = None
+    queue_name = None
+    requeue_on_timeout = False
+    claim_ttl = None  # in seconds
+
+    def __init__(self, redis_c=None, queue_name=None,
+                 requeue_on_timeout=None, claim_ttl=None):
+        assert redis_c or self.redis_c, \
+                "TaskSemaphore: %r needs a redis client" % self
+        self.redis_c = redis_client(redis_c or self.redis_c)
+        self.queue_name = queue_name or self.queue_name or self.get_name()
+        if requeue_on_timeout is not None:
+            self.requeue_on_timeout = requeue_on_timeout
+        if claim_ttl is not None:
+            self.claim_ttl = claim_ttl
+        # tasks requeued on timeout, not to be forgotten by the stop_callback
+        # that follows as another scheduler may have claimed them already
+        self._requeued = set()
+        self._requeued_lock = threading.Lock()
+        self._claim_script = self.redis_c.register_script(CLAIM_SCRIPT)
+        self._enqueue_script = self.redis_c.register_script(ENQUEUE_SCRIPT)
+        self._requeue_script = self.redis_c.register_script(REQUEUE_SCRIPT)
+
+    @property
+    def _keys(self):
+        # hash tagged so all keys are on the same redis cluster node
+        key = "task_semaphore.queue.{%s}" % self.queue_name
+        return [key, key + '.claimed', key + '.claimed_at']
+
+    @staticmethod
+    def _decode(task_id):
+        return task_id.decode() if isinstance(task_id, bytes) else task_id
+
+    def enqueue(self, task_id, priority=0):
+        """Add `task_id` to the queue, or update its priority if already
+        pending. Return whether it was added, it isn't if already running."""
+        return bool(self.enqueue_many({task_id: priority}))
+
+    def enqueue_many(self, priorities):
+        """Same as enqueue with a dict (task id => priority) of tasks, in a
+        single round trip. Return how many were added."""
+        args = []
+        for task_id, priority in priorities.items():
+            args += [task_id, priority]
+        if not args:
+            return 0
+        return self._enqueue_script(keys=self._keys, args=args)
+
+    def poll(self):
+        task_ids = self.poll_many(1)
+        return task_ids[0] if task_ids else None
+
+    def poll_many(self, count):
+        now = time.time()
+        stale_before = now - self.claim_ttl if self.claim_ttl else ''
+        popped = self._claim_script(keys=self._keys,
+                                    args=[count, now, stale_before])
+        return [self._decode(task_id) for task_id in popped[::2]]
+
+    def release_many(self, task_ids):
+        self._requeue_script(keys=self._keys, args=task_ids)
+
+    def _forget(self, unique_task_id):
+        pipe = self.redis_c.pipeline(transaction=False)
+        pipe.hdel(self._keys[1], unique_task_id)
+        pipe.zrem(self._keys[2], unique_task_id)
+        pipe.execute()
+
+    def stop_callback(self, unique_task_id):
+        with self._requeued_lock:
+            if unique_task_id in self._requeued:
+                self._requeued.discard(unique_task_id)
+                return
+        self._forget(unique_task_id)
+
+    def timeout_callback(self, unique_task_id):
+        if self.requeue_on_timeout:
+            logger.info('requeuing %s in %r', unique_task_id, self)
+            with self._requeued_lock:
+                self._requeued.add(unique_task_id)
+            self.release_many([unique_task_id])
+
+    def keepalive_callback(self, unique_task_id):
+        if self.claim_ttl:
+            self.redis_c.zadd(self._keys[2], {unique_task_id: time.time()},
+                              xx=True)
+
+    def backend_error_callback(self, unique_task_id, error, method_name):
+        if method_name == 'start_callback':
+            self._forget(unique_task_id)
+        return False
+
+    def inspect(self):
+        pending_key, claimed_key, _ = self._keys
+        return {'pending': self.redis_c.zcard(pending_key),
+                'claimed': self.redis_c.hlen(claimed_key)}
@@ -0,0 +1,115 @@
+import logging
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+DEFAULT_MIN_INTERVAL = 1  # in seconds
+DEFAULT_MAX_INTERVAL = 60  # in seconds
+
+
+class Runner:
+    """Calls `schedule` on a scheduler until stopped (by `stop` or SIGTERM).
+
+    The interval between two passes goes down to `min_interval` when a pass
+    started or timeouted tasks and doubles, up to `max_interval`, when it
+    didn't. If `reap_interval` is set, `reap_timeouts` is run that often in
+    a thread alongside the passes, triggering a pass when it frees slots.
+    The same goes for `reap_expired_leases` if the scheduler uses leases,
+    `reap_interval` then being the fallback for the expirations missed.
+    Reaping doesn't wait for the pass in progress, see
+    Scheduler._saving_in_bulk, so backends must be thread safe.
+
+    Once stopped, the scheduler's callback dispatcher is closed, see
+    CallbackDispatcher.close for how long that waits.
+    """
+
+    def __init__(self, scheduler, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, reap_interval=None,
+                 on_pass=None):
+        self.scheduler = scheduler
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.reap_interval = reap_interval
+        self.on_pass = on_pass
+        self.interval = min_interval
+        self.last_pass = None
+        self._stopping = threading.Event()
+        self._wake_up = threading.Event()
+
+    def stop(self, *args):
+        """Stop after the current pass, can be used as a signal handler"""
+        logger.info('stopping %r after current pass', self.scheduler)
+        self._stopping.set()
+        self._wake_up.set()
+
+    def run(self):
+        handled_signals = self._handle_signals()
+        threads = []
+        if self.reap_interval:
+            threads.append(threading.Thread(target=self._reap, daemon=True,
+                                            name='task_semaphore.reaper'))
+        if self.scheduler.leases:
+            threads.append(threading.Thread(
+                    target=self._reap_leases, daemon=True,
+                    name='task_semaphore.lease_reaper'))
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stopping.is_set():
+                self._wake_up.clear()
+                self.run_pass()
+                self._wake_up.wait(self.interval)
+        finally:
+            self._stopping.set()
+            for thread in threads:
+                thread.join()
+            self.scheduler.release_prefetched()
+            if self.scheduler.callback_dispatcher is not None:
+                self.scheduler.callback_dispatcher.close()
+            for signum, handler in handled_signals.items():
+                signal.signal(signum, handler)
+
+    def run_pass(self):
+        start = time.monotonic()
+        try:
+            summary = self.scheduler.schedule()
+        except Exception:
+            logger.exception('scheduling pass failed:')
+            summary = {'idle': 0, 'timeouted': 0, 'started': 0}
+        summary['duration'] = time.monotonic() - start
+        if summary['started'] or summary['timeouted']:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        summary['next_interval'] = self.interval
+        logger.info('pass on %r took %.3fs: %r', self.scheduler,
+                    summary['duration'], summary)
+        self.last_pass = summary
+        if self.on_pass is not None:
+            self.on_pass(summary)
+        return summary
+
+    def _reap(self):
+        while not self._stopping.wait(self.reap_interval):
+            try:
+                if self.scheduler.reap_timeouts():
+                    self._wake_up.set()
+            except Exception:
+                logger.exception('reaping timeouts failed:')
+
+    def _reap_leases(self):
+        while not self._stopping.is_set():
+            try:
+                if self.scheduler.reap_expired_leases(timeout=1):
+                    self._wake_up.set()
+            except Exception:
+                logger.exception('reaping expired leases failed:')
+                self._stopping.wait(self.min_interval)
+
+    def _handle_signals(self):
+        """Stop on SIGTERM and SIGINT, returns the handlers replaced"""
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+        return {signum: signal.signal(signum, self.stop)
+                for signum in (signal.SIGTERM, signal.SIGINT)}
@@ -1,75 +1,961 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import UTC, datetime, timedelta
 
-from ..exceptions import TaskTimeoutError, WrongTaskIdError
-from .slot import AbstractSlot
+from ..exceptions import ConflictError, WrongTaskIdError
+from ..registry import get_backend_cls
+from ..stats.recorder import DEFAULT_STATS_WINDOW, StatsRecorder
+from ..utils.lock import LockGroup
+from .pending import PendingWrites
+from .prefetch import PrefetchBuffer
+from .runner import DEFAULT_MAX_INTERVAL, DEFAULT_MIN_INTERVAL, Runner
+from .slot import AbstractSlot, call_backend_method
+from .slot_pool import SlotPool
 
 logger = logging.getLogger(__name__)
+# one lock for the whole scheduler, every signal and pass serialize on it
+LOCK_SCHEDULER = 'scheduler'
+# one lock per slot, signals only lock the slot they target
+LOCK_SLOT = 'slot'
+# no lock, slots are written only if they didn't change since they were
+# loaded and the transitions retried on conflicts, see
+# AbstractStorage.compare_and_set
+LOCK_OPTIMISTIC = 'optimistic'
+# how many times a signal is retried on conflicts before giving up
+OPTIMISTIC_RETRIES = 5
+# how many times a backend giving only tasks already running is polled again
+# during a pass
+DUPLICATE_REPOLLS = 1
 
 
 class Scheduler:
 
     config = None
+    slot_cls = AbstractSlot
 
     KEYS_TO_SERIALIZE = ('config', )
 
-    def __init__(self, name, storage):
+    def __init__(self, name, storage, lock_mode=LOCK_SCHEDULER,
+                 poll_workers=0, refill_on_stop=False,
+                 stats_window=DEFAULT_STATS_WINDOW, timeout_policy=None,
+                 leases=False, callback_dispatcher=None):
+        """`lock_mode` must be the same for every process working on the
+        same scheduler, see LOCK_SCHEDULER, LOCK_SLOT and LOCK_OPTIMISTIC.
+
+        If `poll_workers` is set, backends will be polled concurrently by
+        that many threads during `schedule`.
+
+        If `refill_on_stop` is set, slots freed by `stop` will immediately be
+        given a new task instead of waiting for the next `schedule`.
+
+        Stats are counted by windows of `stats_window` seconds, 0 disables
+        them, see StatsRecorder.
+
+        `timeout_policy` may shorten the slots' timeouts, see
+        AdaptiveTimeoutPolicy.
+
+        With `leases`, slots hold a lease in the storage expiring at their
+        task's deadline, and tasks are timeouted as soon as it expires by
+        `reap_expired_leases`, which `run_forever` calls in a thread.
+
+        With a `callback_dispatcher`, the backends' callbacks are called by
+        its threads rather than inline, see CallbackDispatcher."""
+        assert lock_mode in (LOCK_SCHEDULER, LOCK_SLOT, LOCK_OPTIMISTIC), \
+                "TaskSemaphore: unknown lock mode %r" % lock_mode
+        assert lock_mode != LOCK_OPTIMISTIC \
+                or storage.supports_compare_and_set, \
+                "TaskSemaphore: %r can't compare and set" % storage
+        assert not leases or storage.supports_leases, \
+                "TaskSemaphore: %r doesn't support leases" % storage
         self.id_ = name
         self.storage = storage
+        self.lock_mode = lock_mode
+        self.poll_workers = poll_workers
+        self.refill_on_stop = refill_on_stop
         self.slots = {}
+        self.pools = {}
+        # slots by their id as a string and pools by their ref
+        self._slots_by_ref = {}
+        # passes and config syncs of this process run one at a time, reaping
+        # and signals running alongside them, see _saving_in_bulk
+        self._pass_lock = threading.RLock()
+        # the PendingWrites of the thread's pass or signal, see
+        # _saving_in_bulk
+        self._local = threading.local()
+        # task id => (slot, last keepalive), see _is_kept_alive
+        self._keepalives = {}
+        # backend ref => instance shared by every slot, see get_backend
+        self._backend_instances = {}
+        self.stats = StatsRecorder(self, window=stats_window)
+        self.timeout_policy = timeout_policy
+        self.leases = leases
+        self.callback_dispatcher = callback_dispatcher
+        # version of the config in use, see sync_config
+        self.config_version = None
+        # slots and pools removed from the config, see _drop_drained
+        self._draining = set()
+        # backend name => PrefetchBuffer, see AbstractPrioBackend's
+        # prefetch_depth
+        self._prefetched = {}
 
-    def init_from_config(self, config):
-        # TODO: config should be auto-loaded from db
-        self.config = config
-        for slot_config in config:
-            slot = self.add_slot(slot_config['slot_id'],
-                                 slot_config['backends'],
-                                 slot_config.get('slot_kwargs'))
-            slot.reload()
+    def init_from_config(self, config=None):
+        """Add the slots and pools described by `config`, loaded from the
+        storage if not given, see `publish_config`. A given `config` is
+        kept until a newer one is published."""
+        if config is None:
+            self.config_version, config = self.storage.load_config(self)
+            assert config is not None, \
+                    "TaskSemaphore: no config published for %r" % self.id_
+        else:
+            self.config_version = self.storage.config_version(self)
+        self._apply_config(config)
+        self.storage.reload_many(self.slots.values())
+        for pool in self.pools.values():
+            pool.reload()
         return self
 
+    def publish_config(self, config):
+        """Store `config` as the configuration of every process running this
+        scheduler, each of them applying it on its next pass, see
+        `sync_config`. Backends must be referenced by name or path.
+
+        Return the version of the published config."""
+        version = self.storage.publish_config(self, config)
+        logger.warn('published config version %d for %r', version, self)
+        return version
+
+    def sync_config(self):
+        """Apply the config published in the storage if it's newer than the
+        one in use. Cheap enough to be called on every pass: only the
+        config's version is fetched unless it changed.
+
+        Return whether a new config was applied."""
+        with self._pass_lock:
+            version = self.storage.config_version(self)
+            if version is None or version == self.config_version:
+                return False
+            version, config = self.storage.load_config(self)
+            logger.warn('applying config version %d to %r', version, self)
+            self._apply_config(config)
+            self.config_version = version
+            return True
+
+    def _apply_config(self, config):
+        """Add the slots and pools not there yet, rewire the backends of
+        those already there and drain those no longer configured: they won't
+        be given new tasks and will be removed once idle, see
+        `_drop_drained`.
+
+        `slot_kwargs` and `pool_kwargs` only apply to new slots and pools."""
+        configured = set()
+        for slot_config in config:
+            if 'pool_id' in slot_config:
+                id_ = slot_config['pool_id']
+                configured.add(('pool', id_))
+                if id_ not in self.pools:
+                    self.add_pool(id_, slot_config['size'],
+                                  slot_config['backends'],
+                                  slot_config.get('pool_kwargs'))
+                    continue
+                target = self.pools[id_]
+                target.size = slot_config['size']
+            else:
+                id_ = slot_config['slot_id']
+                configured.add(('slot', id_))
+                if id_ not in self.slots:
+                    self.add_slot(id_, slot_config['backends'],
+                                  slot_config.get('slot_kwargs'))
+                    continue
+                target = self.slots[id_]
+            self._draining.discard(target)
+            self._rewire(target, slot_config['backends'])
+        for kind, targets in ('slot', self.slots), ('pool', self.pools):
+            for id_, target in targets.items():
+                if (kind, id_) not in configured \
+                        and target not in self._draining:
+                    logger.warn('draining %r', target)
+                    self._draining.add(target)
+        self.config = config
+
+    def _rewire(self, target, backends):
+        """Replace the backends `target` polls, the backend of its running
+        tasks staying reachable until they end"""
+        backends_names = []
+        for backend in backends:
+            backend = self.get_backend(backend)
+            target._backends[backend.get_name()] = backend
+            backends_names.append(backend.get_name())
+        if backends_names != target._backends_names:
+            logger.info('%r now polls %r', target, backends_names)
+        target._backends_names = backends_names
+
+    def _drop_drained(self):
+        """Remove the drained slots and pools that are idle"""
+        for target in list(self._draining):
+            if isinstance(target, SlotPool):
+                if target.task_ids:
+                    continue
+                del self.pools[target.id_]
+                del self._slots_by_ref[target.ref]
+            else:
+                if target.current_task_id:
+                    continue
+                del self.slots[target.id_]
+                del self._slots_by_ref[str(target.id_)]
+            logger.warn('%r drained, removed', target)
+            self._draining.discard(target)
+
+    @contextmanager
+    def _saving_in_bulk(self):
+        """Slots saved within this block will only be written once it exits,
+        all in a single call to the storage along their deadlines, as will
+        the stats. Except with LOCK_OPTIMISTIC, as each save decides whether
+        the slot can change.
+
+        What's pending is kept per thread, see PendingWrites."""
+        previous = self._pending
+        pending = self._local.pending = PendingWrites(
+                saves=not self.is_optimistic)
+        try:
+            yield pending
+        finally:
+            self._local.pending = previous
+            pending.write(self.storage)
+            self.stats.flush()
+            for callback in pending.callbacks:
+                self.callback_dispatcher.submit(*callback)
+
+    @property
+    def _pending(self):
+        """The PendingWrites of this thread, None out of `_saving_in_bulk`"""
+        return getattr(self._local, 'pending', None)
+
+    def call_backend(self, backend, method, task_id):
+        """Call `method` of `backend` for `task_id`, see call_backend_method.
+
+        With a `callback_dispatcher` it's called later by its threads, once
+        the slots are saved, and (None, False) is returned."""
+        if self.callback_dispatcher is None:
+            return call_backend_method(backend, method, task_id)
+        pending = self._pending
+        if pending is not None:
+            pending.callbacks.append((backend, method, task_id))
+        else:
+            self.callback_dispatcher.submit(backend, method, task_id)
+        return None, False
+
+    def _release_given_up(self):
+        """Release the tasks dispatched callbacks gave up on"""
+        for task_id in self.callback_dispatcher.collect():
+            try:
+                self._transmit_to_slot('release', task_id)
+            except WrongTaskIdError:
+                logger.info('%r is gone already, not releasing it', task_id)
+
     def schedule(self):
-        """ Schedules new tasks for available slots """
-        with self.storage.lock_on(self):
+        """ Schedules new tasks for available slots
+
+        Return a dict counting the slots found `idle` (timeouted included),
+        the tasks `timeouted` and the tasks `started` during the pass."""
+        with self._pass_lock:
+            self._forget_old_keepalives()
+            self.sync_config()
+            if self.callback_dispatcher is not None:
+                self._release_given_up()
+            if self.timeout_policy is not None:
+                self.timeout_policy.refresh_if_needed(self)
+            if self.lock_mode != LOCK_SCHEDULER:
+                summary = self._schedule_per_slot()
+            else:
+                summary = self._schedule_with_lock()
+            self._drop_drained()
+            self._prefetch()
+            return summary
+
+    def _schedule_with_lock(self):
+        """The whole pass under the scheduler wide lock"""
+        started = set()
+        with self.storage.lock_on(self) as lock, self._saving_in_bulk():
             logger.info('starting reviewing slots for scheduling')
+            self.storage.reload_many(self.slots.values())
+            idle, timeouted = self._review(self.slots.values(), started, lock)
+            for pool in self.pools.values():
+                pool_idle, pool_timeouted = self._review_pool(pool, started,
+                                                              lock)
+                idle, timeouted = idle + pool_idle, timeouted + pool_timeouted
+        return {'idle': idle, 'timeouted': timeouted,
+                'started': len(started)}
+
+    def _schedule_per_slot(self):
+        """Only slots that are idle or late are locked, and those already
+        locked by someone else are skipped for this pass."""
+        logger.info('starting reviewing slots for scheduling')
+        self.storage.reload_many(self.slots.values())
+        with ExitStack() as stack:
+            locks, locked_slots = LockGroup(), []
             for slot in self.slots.values():
-                slot.reload()
-                if slot.current_task_id:
+                if slot.current_task_id and not slot.is_late:
                     logger.debug('slot %s is busy', slot)
-                    try:
-                        slot.timeout_if_late(slot.current_task_id)
-                    except TaskTimeoutError:
-                        slot.stop(slot.current_task_id)
-                    else:  # if not timeouted
+                    continue
+                lock = slot.lock_on()
+                if not lock.acquire(blocking=False):
+                    logger.debug('slot %s is locked, skipping', slot)
+                    continue
+                stack.callback(lock.release)
+                locks.add(lock)
+                locked_slots.append(slot)
+            locked_pools = []
+            for pool in self.pools.values():
+                lock = pool.lock_on()
+                if not lock.acquire(blocking=False):
+                    logger.debug('pool %s is locked, skipping', pool)
+                    continue
+                stack.callback(lock.release)
+                locks.add(lock)
+                locked_pools.append(pool)
+            stack.enter_context(self._saving_in_bulk())
+            self.storage.reload_many(locked_slots)
+            started = set()
+            idle, timeouted = self._review(locked_slots, started, locks)
+            for pool in locked_pools:
+                pool_idle, pool_timeouted = self._review_pool(pool, started,
+                                                              locks)
+                idle, timeouted = idle + pool_idle, timeouted + pool_timeouted
+        return {'idle': idle, 'timeouted': timeouted,
+                'started': len(started)}
+
+    def _review(self, slots, started, lock=None):
+        """Timeout the late tasks of `slots` then fill those idle. Return
+        how many slots were found idle and how many tasks were timeouted.
+
+        `lock`, the lock (or LockGroup) held for the pass if any, is renewed
+        all along."""
+        idle_slots, timeouted = [], 0
+        for slot in slots:
+            self._renew(lock)
+            was_busy = bool(slot.current_task_id)
+            if self._is_idle(slot):
+                idle_slots.append(slot)
+                timeouted += was_busy
+        self._fill(idle_slots, started, lock)
+        return len(idle_slots), timeouted
+
+    def _review_pool(self, pool, started, lock=None):
+        """Same as `_review` for a SlotPool"""
+        self._renew(lock)
+        pool.reload_late(self._max_shortening())
+        late_task_ids = pool.late_task_ids()
+        for task_id in late_task_ids:
+            pool.timeout(task_id)
+        idle = pool.free_capacity
+        self._fill_pool(pool, started, lock)
+        return idle, len(late_task_ids)
+
+    @staticmethod
+    def _renew(lock):
+        """Renew `lock` if given and half of its lease elapsed, see
+        AbstractLock.renew_if_needed"""
+        if lock is not None:
+            lock.renew_if_needed()
+
+    def _fill_pool(self, pool, started, lock=None):
+        """Start tasks from the pool's backends, in order, while it has
+        free capacity, renewing `lock` if given."""
+        if pool in self._draining:
+            return
+        for backend_name in pool._backends_names:
+            backend = pool._backends[backend_name]
+            prefetched = self._take_prefetched(backend_name,
+                                               pool.free_capacity)
+            repolls = DUPLICATE_REPOLLS
+            while pool.free_capacity:
+                self._renew(lock)
+                polled = prefetched or backend.poll_many(pool.free_capacity)
+                task_ids = [task_id for task_id in self._skip_duplicates(
+                                backend_name, polled, started)
+                            if task_id not in pool._tasks]
+                if not task_ids:
+                    if prefetched:
+                        prefetched = []
                         continue
-                task_id, backend = slot.poll()
-                if task_id is not None:
-                    slot.start(task_id, backend)
+                    if not polled or not repolls:
+                        break
+                    repolls -= 1
+                    continue
+                task_ids, left_over = (task_ids[:pool.free_capacity],
+                                       task_ids[pool.free_capacity:])
+                for index, task_id in enumerate(task_ids):
+                    if not pool.start(task_id, backend):
+                        # someone else took the capacity meanwhile
+                        self._release(backend, task_ids[index:] + left_over)
+                        return
+                    started.add(task_id)
+                self._release(backend, left_over)
+            if not pool.free_capacity:
+                return
+
+    def reap_timeouts(self, slot_ids=None):
+        """Timeout the late tasks without reviewing every slot, relying on the
+        storage's deadlines index if it keeps one. Cheap enough to be called
+        much more often than `schedule`.
+
+        If `slot_ids` is given, only those slots are looked at, pools aren't.
+
+        Return the number of tasks timeouted."""
+        with ExitStack() as stack:
+            if self.timeout_policy is not None:
+                self.timeout_policy.refresh_if_needed(self)
+            if self.lock_mode == LOCK_SCHEDULER:
+                stack.enter_context(self.storage.lock_on(self))
+            late_slots = self._locked(stack, self._late_slots(slot_ids))
+            pools = self._locked(stack, list(self.pools.values())
+                                 if slot_ids is None else [])
+            stack.enter_context(self._saving_in_bulk())
+            reaped = self._reap_slots(late_slots)
+            for pool in pools:
+                reaped += self._reap_pool(pool)
+            return reaped
+
+    def _locked(self, stack, targets):
+        """Return the slots (or pools) of `targets` whose lock could be
+        acquired right away, released when leaving `stack`. All of them with
+        LOCK_SCHEDULER, the scheduler's lock being held."""
+        if self.lock_mode == LOCK_SCHEDULER:
+            return list(targets)
+        locked = []
+        for target in targets:
+            lock = target.lock_on()
+            if not lock.acquire(blocking=False):
+                continue
+            stack.callback(lock.release)
+            locked.append(target)
+        return locked
+
+    def _reap_slots(self, slots):
+        """Timeout the tasks of `slots` that are still late once reloaded,
+        return how many"""
+        self.storage.reload_many(slots)
+        freed = [slot for slot in slots
+                 if slot.current_task_id and self._is_idle(slot)]
+        if self.refill_on_stop:
+            self._fill(freed)
+        return len(freed)
+
+    def _reap_pool(self, pool):
+        """Timeout the late tasks of `pool`, return how many"""
+        pool.reload_late(self._max_shortening())
+        late_task_ids = pool.late_task_ids()
+        for task_id in late_task_ids:
+            pool.timeout(task_id)
+        if late_task_ids and self.refill_on_stop:
+            self._fill_pool(pool, set())
+        return len(late_task_ids)
+
+    def reap_expired_leases(self, timeout=1):
+        """Wait up to `timeout` seconds for slots' leases to expire (see
+        `leases`) and timeout their tasks.
+
+        Return the number of tasks timeouted."""
+        slot_ids = self.storage.expired_leases(self, timeout)
+        if not slot_ids:
+            return 0
+        logger.info('leases expired on %r', slot_ids)
+        return self.reap_timeouts(slot_ids)
+
+    def timeout_for(self, backend_name, timeout_after):
+        """Timeout of a task of `backend_name` on a slot (or pool) configured
+        with `timeout_after`, according to the `timeout_policy`"""
+        if self.timeout_policy is None or backend_name is None:
+            return timeout_after
+        return self.timeout_policy.timeout_for(backend_name, timeout_after)
+
+    def _late_slots(self, slot_ids=None):
+        """The slots that may be late, to be checked once locked and
+        reloaded.
+
+        Indexed deadlines were computed with the timeouts in force when
+        the tasks were last kept alive, so those of the slots whose timeout
+        the `timeout_policy` may have shortened since are looked ahead."""
+        if slot_ids is not None:
+            return [self._slots_by_ref[slot_ref] for slot_ref in slot_ids
+                    if slot_ref in self._slots_by_ref]
+        now = datetime.now(UTC).replace(tzinfo=None)
+        if self.storage.indexes_deadlines:
+            return [self._slots_by_ref[slot_ref] for slot_ref
+                    in self.storage.expired_slots(
+                        self, now + self._max_shortening())
+                    if slot_ref in self._slots_by_ref]
+        slots = list(self.slots.values())
+        self.storage.reload_many(slots)
+        return [slot for slot in slots if slot.is_late]
+
+    def _max_shortening(self):
+        """How much the `timeout_policy` shortens the timeouts of the slots
+        and pools at most"""
+        if self.timeout_policy is None:
+            return timedelta(0)
+        return max((target.timeout_after
+                    - self.timeout_for(backend_name, target.timeout_after)
+                    for target in list(self.slots.values())
+                    + list(self.pools.values())
+                    for backend_name in target._backends),
+                   default=timedelta(0))
+
+    def run_forever(self, min_interval=DEFAULT_MIN_INTERVAL,
+                    max_interval=DEFAULT_MAX_INTERVAL, reap_interval=None,
+                    on_pass=None):
+        """Schedule in a loop until SIGTERM (or SIGINT) is received, see
+        Runner. `on_pass` will be called with each pass' summary."""
+        Runner(self, min_interval=min_interval, max_interval=max_interval,
+               reap_interval=reap_interval, on_pass=on_pass).run()
+
+    @property
+    def is_optimistic(self):
+        return self.lock_mode == LOCK_OPTIMISTIC
+
+    def _is_idle(self, slot):
+        """Return whether `slot` is idle, timeouting its task if late"""
+        if slot.current_task_id:
+            if not slot.is_late:
+                logger.debug('slot %s is busy', slot)
+                return False
+            try:
+                slot.timeout(slot.current_task_id)
+            except ConflictError:  # changed meanwhile, and reloaded
+                return not slot.current_task_id
+        return True
+
+    def _fill(self, slots, started=None, lock=None):
+        """Start tasks on the idle `slots`. Slots sharing the same backends are
+        filled together, each backend being asked for as many tasks as there
+        are slots left to fill. Task ids in `started` are skipped, the set is
+        updated and returned. `lock` is renewed along if given."""
+        if started is None:
+            started = set()
+        slots_by_backends = {}
+        for slot in slots:
+            if slot in self._draining:
+                continue
+            slots_by_backends.setdefault(tuple(slot._backends_names), []) \
+                    .append(slot)
+        if self.poll_workers and slots_by_backends:
+            return self._fill_concurrently(slots_by_backends, started, lock)
+        for backends_names, idle_slots in slots_by_backends.items():
+            for backend_name in backends_names:
+                if not idle_slots:
+                    break
+                idle_slots = self._fill_from(backend_name, idle_slots,
+                                             started, lock)
+            for slot in idle_slots:
+                logger.debug('nothing to do for slot %r', slot)
+        return started
+
+    def _fill_concurrently(self, slots_by_backends, started, lock=None):
+        """Every backend of every group of slots is polled at once, then the
+        tasks are attributed in the backends' order, lower priority results
+        being discarded if not needed.
+
+        A backend that gave tasks is polled again if slots are left, so
+        backends only changing their answer once a task is started keep
+        their priority."""
+        polls = self._poll_concurrently(slots_by_backends)
+        for backends_names, idle_slots in slots_by_backends.items():
+            for backend_name in backends_names:
+                self._renew(lock)
+                task_ids = polls[backends_names, backend_name]
+                if task_ids is None:
+                    continue
+                if idle_slots:
+                    idle_slots = self._start_prefetched(backend_name,
+                                                        idle_slots, started)
+                if not idle_slots:  # polled for nothing
+                    backend = slots_by_backends[backends_names][0] \
+                        ._backends[backend_name]
+                    self._release(backend, task_ids)
+                    continue
+                task_ids, idle_slots = self._start_on(
+                        backend_name, idle_slots, task_ids, started, lock)
+                if task_ids and idle_slots:
+                    idle_slots = self._fill_from(backend_name, idle_slots,
+                                                 started, lock)
+            for slot in idle_slots:
+                logger.debug('nothing to do for slot %r', slot)
+        return started
+
+    def _poll_concurrently(self, slots_by_backends):
+        """Poll every backend of every group of slots at once. A backend
+        instance shared by several groups is polled by a single call for
+        all of them, so the pass never polls it twice at once. It can still
+        be called meanwhile by reaping or a CallbackDispatcher's threads.
+
+        Return the task ids polled for each (group, backend name), None if
+        polling failed."""
+        calls = {}  # backend instance id => (backend, [(key, count)])
+        for backends_names, idle_slots in slots_by_backends.items():
+            for backend_name in backends_names:
+                backend = idle_slots[0]._backends[backend_name]
+                calls.setdefault(id(backend), (backend, []))[1].append(
+                        ((backends_names, backend_name), len(idle_slots)))
+        with ThreadPoolExecutor(max_workers=self.poll_workers) as executor:
+            futures = {backend_id: executor.submit(
+                           backend.poll_many,
+                           sum(count for _, count in callers))
+                       for backend_id, (backend, callers) in calls.items()}
+        polls = {}
+        for backend_id, (backend, callers) in calls.items():
+            try:
+                task_ids = futures[backend_id].result()
+            except Exception:
+                logger.exception('polling %r failed:', backend)
+                task_ids = None
+            for key, count in callers:
+                if task_ids is None:
+                    polls[key] = None
+                    continue
+                polls[key], task_ids = task_ids[:count], task_ids[count:]
+        return polls
+
+    def _fill_from(self, backend_name, slots, started, lock=None):
+        """Poll `backend_name` for `slots` until they're all started or the
+        backend has nothing new to offer, renewing `lock` if given. Return
+        the slots left idle."""
+        backend = slots[0]._backends[backend_name]
+        slots = self._start_prefetched(backend_name, slots, started)
+        repolls = DUPLICATE_REPOLLS
+        while slots:
+            self._renew(lock)
+            polled = backend.poll_many(len(slots))
+            task_ids, slots = self._start_on(backend_name, slots, polled,
+                                             started, lock)
+            if not task_ids:
+                if not polled or not repolls:
+                    break
+                repolls -= 1  # only got tasks already running
+        return slots
+
+    def _take_prefetched(self, backend_name, count):
+        """Return up to `count` ids prefetched from `backend_name`, releasing
+        those gone stale"""
+        buffer = self._prefetched.get(backend_name)
+        if buffer is None:
+            return []
+        task_ids, stale = buffer.take(count)
+        self._release(buffer.backend, stale)
+        return task_ids
+
+    def _start_prefetched(self, backend_name, slots, started):
+        """Start the ids prefetched from `backend_name` on `slots`, return
+        the slots left idle"""
+        task_ids = self._take_prefetched(backend_name, len(slots))
+        if task_ids:
+            _, slots = self._start_on(backend_name, slots, task_ids, started)
+        return slots
+
+    def _prefetch(self):
+        """Poll ahead the backends with a `prefetch_depth` whose slots and
+        pools are all busy, see PrefetchBuffer. Those with idle slots have
+        just been polled for nothing.
+
+        The ids prefetched from backends no longer polled by any slot or
+        pool, or replaced by another instance, are released."""
+        backends, idle_backends = self._polled_backends()
+        for backend_name, buffer in list(self._prefetched.items()):
+            if backends.get(backend_name) is not buffer.backend:
+                self._release(buffer.backend, buffer.clear())
+                del self._prefetched[backend_name]
+        for backend_name, backend in backends.items():
+            if backend.prefetch_depth:
+                self._prefetch_from(backend_name, backend,
+                                    idle=backend_name in idle_backends)
+
+    def _polled_backends(self):
+        """Return the backends polled by the slots and pools not being
+        drained, by name, and the names of those polled by idle ones"""
+        backends, idle_backends = {}, set()
+        for target in list(self.slots.values()) + list(self.pools.values()):
+            if target in self._draining:
+                continue
+            for backend_name in target._backends_names:
+                backends[backend_name] = target._backends[backend_name]
+            if target.free_capacity if isinstance(target, SlotPool) \
+                    else not target.current_task_id:
+                idle_backends.update(target._backends_names)
+        return backends, idle_backends
+
+    def _prefetch_from(self, backend_name, backend, idle=False):
+        """Release the stale ids prefetched from `backend` and, unless its
+        slots are `idle`, poll it for those missing"""
+        buffer = self._prefetched.get(backend_name)
+        if buffer is None:
+            buffer = self._prefetched[backend_name] = PrefetchBuffer(backend)
+        self._release(backend, buffer.take(0)[1])
+        if idle or not buffer.missing:
+            return
+        try:
+            polled = backend.poll_many(buffer.missing)
+        except Exception:
+            logger.exception('prefetching from %r failed:', backend)
+            return
+        buffer.add(self._skip_duplicates(
+                backend_name, [task_id for task_id in polled
+                               if task_id not in buffer], set()))
+
+    def release_prefetched(self):
+        """Give the prefetched ids back to their backends"""
+        for buffer in self._prefetched.values():
+            self._release(buffer.backend, buffer.clear())
+
+    def _skip_duplicates(self, backend_name, task_ids, started):
+        """Return the polled `task_ids` that aren't already running, either
+        `started` during the pass or, if the storage indexes tasks, anywhere
+        else. Duplicates are counted in the stats, not released."""
+        unique = [task_id for task_id in dict.fromkeys(task_ids)
+                  if task_id not in started]
+        if unique and self.storage.indexes_tasks:
+            # the index writes of this pass are still pending
+            pending = self._pending
+            indexes = pending.indexes if pending is not None else {}
+            unique = [task_id for task_id, slot_ref in zip(
+                          unique, self.storage.find_tasks(self, unique))
+                      if indexes.get((self, task_id), slot_ref) is None]
+        duplicates = len(task_ids) - len(unique)
+        if duplicates:
+            logger.info('%s gave %d tasks already running', backend_name,
+                        duplicates)
+            self.stats.record_duplicates(backend_name, duplicates)
+        return unique
+
+    def _start_on(self, backend_name, slots, task_ids, started, lock=None):
+        """Start `task_ids` on `slots` skipping duplicates (see
+        `_skip_duplicates`), releasing those left over and renewing `lock`
+        if given. Return the task ids actually started and the slots left
+        idle.
+
+        With LOCK_OPTIMISTIC, slots changed meanwhile by someone else are
+        skipped, their task being started on the next slot."""
+        backend = slots[0]._backends[backend_name]
+        task_ids = self._skip_duplicates(backend_name, task_ids, started)
+        started_ids, slots = [], list(slots)
+        while task_ids and slots:
+            self._renew(lock)
+            slot = slots.pop(0)
+            try:
+                slot.start(task_ids[0], backend)
+            except ConflictError:
+                continue
+            started_ids.append(task_ids.pop(0))
+            started.add(started_ids[-1])
+        self._release(backend, task_ids)
+        return started_ids, slots
+
+    @staticmethod
+    def _release(backend, task_ids):
+        """Give back to `backend` the polled `task_ids` that won't be
+        started, see AbstractPrioBackend.release_many"""
+        if not task_ids:
+            return
+        logger.debug('releasing %r to %r', task_ids, backend)
+        try:
+            backend.release_many(list(task_ids))
+        except Exception:
+            logger.exception('releasing %r to %r failed:', task_ids, backend)
+
+    def _find_slot(self, task_id):
+        """Return the slot (or pool) running `task_id`, through the storage's
+        index if it keeps one, else by reloading and browsing all of them."""
+        slot = self._find_slots([task_id]).get(task_id)
+        if slot is None:
+            raise WrongTaskIdError(self, task_id)
+        return slot
+
+    def _transmit_to_slot(self, method, task_id, refill=False):
+        """Call `method` on the slot running `task_id` under lock, then poll
+        for a new task if `refill` and the slot has been freed."""
+        if self.lock_mode != LOCK_SCHEDULER:
+            slot = self._find_slot(task_id)
+            lock = slot.lock_on()
+        else:
+            slot, lock = None, self.storage.lock_on(self)
+        with lock:
+            slot = slot or self._find_slot(task_id)
+            slot.reload()
+            logger.debug('passing %r to %r(%r)', method, slot, task_id)
+            try:
+                result = self._call_on(slot, method, task_id)
+                if refill:
+                    self._refill([slot])
+            finally:
+                self.stats.flush()
+            return result
+
+    @staticmethod
+    def _call_on(slot, method, task_id):
+        """Call `method` on `slot`, retrying on conflicts with
+        LOCK_OPTIMISTIC, the slot being reloaded each time"""
+        for _ in range(OPTIMISTIC_RETRIES - 1):
+            try:
+                return getattr(slot, method)(task_id)
+            except ConflictError:
+                logger.info('conflict on %r, retrying %r', slot, method)
+        return getattr(slot, method)(task_id)
+
+    def _find_slots(self, task_ids):
+        """Same as `_find_slot` for several tasks, returns a dict with the
+        slot of each task found.
+
+        Tasks missing from the storage's index (eg started before it kept
+        one) are looked for in every slot, and indexed if found. Tasks
+        running on slots unknown to this process get the published config
+        applied, see `sync_config`."""
+        task_ids, found = list(task_ids), {}
+        if self.storage.indexes_tasks:
+            slot_refs = self.storage.find_tasks(self, task_ids)
+            if any(slot_ref not in self._slots_by_ref
+                   for slot_ref in slot_refs if slot_ref is not None):
+                self.sync_config()
+            found = {task_id: self._slots_by_ref[slot_ref]
+                     for task_id, slot_ref in zip(task_ids, slot_refs)
+                     if slot_ref in self._slots_by_ref}
+            task_ids = [task_id for task_id in task_ids
+                        if task_id not in found]
+            if not task_ids:
+                return found
+        found.update(self._scan_for(task_ids))
+        return found
+
+    def _scan_for(self, task_ids):
+        """Find `task_ids` by reloading and browsing all the slots"""
+        self._reload(list(self.slots.values()) + list(self.pools.values()))
+        slots_by_task = {slot.current_task_id: slot
+                         for slot in self.slots.values()
+                         if slot.current_task_id}
+        for pool in self.pools.values():
+            slots_by_task.update(dict.fromkeys(pool.task_ids, pool))
+        found = {task_id: slots_by_task[task_id]
+                 for task_id in task_ids if task_id in slots_by_task}
+        if self.storage.indexes_tasks:
+            for task_id, slot in found.items():
+                logger.info('indexing %r, running on %r', task_id, slot)
+                self.storage.index_task(
+                        self, task_id, slot.ref if isinstance(slot, SlotPool)
+                        else slot.id_)
+        return found
+
+    def _reload(self, targets):
+        """Reload slots in bulk, and pools"""
+        self.storage.reload_many([target for target in targets
+                                  if not isinstance(target, SlotPool)])
+        for target in targets:
+            if isinstance(target, SlotPool):
+                target.reload()
+
+    def _refill(self, targets):
+        """Fill the slots left idle and the pools with free capacity"""
+        started = self._fill([target for target in targets
+                              if not isinstance(target, SlotPool)
+                              and not target.current_task_id])
+        for target in targets:
+            if isinstance(target, SlotPool):
+                self._fill_pool(target, started)
+
+    def _transmit_to_slots(self, method, task_ids, refill=False):
+        """Like `_transmit_to_slot` but for several tasks under a single
+        lock acquisition and a single write.
+
+        Return a dict telling for each task id whether it was transmitted
+        (True) or unknown (False)."""
+        task_ids = list(task_ids)
+        with ExitStack() as stack:
+            if self.lock_mode != LOCK_SCHEDULER:
+                targets = self._find_slots(task_ids)
+                # always locking in the same order to avoid dead locks
+                for slot in sorted(set(targets.values()),
+                                   key=lambda slot: slot._storage_key):
+                    stack.enter_context(slot.lock_on())
+            else:
+                stack.enter_context(self.storage.lock_on(self))
+                targets = self._find_slots(task_ids)
+            stack.enter_context(self._saving_in_bulk())
+            self._reload(set(targets.values()))
+            result = {}
+            for task_id in task_ids:
+                try:
+                    if task_id not in targets:
+                        raise WrongTaskIdError(self, task_id)
+                    self._call_on(targets[task_id], method, task_id)
+                except WrongTaskIdError:
+                    logger.info('%r is unknown, ignoring %r', task_id, method)
+                    result[task_id] = False
                 else:
-                    logger.debug('nothing to do for slot %r', slot)
+                    result[task_id] = True
+            if refill:
+                self._refill(set(targets.values()))
+            return result
 
-    def _transmit_to_slot(self, method, task_id):
-        with self.storage.lock_on(self):
-            for slot in self.slots.values():
-                if slot.current_task_id == task_id:
-                    logger.debug('passing %r to %r(%r)', method, slot, task_id)
-                    return getattr(slot, method)(task_id)
-        raise WrongTaskIdError(self, task_id)
+    def _is_kept_alive(self, task_id):
+        """Whether this process persisted a keepalive for `task_id` less than
+        its slot's `keepalive_resolution` ago"""
+        kept_alive = self._keepalives.get(task_id)
+        if kept_alive is None:
+            return False
+        slot, last_keepalive_at = kept_alive
+        now = datetime.now(UTC).replace(tzinfo=None)
+        if now - last_keepalive_at < slot.keepalive_resolution:
+            return True
+        self._keepalives.pop(task_id, None)
+        return False
+
+    def _forget_old_keepalives(self):
+        """Forget the keepalives persisted too long ago, oldest first, see
+        AbstractSlot._keepalive_persisted. Stops at the first one still
+        recent, so it's cheap enough to be called on every keepalive."""
+        while self._keepalives:
+            try:
+                task_id = next(iter(self._keepalives))
+            except (StopIteration, RuntimeError):  # changed by another thread
+                return
+            if self._is_kept_alive(task_id):
+                return
 
     def keepalive(self, task_id):
         """ Inform the scheduler that the task is still running
         Will reset the timeout """
+        self._forget_old_keepalives()
+        if self._is_kept_alive(task_id):
+            logger.debug('%r has been kept alive recently, skipping', task_id)
+            return
         self._transmit_to_slot('keepalive', task_id)
 
     def stop(self, task_id):
         """Inform the scheduler that the task with task_id is finished and that
         its slot should be freed.
         """
-        self._transmit_to_slot('stop', task_id)
+        self._transmit_to_slot('stop', task_id, refill=self.refill_on_stop)
+
+    def keepalive_many(self, task_ids):
+        """Same as keepalive for several tasks at once, returns for each task
+        id whether it was known."""
+        self._forget_old_keepalives()
+        result = {task_id: True for task_id in task_ids
+                  if self._is_kept_alive(task_id)}
+        task_ids = [task_id for task_id in task_ids if task_id not in result]
+        if task_ids:
+            result.update(self._transmit_to_slots('keepalive', task_ids))
+        return result
+
+    def stop_many(self, task_ids):
+        """Same as stop for several tasks at once, returns for each task id
+        whether it was known."""
+        return self._transmit_to_slots('stop', task_ids,
+                                       refill=self.refill_on_stop)
 
     def add_slot(self, id_, backends=None, slot_kwargs=None):
         """Add a single slot with an id_ that
         hasn't been yet registered (unique).
-        `backends` must be a list of registered backends. See Slot.add_backend.
+        `backends` must be a list of registered backends, backend paths or
+        instances, see `get_backend`.
         `slot_kwargs` are the kwargs you want to pass on to the soon to be
         instantiated backends.
         """
@@ -77,24 +963,66 @@ class Scheduler:
                 "TaskSemaphore: slot with id %r already registered!" % id_
         if not slot_kwargs:
             slot_kwargs = {}
-        self.slots[id_] = AbstractSlot(id_=id_, scheduler=self, **slot_kwargs)
+        self.slots[id_] = self.slot_cls(id_=id_, scheduler=self, **slot_kwargs)
+        self._slots_by_ref[str(id_)] = self.slots[id_]
         for backend in backends:
-            self.slots[id_].add_backend(backend)
+            self.slots[id_].add_backend(self.get_backend(backend))
         return self.slots[id_]
 
+    def add_pool(self, id_, size, backends=None, pool_kwargs=None):
+        """Add a SlotPool of `size` slots, `id_` must be unique among the
+        pools. See `add_slot` for the other arguments."""
+        assert id_ not in self.pools, \
+                "TaskSemaphore: pool with id %r already registered!" % id_
+        pool = SlotPool(id_=id_, scheduler=self, size=size,
+                        **(pool_kwargs or {}))
+        self.pools[id_] = self._slots_by_ref[pool.ref] = pool
+        for backend in backends or []:
+            pool.add_backend(self.get_backend(backend))
+        return pool
+
+    def get_backend(self, backend):
+        """Return the instance of `backend` shared by all the slots of this
+        scheduler, instantiating it on first use.
+
+        `backend` may be a registered backend name or a
+        "package.module:ClassName" path, see `get_backend_cls`. Instances
+        are returned as is."""
+        if not isinstance(backend, str):
+            return backend
+        if backend not in self._backend_instances:
+            BackendCls = get_backend_cls(backend)
+            name = BackendCls.get_name()
+            # a backend referenced both by name and by path is still shared
+            if name not in self._backend_instances:
+                self._backend_instances[name] = BackendCls()
+            self._backend_instances[backend] = self._backend_instances[name]
+        return self._backend_instances[backend]
+
     @property
     def _all_backends(self):
         uniq_backends = {}
-        for slot in self.slots.values():
+        for slot in list(self.slots.values()) + list(self.pools.values()):
             for backend_id, backend in slot._backends.items():
                 uniq_backends[backend.get_name()] = backend
         return uniq_backends
 
     def inspect(self):
+        """State of the slots, pools and backends, with the stats of the last
+        hour, see StatsRecorder.query"""
+        for pool in self.pools.values():
+            pool.reload()  # passes may only have loaded the late tasks
+        inspected = self._inspect_state()
+        inspected['stats'] = self.stats.query()
+        return inspected
+
+    def _inspect_state(self):
         # TODO: more generic plainify
         return {
             'slots': {slot_id: slot.to_plain()
                       for slot_id, slot in self.slots.items()},
+            'pools': {pool_id: pool.to_plain()
+                      for pool_id, pool in self.pools.items()},
             'backends': {backend_id: backend.inspect()
                          for backend_id, backend in self._all_backends.items()}
         }
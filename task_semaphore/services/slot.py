@@ -1,8 +1,9 @@
 import logging
 from datetime import UTC, datetime, timedelta
 
-from ..exceptions import TaskTimeoutError, WrongTaskIdError
-from ..registry import REGISTRY
+from ..exceptions import ConflictError, TaskTimeoutError, WrongTaskIdError
+from ..registry import get_backend_cls
+from ..utils.lock import AbstractLock
 from ..utils.plainattrs import PlainAttrs
 from .prio_backend import AbstractPrioBackend
 
@@ -10,22 +11,70 @@ logger = logging.getLogger(__name__)
 DEFAULT_SLOT_TIMEOUT = 60 * 8  # EIGHT HOURS
 
 
+def call_backend_method(backend, method, task_id):
+    """Call `method` of `backend` for `task_id`, calling the backend's
+    `backend_error_callback` if it raises.
+
+    Return the method's result and whether the task must be freed, see
+    `AbstractSlot.backend_method_wrapper`."""
+    try:
+        return getattr(backend, method)(task_id), False
+
+    except Exception as error:
+        return None, handle_backend_error(backend, method, task_id, error)
+
+
+def handle_backend_error(backend, method, task_id, error):
+    """Call the backend's `backend_error_callback` for `error`, raised by (or
+    on behalf of) its `method` called for `task_id`. Return whether the task
+    must be freed."""
+    free_slot = False
+    try:
+        logger.warn('something bad happend while calling %r: %r(%s), '
+                    'calling error callback: %r', backend,
+                    method, task_id, error)
+        free_slot = backend.backend_error_callback(task_id, error, method)
+    except Exception:
+        logger.exception('an error occured while calling '
+                         'on error handler, ignoring, freeing slot:')
+        free_slot = True
+    if free_slot or method == 'start_callback':
+        logger.warn('backend_error_callback returned True, '
+                    'freeing slot')
+        return True
+    return False
+
+
 class AbstractSlot(PlainAttrs):
     KEYS_TO_SERIALIZE = ('_current_task_id',
                          '_backends_names', '_current_backend_name',
-                         '_started_at', '_last_keepalive_at')
+                         '_started_at', '_last_keepalive_at', '_version')
+    # come from the configuration, only serialized to be inspected
+    CONFIG_KEYS = ('_backends_names', )
 
     def __init__(self, id_, scheduler, backends=None,
-                 timeout_after=DEFAULT_SLOT_TIMEOUT):
+                 timeout_after=DEFAULT_SLOT_TIMEOUT, keepalive_resolution=0):
+        """`timeout_after` is in minutes. Keepalives received less than
+        `keepalive_resolution` seconds after the last one this process
+        persisted will be acknowledged without being written."""
         self.id_ = id_
         self.scheduler = scheduler
         self.timeout_after = timedelta(minutes=timeout_after)
+        self.keepalive_resolution = timedelta(seconds=keepalive_resolution)
 
         # internal value init
         self._current_task_id = None
         self._current_backend_name = None
         self._started_at = None
         self._last_keepalive_at = None
+        # bumped on each write with LOCK_OPTIMISTIC, see save
+        self._version = 0
+        # whether the deadline is to be written with the next save, see
+        # _set_deadline
+        self._deadline_changed = False
+        # task id => slot id, None once freed, to be written to the storage's
+        # task index with the next save, see _pop_indexes
+        self._index_changes = {}
 
         # we have to keep the order of backends since it matters for polling
         self._backends_names = []
@@ -41,13 +90,14 @@ class AbstractSlot(PlainAttrs):
 
     def add_backend(self, backend):
         """Add a single backend. backend can be either the name of a registered
-        backend or directly an instance of backend.
+        backend, a "package.module:ClassName" path or directly an instance of
+        backend.
+
+        Slots added through the scheduler get the scheduler's instances, see
+        `Scheduler.get_backend`.
         """
         if isinstance(backend, str):
-            assert backend in REGISTRY, \
-                    "TaskSemaphore: %r is not a registered backend!" % backend
-            BackendCls = REGISTRY[backend]
-            backend = BackendCls()
+            backend = get_backend_cls(backend)()
         assert isinstance(backend, AbstractPrioBackend), "TaskSemaphore: " \
                 "%r is no AbstractBackend subclass instance" % backend
         backend_name = backend.get_name()
@@ -99,40 +149,67 @@ class AbstractSlot(PlainAttrs):
         If the error handling callback also raises something, it'll be ignored.
         See `AbstractBackend.backend_error_callback`.
         """
-        try:
-            return getattr(self.current_backend, method)(self.current_task_id)
-
-        except Exception as error:
-            free_slot = False
-            try:
-                logger.warn('something bad happend while calling %r: %r(%s), '
-                            'calling error callback: %r', self.current_backend,
-                            method, self.current_task_id, error)
-                free_slot = self.current_backend.backend_error_callback(
-                        self.current_task_id, error, method)
-            except Exception:
-                logger.exception('an error occured while calling '
-                                 'on error handler, ignoring, freeing slot:')
-                free_slot = True
-            if free_slot or method == 'start_callback':
-                logger.warn('backend_error_callback returned True, '
-                            'freeing slot')
-                self._free_slot()
+        result, free_slot = self.scheduler.call_backend(
+                self.current_backend, method, self.current_task_id)
+        if free_slot:
+            self._free_slot()
+        return result
+
+    @property
+    def current_timeout(self):
+        """`timeout_after`, possibly shortened for the running task by the
+        scheduler's `timeout_policy`"""
+        return self.scheduler.timeout_for(self._current_backend_name,
+                                          self.timeout_after)
+
+    @property
+    def deadline(self):
+        """Moment after which the running task will be considered dead"""
+        if not self._last_keepalive_at:
+            return
+        return self._last_keepalive_at + self.current_timeout
+
+    @property
+    def is_late(self):
+        return bool(self.current_task_id) \
+                and self.deadline < datetime.now(UTC).replace(tzinfo=None)
 
     def timeout_if_late(self, unique_task_id):
-        """ Based on configured self.timeout_after will decide whether or not
-        the task is dead.
+        """ Based on configured self.timeout_after (see current_timeout) will
+        decide whether or not the task is dead.
         If so, will notify current backend current task is timeouted and will
         mark itself as idle in the database"""
         if self.current_task_id != unique_task_id:
             raise WrongTaskIdError(self, unique_task_id)
-        deadline = self._last_keepalive_at + self.timeout_after
-        if deadline < datetime.now(UTC).replace(tzinfo=None):
+        if self.is_late:
             logger.warn('Deadline was %s (last keep alive on %s) for %s. '
-                        'Timeouting', deadline, self._last_keepalive_at, self)
+                        'Timeouting', self.deadline, self._last_keepalive_at,
+                        self)
+            self.scheduler.stats.record_timeout(self._current_backend_name)
             self.backend_method_wrapper('timeout_callback')
             raise TaskTimeoutError(self)
 
+    def timeout(self, unique_task_id):
+        """Free the slot of its late task, then call the backend's
+        `timeout_callback` and `stop_callback`.
+
+        Like `start`, `stop` and `keepalive`, the slot is saved before the
+        callbacks are called, so with LOCK_OPTIMISTIC only the process that
+        actually changed the slot calls them.
+
+        The task only counts as timeouted in the stats, not as stopped, so
+        its duration doesn't skew those of the tasks that ended."""
+        if self.current_task_id != unique_task_id:
+            raise WrongTaskIdError(self, unique_task_id)
+        logger.warn('Deadline was %s (last keep alive on %s) for %s. '
+                    'Timeouting', self.deadline, self._last_keepalive_at,
+                    self)
+        backend = self.current_backend
+        self._free_slot()
+        self.scheduler.stats.record_timeout(backend.get_name())
+        for method in 'timeout_callback', 'stop_callback':
+            self.scheduler.call_backend(backend, method, unique_task_id)
+
     def keepalive(self, unique_task_id):
         """ Supposing the running task is the task with the unique_task_id
         will refresh its timeout time
@@ -141,8 +218,45 @@ class AbstractSlot(PlainAttrs):
             raise WrongTaskIdError(self, unique_task_id)
         logger.debug('bumping keepalive %r(%s)', self, unique_task_id)
         self._last_keepalive_at = datetime.now(UTC).replace(tzinfo=None)
+        self._set_deadline()
+        self.save(fields=('_last_keepalive_at',))
+        self._keepalive_persisted()
         self.backend_method_wrapper('keepalive_callback')
-        self.save()
+
+    def _set_deadline(self):
+        """Have the next save index the slot's deadline and, with the
+        scheduler's `leases`, hold a lease on the slot expiring at that
+        deadline, both cleared once the slot is free. See
+        AbstractStorage.save_many."""
+        self._deadline_changed = True
+
+    def _pop_deadline(self):
+        """The `deadlines` argument of AbstractStorage.save_many for this
+        slot, None if its deadline didn't change since last saved"""
+        if not self._deadline_changed:
+            return None
+        self._deadline_changed = False
+        return {self: self.deadline}
+
+    def _pop_indexes(self):
+        """The `indexes` argument of AbstractStorage.save_many for this slot,
+        None if it didn't start nor free any task since last saved"""
+        if not self._index_changes:
+            return None
+        changes, self._index_changes = self._index_changes, {}
+        return {(self.scheduler, task_id): slot_id
+                for task_id, slot_id in changes.items()}
+
+    def _keepalive_persisted(self):
+        """Let the scheduler know when the running task was last kept alive
+        so it can coalesce the keepalives, see `keepalive_resolution`.
+
+        Entries are kept in the order they were persisted in, so the
+        scheduler can forget the old ones first."""
+        if self.keepalive_resolution:
+            self.scheduler._keepalives.pop(self.current_task_id, None)
+            self.scheduler._keepalives[self.current_task_id] = \
+                    (self, self._last_keepalive_at)
 
     def start(self, unique_task_id, backend):
         """Will start the task with `unique_task_id`, meaning, will make so
@@ -157,16 +271,35 @@ class AbstractSlot(PlainAttrs):
         self._current_backend_name = backend.get_name()
         self._started_at = datetime.now(UTC).replace(tzinfo=None)
         self._last_keepalive_at = datetime.now(UTC).replace(tzinfo=None)
+        self._set_deadline()
+        self._index_changes[unique_task_id] = self.id_
+        self.save()
         logger.warn('starting %r(%s)', self, unique_task_id)
+        self.scheduler.stats.record_start(backend, unique_task_id,
+                                          self._started_at)
+        self._keepalive_persisted()
         self.backend_method_wrapper('start_callback')
-        self.save()
 
     def _free_slot(self):
+        task_id = self._current_task_id
         self._current_task_id = None
         self._current_backend_name = None
         self._started_at = None
         self._last_keepalive_at = None
+        if task_id is not None:
+            self._set_deadline()
+            self._index_changes[task_id] = None
         self.save()
+        if task_id is not None:
+            self.scheduler._keepalives.pop(task_id, None)
+
+    def release(self, unique_task_id):
+        """Free the slot without calling any callback, eg when a dispatched
+        callback asked for it, see CallbackDispatcher"""
+        if self.current_task_id != unique_task_id:
+            raise WrongTaskIdError(self, unique_task_id)
+        logger.warn('releasing %r(%s)', self, unique_task_id)
+        self._free_slot()
 
     def stop(self, unique_task_id):
         """Will stop the task with `unique_task_id`, meaning, will make so
@@ -180,8 +313,10 @@ class AbstractSlot(PlainAttrs):
         if self.current_task_id != unique_task_id:
             raise WrongTaskIdError(self, unique_task_id)
         logger.warn('stopping %r(%s)', self, unique_task_id)
-        self.backend_method_wrapper('stop_callback')
+        backend, started_at = self.current_backend, self._started_at
         self._free_slot()
+        self.scheduler.stats.record_stop(backend.get_name(), started_at)
+        self.scheduler.call_backend(backend, 'stop_callback', unique_task_id)
 
     @property
     def storage(self):
@@ -191,8 +326,49 @@ class AbstractSlot(PlainAttrs):
     def _storage_key(self):
         return self.scheduler._storage_key + ("slot", str(self.id_))
 
-    def save(self):
-        self.storage.save(self)
+    def lock_on(self):
+        """Lock on this slot only, see LOCK_SLOT. A lock that always succeeds
+        with LOCK_OPTIMISTIC."""
+        if self.scheduler.is_optimistic:
+            return AbstractLock()
+        return self.storage.lock_on(self)
+
+    def save(self, fields=None):
+        """Save the slot, only `fields` if specified and if the storage
+        supports it.
+
+        With LOCK_OPTIMISTIC, the slot is only written if it hasn't changed
+        in the storage since it was loaded, else it's reloaded and
+        ConflictError is raised.
+
+        A changed deadline is written along, see _set_deadline, as are the
+        tasks started or freed, see _pop_indexes."""
+        pending = self.scheduler._pending
+        if pending is not None and pending.saves is not None:
+            pending.save(self, fields)
+        elif self.scheduler.is_optimistic:
+            self._version += 1
+            if not self.storage.compare_and_set(self, self._version - 1):
+                logger.info('%r changed meanwhile, reloading', self)
+                self._deadline_changed = False
+                self._index_changes = {}
+                self.reload()
+                raise ConflictError(self)
+            if self._deadline_changed or self._index_changes:
+                self.storage.save_many([], deadlines=self._pop_deadline(),
+                                       indexes=self._pop_indexes())
+        elif self._deadline_changed or self._index_changes:
+            self.storage.save_many([self], fields={self: fields},
+                                   deadlines=self._pop_deadline(),
+                                   indexes=self._pop_indexes())
+        elif fields:
+            self.storage.save_fields(self, fields)
+        else:
+            self.storage.save(self)
+
+    def from_plain(self, attrs_dict):
+        super().from_plain({key: val for key, val in attrs_dict.items()
+                            if key not in self.CONFIG_KEYS})
 
     def reload(self):
         self.storage.reload(self)
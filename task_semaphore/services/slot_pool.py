@@ -0,0 +1,181 @@
+import logging
+from datetime import UTC, datetime, timedelta
+
+from ..exceptions import WrongTaskIdError
+from ..utils.lock import AbstractLock
+from ..utils.plainattrs import PlainAttrs
+from .slot import DEFAULT_SLOT_TIMEOUT, AbstractSlot
+
+logger = logging.getLogger(__name__)
+
+
+class SlotPool(PlainAttrs):
+    """`size` identical slots handled as one counting semaphore.
+
+    Instead of a slot object and a storage entry per unit of concurrency,
+    the pool only stores the mapping of its running tasks (task id to
+    backend name, start and last keepalive), and takes or releases capacity
+    atomically in the storage. Reviewing a pool costs as much as it has
+    tasks running, not as much as its size, and only as much as it has
+    late tasks if the storage indexes their deadlines, see reload_late."""
+    KEYS_TO_SERIALIZE = ('size', '_backends_names', '_tasks')
+
+    def __init__(self, id_, scheduler, size, backends=None,
+                 timeout_after=DEFAULT_SLOT_TIMEOUT):
+        self.id_ = id_
+        self.scheduler = scheduler
+        self.size = size
+        self.timeout_after = timedelta(minutes=timeout_after)
+        # task id => (backend name, started at, last keepalive at)
+        self._tasks = {}
+        # tasks running but not loaded in `_tasks`, see reload_late
+        self._unloaded = 0
+        self._backends_names = []
+        self._backends = {}
+        for backend in backends or []:
+            self.add_backend(backend)
+
+    add_backend = AbstractSlot.add_backend
+
+    def __repr__(self):
+        return "<%s id=%r size=%r>" % (self.__class__.__name__,
+                                       self.id_, self.size)
+
+    @property
+    def ref(self):
+        """How the pool is referenced in the storage's task index"""
+        return 'pool:%s' % self.id_
+
+    @property
+    def free_capacity(self):
+        return max(self.size - len(self._tasks) - self._unloaded, 0)
+
+    @property
+    def task_ids(self):
+        return list(self._tasks)
+
+    def deadline_of(self, record):
+        """Moment after which the task of `record` will be considered dead
+        """
+        backend_name, _, last_keepalive_at = record
+        return last_keepalive_at + self.scheduler.timeout_for(
+                backend_name, self.timeout_after)
+
+    def late_task_ids(self):
+        now = datetime.now(UTC).replace(tzinfo=None)
+        return [task_id for task_id, record in self._tasks.items()
+                if self.deadline_of(record) < now]
+
+    def _call(self, task_id, method):
+        """Call `method` on the backend running `task_id`, releasing the task
+        if the backend asks for it, see AbstractSlot.backend_method_wrapper
+        """
+        backend = self._backends[self._tasks[task_id][0]]
+        result, release = self.scheduler.call_backend(backend, method,
+                                                      task_id)
+        if release:
+            self._release(task_id)
+        return result
+
+    def start(self, unique_task_id, backend):
+        """Take a unit of capacity for `unique_task_id` and call the backend's
+        `start_callback`. Return False if the pool turned out to be full."""
+        now = datetime.now(UTC).replace(tzinfo=None)
+        record = (backend.get_name(), now, now)
+        if not self.storage.acquire_in_pool(self, unique_task_id, record):
+            logger.info('%r is full, not starting %s', self, unique_task_id)
+            return False
+        self._tasks[unique_task_id] = record
+        self._index(unique_task_id, self.ref)
+        logger.warn('starting %r(%s)', self, unique_task_id)
+        self.scheduler.stats.record_start(backend, unique_task_id, now)
+        self._call(unique_task_id, 'start_callback')
+        return True
+
+    def keepalive(self, unique_task_id):
+        if unique_task_id not in self._tasks:
+            raise WrongTaskIdError(self, unique_task_id)
+        backend_name, started_at, _ = self._tasks[unique_task_id]
+        record = (backend_name, started_at,
+                  datetime.now(UTC).replace(tzinfo=None))
+        if not self.storage.update_in_pool(self, unique_task_id, record):
+            del self._tasks[unique_task_id]
+            raise WrongTaskIdError(self, unique_task_id)
+        self._tasks[unique_task_id] = record
+        self._call(unique_task_id, 'keepalive_callback')
+
+    def stop(self, unique_task_id):
+        if unique_task_id not in self._tasks:
+            raise WrongTaskIdError(self, unique_task_id)
+        logger.warn('stopping %r(%s)', self, unique_task_id)
+        backend_name, started_at, _ = self._tasks[unique_task_id]
+        self.scheduler.stats.record_stop(backend_name, started_at)
+        self._call(unique_task_id, 'stop_callback')
+        self._release(unique_task_id)
+
+    def timeout(self, unique_task_id):
+        """Call the backend's `timeout_callback` and `stop_callback`, then
+        release the task. Only counted as timeouted in the stats, its
+        duration not being one."""
+        logger.warn('%r(%s) is late, timeouting', self, unique_task_id)
+        self.scheduler.stats.record_timeout(self._tasks[unique_task_id][0])
+        for method in 'timeout_callback', 'stop_callback':
+            if unique_task_id in self._tasks:
+                self._call(unique_task_id, method)
+        self._release(unique_task_id)
+
+    def release(self, unique_task_id):
+        """Release `unique_task_id` without calling any callback, see
+        AbstractSlot.release"""
+        if unique_task_id not in self._tasks:
+            raise WrongTaskIdError(self, unique_task_id)
+        logger.warn('releasing %r(%s)', self, unique_task_id)
+        self._release(unique_task_id)
+
+    def _release(self, task_id):
+        if self._tasks.pop(task_id, None) is None:
+            return
+        self.storage.release_from_pool(self, task_id)
+        self._index(task_id, None)
+
+    def _index(self, task_id, ref):
+        """Index `task_id` as running on `ref`, None once freed, along with
+        the other writes of the pass or signal if any, see PendingWrites"""
+        indexes = {(self.scheduler, task_id): ref}
+        pending = self.scheduler._pending
+        if pending is not None:
+            pending.indexes.update(indexes)
+        else:
+            self.storage.save_many([], indexes=indexes)
+
+    @property
+    def storage(self):
+        return self.scheduler.storage
+
+    @property
+    def _storage_key(self):
+        return self.scheduler._storage_key + ("pool", str(self.id_))
+
+    def lock_on(self):
+        """No lock with LOCK_OPTIMISTIC, pools only changing through the
+        storage's atomic acquire_in_pool and release_from_pool"""
+        if self.scheduler.is_optimistic:
+            return AbstractLock()
+        return self.storage.lock_on(self)
+
+    def reload(self):
+        tasks = self.storage.load_pool(self)
+        if tasks is not None:
+            self._tasks, self._unloaded = tasks, 0
+
+    def reload_late(self, look_ahead=timedelta(0)):
+        """Only load the tasks that may be late, those whose deadline is
+        less than `look_ahead` away included (see
+        Scheduler._max_shortening), and count the others. Same as reload if
+        the storage doesn't index the pools' deadlines."""
+        now = datetime.now(UTC).replace(tzinfo=None)
+        loaded = self.storage.load_pool_late(self, now + look_ahead)
+        if loaded is None:
+            return self.reload()
+        count, self._tasks = loaded
+        self._unloaded = max(count - len(self._tasks), 0)
@@ -0,0 +1,6 @@
+from .adaptive_timeout import AdaptiveTimeoutPolicy
+from .histogram import DURATION_BUCKETS, bucket_of, percentile
+from .recorder import DEFAULT_STATS_WINDOW, StatsRecorder
+
+__all__ = ['AdaptiveTimeoutPolicy', 'DURATION_BUCKETS',
+           'DEFAULT_STATS_WINDOW', 'StatsRecorder', 'bucket_of', 'percentile']
@@ -0,0 +1,66 @@
+import logging
+from datetime import UTC, datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveTimeoutPolicy:
+    """Derives the timeout of each backend's tasks from their observed
+    durations: `factor` times the 99th percentile of the durations recorded
+    by the scheduler's stats over the last `since` seconds, at least `floor`
+    minutes, and never more than the slot's own `timeout_after`.
+
+    Backends with less than `min_samples` durations recorded keep the
+    slot's timeout. The percentiles are fetched at most every `refresh`
+    seconds, by the scheduler at the start of its passes, so computing a
+    deadline never hits the storage.
+
+    Deadlines being counted from the last keepalive, tasks sending
+    keepalives are given at least as long between two of them."""
+
+    def __init__(self, factor=3, floor=5, since=60 * 60 * 24,
+                 min_samples=20, refresh=60):
+        self.factor = factor
+        self.floor = timedelta(minutes=floor)
+        self.since = since
+        self.min_samples = min_samples
+        self.refresh = timedelta(seconds=refresh)
+        self._refreshed_at = None
+        # backend name => adaptive timeout
+        self._timeouts = {}
+
+    def _is_due(self):
+        now = datetime.now(UTC).replace(tzinfo=None)
+        return self._refreshed_at is None \
+            or now - self._refreshed_at >= self.refresh
+
+    def refresh_if_needed(self, scheduler):
+        if self._is_due():
+            self.update(scheduler.stats.query(since=self.since))
+
+    async def refresh_if_needed_async(self, scheduler):
+        if self._is_due():
+            self.update(await scheduler.stats.query_async(since=self.since))
+
+    def update(self, stats):
+        """Compute the timeouts from a `StatsRecorder.query` summary"""
+        self._refreshed_at = datetime.now(UTC).replace(tzinfo=None)
+        timeouts = {}
+        for backend_name, backend_stats in stats.items():
+            duration = backend_stats['duration']
+            if duration['count'] < self.min_samples \
+                    or duration.get('p99') in (None, float('inf')):
+                continue
+            timeouts[backend_name] = max(
+                    self.floor,
+                    timedelta(seconds=self.factor * duration['p99']))
+        if timeouts != self._timeouts:
+            logger.info('adaptive timeouts are now %r', timeouts)
+        self._timeouts = timeouts
+
+    def timeout_for(self, backend_name, timeout_after):
+        """Timeout of a task of `backend_name` on a slot configured with
+        `timeout_after`"""
+        if backend_name not in self._timeouts:
+            return timeout_after
+        return min(self._timeouts[backend_name], timeout_after)
@@ -0,0 +1,28 @@
+from bisect import bisect_left
+
+# upper bounds, in seconds, of the fixed buckets durations are counted in,
+# one more bucket counts the durations above the last bound
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600,
+                    7200, 14400, 28800, 86400)
+
+
+def bucket_of(seconds):
+    """Index of the bucket counting a duration of `seconds`"""
+    return bisect_left(DURATION_BUCKETS, seconds)
+
+
+def percentile(counts, percent):
+    """Return the upper bound of the bucket under which `percent` percents
+    of the durations counted in `counts` (bucket index => count) fall, inf
+    if that's the last bucket and None if nothing was counted."""
+    total = sum(counts.values())
+    if not total:
+        return None
+    threshold, seen = total * percent / 100, 0
+    for index in sorted(counts):
+        seen += counts[index]
+        if seen >= threshold:
+            break
+    if index < len(DURATION_BUCKETS):
+        return DURATION_BUCKETS[index]
+    return float('inf')
@@ -0,0 +1,142 @@
+import logging
+import threading
+from datetime import UTC, datetime, timedelta
+
+from .histogram import bucket_of, percentile
+
+logger = logging.getLogger(__name__)
+DEFAULT_STATS_WINDOW = 60  # seconds
+DEFAULT_STATS_RETENTION = 60 * 60 * 24 * 7  # a week, in seconds
+PERCENTILES = (50, 95, 99)
+EVENTS = ('started', 'stopped', 'timeouted', 'duplicates')
+HISTOGRAMS = ('duration', 'wait')
+
+
+class StatsRecorder:
+    """Counts, per backend, the tasks started, stopped and timeouted and
+    their durations and wait times in histograms (see DURATION_BUCKETS).
+
+    Counts are kept per time window of `window` seconds. Recording only
+    touches memory, the scheduler writes what's been recorded to the storage
+    at the end of each pass or signal, see `flush`. Windows older than
+    `retention` seconds may be dropped by the storage.
+
+    Setting `window` to 0 disables the recording."""
+
+    def __init__(self, scheduler, window=DEFAULT_STATS_WINDOW,
+                 retention=DEFAULT_STATS_RETENTION):
+        self.scheduler = scheduler
+        self.window = window
+        self.retention = retention
+        # window start (epoch) => field => count
+        self._pending = {}
+        # passes, reaping and signals may record from several threads
+        self._lock = threading.Lock()
+
+    def _window_of(self, moment):
+        epoch = int(moment.replace(tzinfo=UTC).timestamp())
+        return epoch - epoch % self.window
+
+    def _incr(self, backend_name, *field, count=1):
+        if not self.window:
+            return
+        window = self._window_of(datetime.now(UTC))
+        field = '|'.join((backend_name,) + tuple(map(str, field)))
+        with self._lock:
+            counters = self._pending.setdefault(window, {})
+            counters[field] = counters.get(field, 0) + count
+
+    def record_start(self, backend, task_id, started_at):
+        """Count a start and, if the backend knows when the task has been
+        enqueued, how long it waited, see AbstractPrioBackend.enqueued_at"""
+        if not self.window:
+            return
+        self._incr(backend.get_name(), 'started')
+        try:
+            enqueued_at = backend.enqueued_at(task_id)
+        except Exception:
+            logger.exception('%r.enqueued_at(%s) failed, ignoring:',
+                             backend, task_id)
+            return
+        if enqueued_at is not None:
+            self._incr(backend.get_name(), 'wait', bucket_of(
+                    (started_at - enqueued_at).total_seconds()))
+
+    def record_stop(self, backend_name, started_at):
+        """Count a stop and how long the task held its slot"""
+        self._incr(backend_name, 'stopped')
+        if started_at is not None:
+            now = datetime.now(UTC).replace(tzinfo=None)
+            self._incr(backend_name, 'duration',
+                       bucket_of((now - started_at).total_seconds()))
+
+    def record_timeout(self, backend_name):
+        self._incr(backend_name, 'timeouted')
+
+    def record_duplicates(self, backend_name, count):
+        """Count polled tasks that were already running"""
+        self._incr(backend_name, 'duplicates', count=count)
+
+    def pop_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def flush(self):
+        """Write what's been recorded since the last flush, in a single call
+        to the storage"""
+        pending = self.pop_pending()
+        if pending:
+            self.scheduler.storage.incr_stats(self.scheduler, pending,
+                                              self.retention)
+
+    def windows(self, since=3600, until=None):
+        """Start of the windows between `since` seconds before `until`
+        (defaults to now) and `until`"""
+        until = until or datetime.now(UTC).replace(tzinfo=None)
+        first = self._window_of(until - timedelta(seconds=since))
+        return list(range(first, self._window_of(until) + 1, self.window))
+
+    def query(self, since=3600, until=None, percentiles=PERCENTILES):
+        """Summary of the stats between `since` seconds before `until` and
+        `until`, see `summarize`"""
+        if not self.window:
+            return {}
+        return self.summarize(self.scheduler.storage.load_stats(
+                self.scheduler, self.windows(since, until)), percentiles)
+
+    async def query_async(self, since=3600, until=None,
+                          percentiles=PERCENTILES):
+        """Same as `query` for an AbstractAsyncStorage"""
+        if not self.window:
+            return {}
+        return self.summarize(await self.scheduler.storage.load_stats(
+                self.scheduler, self.windows(since, until)), percentiles)
+
+    @staticmethod
+    def summarize(windows_counters, percentiles=PERCENTILES):
+        """Return per backend name the count of each event and, for the
+        durations and wait times (in seconds), the count and percentiles
+        (as 'p50', 'p95', et c), merging the counters of several windows.
+
+        Percentiles are the upper bound of the bucket they fall in."""
+        merged = {}
+        for counters in windows_counters:
+            for field, count in counters.items():
+                backend_name, kind, *bucket = field.split('|')
+                backend = merged.setdefault(backend_name, dict.fromkeys(
+                        EVENTS, 0))
+                if bucket:
+                    histogram = backend.setdefault(kind, {})
+                    histogram[int(bucket[0])] = \
+                        histogram.get(int(bucket[0]), 0) + count
+                else:
+                    backend[kind] = backend.get(kind, 0) + count
+        for backend in merged.values():
+            for kind in HISTOGRAMS:
+                histogram = backend.pop(kind, {})
+                backend[kind] = {'count': sum(histogram.values())}
+                for percent in percentiles:
+                    backend[kind]['p%d' % percent] = percentile(histogram,
+                                                                percent)
+        return merged
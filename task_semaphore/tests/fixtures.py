@@ -1,4 +1,10 @@
-from .. import AbstractPrioBackend
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+
+from .. import AbstractPrioBackend, AsyncPrioBackend
+from ..utils.async_storage import AbstractAsyncStorage
+from ..utils.lock import DEFAULT_LOCK_TTL, AbstractLock
 from ..utils.storage import AbstractStorage
 
 
@@ -10,6 +16,144 @@ class MockStorage(AbstractStorage):
         pass
 
 
+class AsyncMockStorage(AbstractAsyncStorage):
+    async def save(self, model):
+        pass
+
+    async def reload(self, model):
+        pass
+
+
+class CountingStorage(MockStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = {}
+
+    def _count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def save(self, model):
+        self._count('save')
+
+    def reload(self, model):
+        self._count('reload')
+
+    def save_many(self, models, fields=None, deadlines=None, indexes=None):
+        self._count('save_many')
+
+    def reload_many(self, models):
+        self._count('reload_many')
+
+
+class DictLock(AbstractLock):
+    """In memory lock, `store` being shared between competing locks, each
+    renewal being counted by key in `renewals` if given"""
+
+    def __init__(self, store, *args, key='lock', renewals=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.store = store
+        self.key = key
+        self.renewals = renewals
+
+    def is_locked(self):
+        return self.key in self.store
+
+    def lock(self, token):
+        return self.store.setdefault(self.key, token) == token
+
+    def unlock(self, token):
+        if self.store.get(self.key) == token:
+            del self.store[self.key]
+
+    def extend(self, token):
+        if self.renewals is not None:
+            self.renewals[self.key] = self.renewals.get(self.key, 0) + 1
+        return self.store.get(self.key) == token
+
+
+class LockingStorage(MockStorage):
+    """Storage with working locks, they're all kept in `locks`, leased for
+    `lock_ttl` seconds and their renewals counted in `renewals`"""
+    lock_ttl = DEFAULT_LOCK_TTL
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.locks, self.renewals = {}, {}
+
+    def lock_on(self, model):
+        return DictLock(self.locks, key=model._storage_key, ttl=self.lock_ttl,
+                        renewals=self.renewals)
+
+
+class MemoryStorage(LockingStorage):
+    """Storage actually keeping the models' state, in `data`"""
+    indexes_tasks = True
+    indexes_deadlines = True
+    supports_compare_and_set = True
+    supports_leases = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data = {}
+
+    def save(self, model):
+        self.data[model._storage_key] = dict(model.to_plain())
+
+    def reload(self, model):
+        model.from_plain(self.data.get(model._storage_key, {}))
+
+    def compare_and_set(self, model, version):
+        if self.data.get(model._storage_key, {}).get('_version', 0) \
+                != version:
+            return False
+        self.save(model)
+        return True
+
+    def _index(self, model):
+        return self.data.setdefault(model._storage_key + ('tasks',), {})
+
+    def index_task(self, model, task_id, slot_id):
+        self._index(model)[task_id] = str(slot_id)
+
+    def unindex_task(self, model, task_id):
+        self._index(model).pop(task_id, None)
+
+    def find_task(self, model, task_id):
+        return self._index(model).get(task_id)
+
+    def _deadlines(self, model):
+        return self.data.setdefault(model._storage_key + ('deadlines',), {})
+
+    def set_deadline(self, model, slot_id, deadline):
+        self._deadlines(model)[str(slot_id)] = deadline
+
+    def clear_deadline(self, model, slot_id):
+        self._deadlines(model).pop(str(slot_id), None)
+
+    def expired_slots(self, model, now):
+        return [slot_id for slot_id, deadline
+                in self._deadlines(model).items() if deadline < now]
+
+    def _leases(self, model):
+        return self.data.setdefault(model._storage_key + ('leases',), {})
+
+    def set_lease(self, model, slot_id, ttl):
+        self._leases(model)[str(slot_id)] = \
+                datetime.now(UTC).replace(tzinfo=None) + ttl
+
+    def clear_lease(self, model, slot_id):
+        self._leases(model).pop(str(slot_id), None)
+
+    def expired_leases(self, model, timeout):
+        now, leases = datetime.now(UTC).replace(tzinfo=None), \
+                self._leases(model)
+        expired = [slot_id for slot_id, expires_at in leases.items()
+                   if expires_at <= now]
+        for slot_id in expired:
+            del leases[slot_id]
+        return expired
+
+
 class ExampleBackend(AbstractPrioBackend):
     def __init__(self):
         self.polled, self.started, self.stopped = 0, 0, 0
@@ -44,6 +188,123 @@ class ExampleScheduleBackend(ExampleBackend):
         return 'SELECTED_TASK_ID_%d' % self.polled
 
 
+class ExampleBatchBackend(ExampleScheduleBackend):
+    """Has only 3 tasks to give"""
+    def __init__(self):
+        super().__init__()
+        self.polled_many = 0
+
+    def poll(self):
+        self.polled += 1
+        return 'BATCH_TASK_ID_%d' % self.polled
+
+    def poll_many(self, count):
+        self.polled_many += 1
+        return [self.poll() for _ in range(min(count, 3 - self.polled))]
+
+
+class ExampleIdempotentBackend(ExampleBackend):
+    """Returns the same task until it has been started"""
+    queue = []  # shared between instances, as a database would be
+
+    def poll(self):
+        self.polled += 1
+        return self.queue[0] if self.queue else None
+
+    def start_callback(self, unique_task_id):
+        super().start_callback(unique_task_id)
+        self.queue.remove(unique_task_id)
+
+
+class ExampleLaggingBackend(ExampleBackend):
+    """Keeps giving the same task, as if marking it as taken lagged"""
+    def poll(self):
+        self.polled += 1
+        return 'LAGGING_TASK'
+
+
+class ExampleClaimingBackend(ExampleBackend):
+    """Polling claims tasks from its `queue`, they have to be released to be
+    polled again"""
+    def __init__(self):
+        super().__init__()
+        self.queue = ['%s_%d' % (self.get_name(), i) for i in range(3)]
+
+    def poll_many(self, count):
+        self.polled += 1
+        task_ids, self.queue = self.queue[:count], self.queue[count:]
+        return task_ids
+
+    def release_many(self, task_ids):
+        self.queue = task_ids + self.queue
+
+
+class ExampleOtherClaimingBackend(ExampleClaimingBackend):
+    pass
+
+
+class ExamplePrefetchedBackend(ExampleClaimingBackend):
+    prefetch_depth = 2
+    prefetch_ttl = 0.2
+
+
+class ExampleMeetingBackend(ExampleScheduleBackend):
+    """The first poll of each meeting backend waits for those of the others,
+    raising BrokenBarrierError unless they're all polled at once. `meeting`
+    is the threading.Barrier they share, set by the tests."""
+    meeting = None
+
+    def poll(self):
+        if not self.polled:
+            self.meeting.wait(timeout=5)
+        return 'MEETING_' + super().poll()
+
+
+class ExampleMeetingEmptyBackend(ExampleMeetingBackend):
+    def poll(self):
+        super().poll()
+
+
+class ExampleMeetingLowBackend(ExampleMeetingBackend):
+    pass
+
+
+class ExampleBlockingBackend(ExampleBackend):
+    """Polling blocks until `unblocked` is set, `polling` being set once it
+    started"""
+    def __init__(self):
+        super().__init__()
+        self.polling, self.unblocked = threading.Event(), threading.Event()
+
+    def poll(self):
+        self.polling.set()
+        self.unblocked.wait(5)
+        return super().poll()
+
+
+class ExampleSlowBackend(ExampleScheduleBackend):
+    def poll(self):
+        time.sleep(0.1)
+        return 'SLOW_' + super().poll()
+
+
+class ExampleSlowStartBackend(ExampleScheduleBackend):
+    delay = 0.5
+
+    def start_callback(self, unique_task_id):
+        time.sleep(self.delay)
+        super().start_callback(unique_task_id)
+
+
+class ExampleEnqueuedBackend(ExampleScheduleBackend):
+    """Its tasks have been waiting for 10 seconds"""
+    def poll(self):
+        return 'ENQUEUED_' + super().poll()
+
+    def enqueued_at(self, unique_task_id):
+        return datetime.now(UTC).replace(tzinfo=None) - timedelta(seconds=10)
+
+
 class ExampleStartRaisingBackend(ExampleScheduleBackend):
     def start_callback(self, unique_task_id):
         super().start_callback(unique_task_id)
@@ -68,3 +329,25 @@ class ExampleDoubleRaisingBackend(ExampleStartRaisingBackend):
     def backend_error_callback(self, unique_task_id, error, method):
         super().backend_error_callback(unique_task_id, error, method)
         raise ZeroDivisionError()
+
+
+class ExampleAsyncBackend(AsyncPrioBackend):
+    def __init__(self):
+        self.polled, self.started, self.stopped = 0, 0, 0
+        self.timeouted, self.keptalive = 0, 0
+
+    async def poll(self):
+        self.polled += 1
+        return 'ASYNC_TASK_ID_%d' % self.polled
+
+    async def start_callback(self, unique_task_id):
+        self.started += 1
+
+    async def stop_callback(self, unique_task_id):
+        self.stopped += 1
+
+    async def timeout_callback(self, unique_task_id):
+        self.timeouted += 1
+
+    async def keepalive_callback(self, unique_task_id):
+        self.keptalive += 1
@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+
+from .. import AsyncScheduler, WrongTaskIdError
+from ..utils.lock import AbstractAsyncLock
+from .fixtures import AsyncMockStorage
+
+
+class AsyncTestCase(unittest.IsolatedAsyncioTestCase):
+    """Integration test for the asyncio scheduler"""
+
+    async def _scheduler(self, config):
+        return await AsyncScheduler(name='test', storage=AsyncMockStorage()) \
+            .init_from_config(config)
+
+    async def test_schedule_with_sync_and_async_backends(self):
+        sched = await self._scheduler(
+                [{'backends': ['ExampleScheduleEmptyBackend',
+                               'ExampleAsyncBackend'],
+                  'slot_id': 'sid_1'},
+                 {'backends': ['ExampleScheduleBackend'],
+                  'slot_id': 'sid_2'}])
+        await sched.schedule()
+        sid_1, sid_2 = sched.slots['sid_1'], sched.slots['sid_2']
+        assert sid_1._backends['ExampleScheduleEmptyBackend'].polled == 1
+        assert sid_1.current_task_id == 'ASYNC_TASK_ID_1'
+        assert sid_1.current_backend.started == 1
+        assert sid_2.current_task_id == 'SELECTED_TASK_ID_1'
+        assert sid_2.current_backend.started == 1
+
+    async def test_signals(self):
+        sched = await self._scheduler(
+                [{'backends': ['ExampleAsyncBackend'],
+                  'slot_id': 'sid_%d' % i} for i in range(3)])
+        await sched.schedule()
+        self.assertEqual([slot.current_task_id
+                          for slot in sched.slots.values()],
+                         ['ASYNC_TASK_ID_%d' % i for i in (1, 2, 3)])
+        backend = sched.slots['sid_0']._backends['ExampleAsyncBackend']
+        assert backend.polled == 3
+
+        await sched.keepalive('ASYNC_TASK_ID_1')
+        await sched.stop('ASYNC_TASK_ID_1')
+        with self.assertRaises(WrongTaskIdError):
+            await sched.stop('ASYNC_TASK_ID_1')
+        self.assertEqual(
+                await sched.stop_many(['ASYNC_TASK_ID_2', 'NOPE']),
+                {'ASYNC_TASK_ID_2': True, 'NOPE': False})
+        assert sched.slots['sid_0'].current_task_id is None
+        assert sched.slots['sid_1'].current_task_id is None
+        assert sched.slots['sid_2'].current_task_id == 'ASYNC_TASK_ID_3'
+        assert sched.slots['sid_0'].current_backend is None
+        assert backend.keptalive == 1 and backend.stopped == 2
+        stats = (await sched.inspect())['stats']['ExampleAsyncBackend']
+        assert stats['started'] == 3 and stats['stopped'] == 2
+
+    async def test_timeout(self):
+        sched = await self._scheduler(
+                [{'backends': ['ExampleAsyncBackend'],
+                  'slot_id': 'sid_1',
+                  'slot_kwargs': {'timeout_after': 1 / 120}}])
+        await sched.schedule()
+        slot = sched.slots['sid_1']
+        assert slot.current_task_id == 'ASYNC_TASK_ID_1'
+        await asyncio.sleep(1)
+        await sched.schedule()
+        assert slot.current_task_id == 'ASYNC_TASK_ID_2'
+        assert slot.current_backend.timeouted == 1
+        assert slot.current_backend.stopped == 1
+        # counted as timeouted only, its duration left out of the histogram
+        stats = (await sched.inspect())['stats']['ExampleAsyncBackend']
+        assert stats['timeouted'] == 1 and stats['stopped'] == 0
+        assert stats['duration']['count'] == 0
+
+    async def test_sync_only_methods(self):
+        sched = await self._scheduler([{'backends': ['ExampleAsyncBackend'],
+                                        'slot_id': 'sid_1'}])
+        for method in (sched.reap_timeouts, sched.sync_config,
+                       sched.run_forever, sched.reap_expired_leases):
+            self.assertRaises(NotImplementedError, method)
+        with self.assertRaises(TypeError):
+            with AbstractAsyncLock():
+                pass
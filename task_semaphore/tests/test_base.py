@@ -1,9 +1,17 @@
+import threading
 import time
 import unittest
+from unittest import mock
 
-from .. import AbstractPrioBackend, Scheduler
+from .. import (AbstractPrioBackend, CallbackDispatcher, Scheduler,
+                WrongTaskIdError)
+from ..exceptions import ConflictError
+from ..services.runner import Runner
+from ..services.scheduler import LOCK_OPTIMISTIC, LOCK_SCHEDULER, LOCK_SLOT
 from ..services.slot import AbstractSlot
-from .fixtures import (ExampleScheduleBackend, ExampleScheduleEmptyBackend,
+from .fixtures import (CountingStorage, ExampleMeetingBackend,
+                       ExampleScheduleBackend, ExampleScheduleEmptyBackend,
+                       ExampleSlowStartBackend, LockingStorage, MemoryStorage,
                        MockStorage)
 
 
@@ -87,12 +95,455 @@ class BaseTestCase(unittest.TestCase):
         assert isinstance(backends[1], ExampleScheduleEmptyBackend)
         assert slot.current_backend is backends[0]
         assert isinstance(slot.current_backend, ExampleScheduleBackend)
-        assert backends[0].polled == 1
-        assert backends[0].started == 1
-        assert backends[1].polled == 0
+        # backends are shared, sid_2 polled both of them
+        assert backends[0] is sched.slots['sid_2']._backends[
+            'ExampleScheduleBackend']
+        assert backends[0].polled == 2
+        assert backends[0].started == 2
+        assert backends[1].polled == 1
         assert backends[1].started == 0
         assert slot.current_task_id == 'SELECTED_TASK_ID_1'
 
+    def test_schedule_reloads_and_saves_in_bulk(self):
+        storage = CountingStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(5)]
+        sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        self.assertEqual(storage.calls, {'reload_many': 1})
+
+        sched.schedule()
+        self.assertEqual(storage.calls, {'reload_many': 2, 'save_many': 1})
+        assert all(slot.current_task_id for slot in sched.slots.values())
+
+    def test_slot_lock_mode(self):
+        storage = LockingStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(3)]
+        sched = Scheduler(name='test', storage=storage,
+                          lock_mode=LOCK_SLOT).init_from_config(config)
+        # someone else is working on sid_1
+        busy_lock = sched.slots['sid_1'].lock_on()
+        busy_lock.acquire()
+
+        sched.schedule()
+        assert sched.slots['sid_0'].current_task_id
+        assert sched.slots['sid_1'].current_task_id is None
+        assert sched.slots['sid_2'].current_task_id
+
+        # the scheduler wide lock isn't involved in signals
+        scheduler_lock = storage.lock_on(sched)
+        scheduler_lock.acquire()
+        task_id = sched.slots['sid_0'].current_task_id
+        sched.keepalive(task_id)
+        sched.stop(task_id)
+        assert sched.slots['sid_0'].current_task_id is None
+        busy_lock.release()
+        scheduler_lock.release()
+        self.assertEqual(storage.locks, {})
+
+    def test_optimistic_lock_mode(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(2)]
+        sched = Scheduler(name='test', storage=storage,
+                          lock_mode=LOCK_OPTIMISTIC).init_from_config(config)
+        other_sched = Scheduler(name='test', storage=storage,
+                                lock_mode=LOCK_OPTIMISTIC). \
+            init_from_config(config)
+        stale = sched.slots['sid_0']
+        backend = stale._backends['ExampleScheduleBackend']
+        other_sched.slots['sid_0'].start('OTHER_TASK', backend)
+
+        # sid_0 changed since sched loaded it, its task goes to sid_1
+        started, idle = sched._start_on('ExampleScheduleBackend',
+                                        [stale, sched.slots['sid_1']],
+                                        ['TASK', 'NEXT_TASK'], set())
+        self.assertEqual((started, idle), (['TASK'], []))
+        assert stale.current_task_id == 'OTHER_TASK'
+        self.assertEqual(sched.slots['sid_1'].current_task_id, 'TASK')
+
+        other_stale = other_sched.slots['sid_1']
+        self.assertRaises(ConflictError, other_stale.start, 'NEXT_TASK',
+                          backend)
+        assert other_stale.current_task_id == 'TASK'
+        assert backend.started == 1
+
+        sched.stop('OTHER_TASK')
+        self.assertRaises(WrongTaskIdError, other_sched.stop, 'OTHER_TASK')
+        assert backend.stopped == 1
+        with self.assertRaises(AssertionError):
+            Scheduler(name='test', storage=MockStorage(),
+                      lock_mode=LOCK_OPTIMISTIC)
+
+    def test_signals_from_another_process(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['ExampleScheduleEmptyBackend'],
+                   'slot_id': 'sid_2'}]
+        sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        other_sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        sched.schedule()
+        self.assertEqual(storage.find_task(sched, 'SELECTED_TASK_ID_1'),
+                         'sid_1')
+
+        # other_sched never ran a pass nor reloaded its slots
+        other_sched.keepalive('SELECTED_TASK_ID_1')
+        other_sched.stop('SELECTED_TASK_ID_1')
+        slot = other_sched.slots['sid_1']
+        assert slot.current_task_id is None
+        assert slot._backends['ExampleScheduleBackend'].keptalive == 1
+        assert slot._backends['ExampleScheduleBackend'].stopped == 1
+        assert storage.find_task(sched, 'SELECTED_TASK_ID_1') is None
+        self.assertRaises(WrongTaskIdError,
+                          other_sched.stop, 'SELECTED_TASK_ID_1')
+
+    def test_signals_for_tasks_not_indexed(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'}]
+        sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        sched.schedule()
+        # as if started before the storage indexed tasks
+        storage.unindex_task(sched, 'SELECTED_TASK_ID_1')
+        sched.keepalive('SELECTED_TASK_ID_1')
+        self.assertEqual(storage.find_task(sched, 'SELECTED_TASK_ID_1'),
+                         'sid_1')
+        sched.stop('SELECTED_TASK_ID_1')
+        assert sched.slots['sid_1'].current_task_id is None
+        self.assertRaises(WrongTaskIdError, sched.stop, 'SELECTED_TASK_ID_1')
+
+    def test_signals_in_bulk(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(3)]
+        for lock_mode in LOCK_SCHEDULER, LOCK_SLOT, LOCK_OPTIMISTIC:
+            sched = Scheduler(name=lock_mode, storage=storage,
+                              lock_mode=lock_mode).init_from_config(config)
+            for slot in sched.slots.values():
+                slot.start('TASK_%s' % slot.id_, slot._backends[
+                    'ExampleScheduleBackend'])
+
+            self.assertEqual(
+                sched.keepalive_many(['TASK_sid_0', 'TASK_sid_1', 'NOPE']),
+                {'TASK_sid_0': True, 'TASK_sid_1': True, 'NOPE': False})
+            self.assertEqual(
+                sched.stop_many(['TASK_sid_0', 'NOPE', 'TASK_sid_2']),
+                {'TASK_sid_0': True, 'TASK_sid_2': True, 'NOPE': False})
+            slots = sched.slots
+            assert slots['sid_0'].current_task_id is None
+            assert slots['sid_1'].current_task_id == 'TASK_sid_1'
+            assert slots['sid_2'].current_task_id is None
+            assert storage.data[slots['sid_2']._storage_key][
+                '_current_task_id'] is None
+            backend = slots['sid_0']._backends['ExampleScheduleBackend']
+            assert backend.keptalive == backend.stopped == 2
+            self.assertEqual(storage.locks, {})
+
+    def test_duplicates_are_not_started(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleLaggingBackend',
+                                'ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(2)]
+        sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        sched.schedule()
+        self.assertEqual(sorted(slot.current_task_id
+                                for slot in sched.slots.values()),
+                         ['LAGGING_TASK', 'SELECTED_TASK_ID_1'])
+        backend = sched.slots['sid_0']._backends['ExampleLaggingBackend']
+        # polled again once after only getting duplicates
+        assert backend.polled == 3 and backend.started == 1
+
+        # another process knows it's running through the storage's index
+        other_sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        other_sched.stop('SELECTED_TASK_ID_1')
+        other_sched.schedule()
+        self.assertEqual(storage.find_task(sched, 'LAGGING_TASK'), 'sid_0')
+        self.assertEqual(other_sched.slots['sid_1'].current_task_id,
+                         'SELECTED_TASK_ID_1')
+        self.assertEqual(
+            other_sched.stats.query()['ExampleLaggingBackend']['duplicates'],
+            4)
+
+    def test_task_index_is_written_along(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['ExampleScheduleBackend'],
+                   'pool_id': 'pool', 'size': 2}]
+        sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        with mock.patch.object(storage, 'save_many',
+                               wraps=storage.save_many) as save_many:
+            sched.schedule()
+        # a single write for the slots, their deadlines and the index
+        save_many.assert_called_once()
+        self.assertEqual(save_many.call_args.kwargs['indexes'],
+                         {(sched, 'SELECTED_TASK_ID_1'): 'sid_1',
+                          (sched, 'SELECTED_TASK_ID_2'): 'pool:pool',
+                          (sched, 'SELECTED_TASK_ID_3'): 'pool:pool'})
+        self.assertEqual(storage.find_tasks(sched, ['SELECTED_TASK_ID_1',
+                                                    'SELECTED_TASK_ID_3']),
+                         ['sid_1', 'pool:pool'])
+        sched.stop_many(['SELECTED_TASK_ID_1', 'SELECTED_TASK_ID_3'])
+        self.assertEqual(storage.find_tasks(sched, ['SELECTED_TASK_ID_1',
+                                                    'SELECTED_TASK_ID_2',
+                                                    'SELECTED_TASK_ID_3']),
+                         [None, 'pool:pool', None])
+
+    def test_prefetch(self):
+        config = [{'backends': ['ExamplePrefetchedBackend'],
+                   'slot_id': 'sid_1'}]
+        sched = Scheduler(name='test', storage=MemoryStorage(),
+                          refill_on_stop=True).init_from_config(config)
+        slot = sched.slots['sid_1']
+        backend = slot._backends['ExamplePrefetchedBackend']
+        sched.schedule()
+        self.assertEqual(slot.current_task_id, 'ExamplePrefetchedBackend_0')
+        # polled ahead since the slot is busy
+        assert backend.polled == 2 and backend.queue == []
+
+        sched.stop('ExamplePrefetchedBackend_0')
+        self.assertEqual(slot.current_task_id, 'ExamplePrefetchedBackend_1')
+        assert backend.polled == 2
+        sched.release_prefetched()
+        self.assertEqual(backend.queue, ['ExamplePrefetchedBackend_2'])
+
+        sched.schedule()
+        assert backend.polled == 3 and backend.queue == []
+        time.sleep(backend.prefetch_ttl)
+        sched.stop('ExamplePrefetchedBackend_1')
+        # the prefetched id went stale, released then polled again
+        self.assertEqual(slot.current_task_id, 'ExamplePrefetchedBackend_2')
+        assert backend.polled == 4
+
+        # backends no longer configured give their prefetched ids back
+        backend.queue = ['ExamplePrefetchedBackend_3']
+        sched.schedule()
+        assert backend.polled == 5 and backend.queue == []
+        sched.publish_config([{'backends': ['ExampleScheduleEmptyBackend'],
+                               'slot_id': 'sid_1'}])
+        sched.schedule()
+        assert backend.polled == 5
+        self.assertEqual(backend.queue, ['ExamplePrefetchedBackend_3'])
+        assert sched._prefetched == {}
+
+    def test_backends_are_shared(self):
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['task_semaphore.tests.fixtures:'
+                                'ExampleScheduleBackend',
+                                'ExampleScheduleEmptyBackend'],
+                   'slot_id': 'sid_2'},
+                  {'backends': ['ExampleScheduleBackend'],
+                   'pool_id': 'pool', 'size': 2}]
+        sched = Scheduler(name='test', storage=MockStorage()). \
+            init_from_config(config)
+        backend = sched.slots['sid_1']._backends['ExampleScheduleBackend']
+        assert backend is sched.slots['sid_2']._backends[
+            'ExampleScheduleBackend']
+        assert backend is sched.pools['pool']._backends[
+            'ExampleScheduleBackend']
+        self.assertEqual(set(sched._all_backends),
+                         {'ExampleScheduleBackend',
+                          'ExampleScheduleEmptyBackend'})
+        with self.assertRaises(AssertionError):
+            sched.add_slot('sid_3', ['task_semaphore.tests.fixtures:Nope'])
+        with self.assertRaises(AssertionError):
+            sched.add_slot('sid_4', ['task_semaphore.nope:Nope'])
+
+    def test_hot_reconfiguration(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_2'}]
+        publisher = Scheduler(name='test', storage=storage)
+        self.assertEqual(publisher.publish_config(config), 1)
+        sched = Scheduler(name='test', storage=storage).init_from_config()
+        assert sched.config_version == 1 and not sched.sync_config()
+        # a config given explicitly isn't replaced by the one published
+        explicit = Scheduler(name='test', storage=storage). \
+            init_from_config(config[:1])
+        assert explicit.config_version == 1 and not explicit.sync_config()
+        # only sending signals, never syncing its config
+        signaler = Scheduler(name='test', storage=storage).init_from_config()
+        sched.schedule()
+        self.assertEqual(sched.inspect()['slots']['sid_2'][
+            '_current_task_id'], 'SELECTED_TASK_ID_2')
+
+        # sid_1 is removed, sid_2 polls another backend, more capacity
+        self.assertEqual(publisher.publish_config(
+            [{'backends': ['ExampleBatchBackend'], 'slot_id': 'sid_2'},
+             {'backends': ['ExampleBatchBackend'], 'slot_id': 'sid_3'},
+             {'backends': ['ExampleBatchBackend'],
+              'pool_id': 'pool', 'size': 1}]), 2)
+        sched.schedule()
+        assert sched.config_version == 2
+        sid_1, sid_2 = sched.slots['sid_1'], sched.slots['sid_2']
+        # running tasks aren't touched, sid_1 is drained
+        assert sid_1.current_task_id == 'SELECTED_TASK_ID_1'
+        assert sid_2.current_task_id == 'SELECTED_TASK_ID_2'
+        self.assertEqual(sid_2._backends_names, ['ExampleBatchBackend'])
+        assert sched.slots['sid_3'].current_task_id == 'BATCH_TASK_ID_1'
+        self.assertEqual(sched.pools['pool'].task_ids, ['BATCH_TASK_ID_2'])
+        signaler.keepalive('BATCH_TASK_ID_1')
+        assert signaler.config_version == 2
+
+        sched.stop('SELECTED_TASK_ID_2')  # still has its backend
+        assert sid_2.current_task_id is None
+        sched.stop('SELECTED_TASK_ID_1')
+        sched.schedule()
+        assert 'sid_1' not in sched.slots
+        assert sid_2.current_task_id == 'BATCH_TASK_ID_3'
+        self.assertRaises(WrongTaskIdError, sched.stop, 'SELECTED_TASK_ID_1')
+
+    def test_unused_polled_tasks_are_released(self):
+        config = [{'backends': ['ExampleClaimingBackend',
+                                'ExampleOtherClaimingBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['ExampleClaimingBackend'],
+                   'pool_id': 'pool', 'size': 1}]
+        sched = Scheduler(name='test', storage=MockStorage(),
+                          poll_workers=2).init_from_config(config)
+        sched.schedule()
+        slot, pool = sched.slots['sid_1'], sched.pools['pool']
+        claiming = slot._backends['ExampleClaimingBackend']
+        other = slot._backends['ExampleOtherClaimingBackend']
+        assert slot.current_task_id == 'ExampleClaimingBackend_0'
+        # polled concurrently but not needed
+        assert other.polled == 1
+        self.assertEqual(other.queue, ['ExampleOtherClaimingBackend_%d' % i
+                                       for i in range(3)])
+        self.assertEqual(pool.task_ids, ['ExampleClaimingBackend_1'])
+        self.assertEqual(claiming.queue, ['ExampleClaimingBackend_2'])
+
+        # pool turns out to be full when starting
+        sched.storage.acquire_in_pool = lambda *args: False
+        pool._tasks.clear()
+        polled = claiming.polled
+        sched._fill_pool(pool, set())
+        assert claiming.polled == polled + 1
+        self.assertEqual(claiming.queue, ['ExampleClaimingBackend_2'])
+
+    def test_poll_many(self):
+        config = [{'backends': ['ExampleBatchBackend',
+                                'ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(5)]
+        sched = Scheduler(name='test', storage=MockStorage()). \
+            init_from_config(config)
+        sched.schedule()
+        batch_backend = sched.slots['sid_0']._backends['ExampleBatchBackend']
+        backend = sched.slots['sid_3']._backends['ExampleScheduleBackend']
+        # 3 tasks at most from the batch backend, the 2 others from the next
+        assert batch_backend.polled_many == 2
+        assert batch_backend.polled == 3
+        assert backend.polled == 2
+        self.assertEqual(
+            [slot.current_backend.get_name()
+             for slot in sched.slots.values()],
+            ['ExampleBatchBackend'] * 3 + ['ExampleScheduleBackend'] * 2)
+        self.assertEqual([slot.current_task_id
+                          for slot in sched.slots.values()],
+                         ['BATCH_TASK_ID_1', 'BATCH_TASK_ID_2',
+                          'BATCH_TASK_ID_3', 'SELECTED_TASK_ID_1',
+                          'SELECTED_TASK_ID_2'])
+
+    def test_poll_many_default_stops_on_repeated_task(self):
+        config = [{'backends': ['ExampleIdempotentBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(3)]
+        sched = Scheduler(name='test', storage=MockStorage()). \
+            init_from_config(config)
+        backend = sched.slots['sid_0']._backends['ExampleIdempotentBackend']
+        backend.queue[:] = ['TASK_1', 'TASK_2', 'TASK_3', 'TASK_4']
+        self.assertEqual(backend.poll_many(3), ['TASK_1'])
+        assert backend.polled == 1
+        sched.schedule()
+        self.assertEqual([slot.current_task_id
+                          for slot in sched.slots.values()],
+                         ['TASK_1', 'TASK_2', 'TASK_3'])
+        self.assertEqual(backend.queue, ['TASK_4'])
+
+    def test_locks_are_renewed_while_filling(self):
+        config = [{'backends': ['ExampleSlowBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(3)]
+        config.append({'backends': ['ExampleSlowBackend'],
+                       'pool_id': 'pool', 'size': 3})
+        for lock_mode in LOCK_SCHEDULER, LOCK_SLOT:
+            storage = MemoryStorage()
+            storage.lock_ttl = 0.15  # renewed past 0.075s, about every poll
+            sched = Scheduler(name='test', storage=storage,
+                              lock_mode=lock_mode).init_from_config(config)
+            sched.schedule()
+            assert all(slot.current_task_id
+                       for slot in sched.slots.values())
+            assert sched.pools['pool'].free_capacity == 0
+            if lock_mode == LOCK_SCHEDULER:
+                # once a slot or so, every poll taking 0.1s
+                assert storage.renewals[sched._storage_key] >= 4
+            else:
+                # every lock held during the pass, not only the slot polling
+                self.assertEqual(
+                        set(storage.renewals),
+                        {target._storage_key for target in
+                         list(sched.slots.values()) + [sched.pools['pool']]})
+            self.assertEqual(storage.locks, {})
+
+    def test_concurrent_polling(self):
+        config = [{'backends': ['ExampleMeetingEmptyBackend',
+                                'ExampleMeetingBackend',
+                                'ExampleMeetingLowBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(2)]
+        sched = Scheduler(name='test', storage=MockStorage(),
+                          poll_workers=4).init_from_config(config)
+        # the three backends' first polls must all be in progress together
+        meeting = ExampleMeetingBackend.meeting = threading.Barrier(3)
+        sched.schedule()
+        assert not meeting.broken
+        slot = sched.slots['sid_0']
+        assert slot._backends['ExampleMeetingEmptyBackend'].polled == 1
+        assert slot._backends['ExampleMeetingBackend'].polled == 2
+        assert slot._backends['ExampleMeetingLowBackend'].polled == 1
+        # lower priority backend's tasks were discarded
+        self.assertEqual([slot.current_task_id
+                          for slot in sched.slots.values()],
+                         ['MEETING_SELECTED_TASK_ID_1',
+                          'MEETING_SELECTED_TASK_ID_2'])
+
+    def test_concurrent_polling_of_shared_backends(self):
+        config = [{'backends': ['ExampleBatchBackend'], 'slot_id': 'sid_1'},
+                  {'backends': ['ExampleBatchBackend',
+                                'ExampleScheduleEmptyBackend'],
+                   'slot_id': 'sid_2'}]
+        sched = Scheduler(name='test', storage=MockStorage(),
+                          poll_workers=2).init_from_config(config)
+        sched.schedule()
+        # polled once for both groups of slots, not from two threads
+        backend = sched.slots['sid_1']._backends['ExampleBatchBackend']
+        assert backend.polled_many == 1
+        self.assertEqual([slot.current_task_id
+                          for slot in sched.slots.values()],
+                         ['BATCH_TASK_ID_1', 'BATCH_TASK_ID_2'])
+
+    def test_concurrent_polling_keeps_priority(self):
+        config = [{'backends': ['ExampleIdempotentBackend',
+                                'ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(3)]
+        sched = Scheduler(name='test', storage=MockStorage(),
+                          poll_workers=2).init_from_config(config)
+        backend = sched.slots['sid_0']._backends['ExampleIdempotentBackend']
+        backend.queue[:] = ['TASK_1', 'TASK_2']
+        sched.schedule()
+        self.assertEqual([slot.current_task_id
+                          for slot in sched.slots.values()],
+                         ['TASK_1', 'TASK_2', 'SELECTED_TASK_ID_1'])
+
     def test_schedule_nothing_to_do(self):
         config = [{'backends': ['ExampleScheduleEmptyBackend'],
                   'slot_id': 'sid_1'}]
@@ -127,6 +578,28 @@ class BaseTestCase(unittest.TestCase):
         assert slot._backends['ExampleScheduleBackend'].started == 1
         assert slot._backends['ExampleScheduleBackend'].stopped == 1
 
+    def test_refill_on_stop(self):
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(2)]
+        sched = Scheduler(name='test', storage=MemoryStorage(),
+                          refill_on_stop=True).init_from_config(config)
+        sid_0, sid_1 = sched.slots['sid_0'], sched.slots['sid_1']
+        backend = sid_0._backends['ExampleScheduleBackend']
+        sched.schedule()
+        self.assertEqual([sid_0.current_task_id, sid_1.current_task_id],
+                         ['SELECTED_TASK_ID_1', 'SELECTED_TASK_ID_2'])
+
+        sched.stop('SELECTED_TASK_ID_1')
+        assert sid_0.current_task_id == 'SELECTED_TASK_ID_3'
+        assert backend.stopped == 1 and backend.started == 3
+
+        self.assertEqual(sched.stop_many(['SELECTED_TASK_ID_2',
+                                          'SELECTED_TASK_ID_3']),
+                         {'SELECTED_TASK_ID_2': True,
+                          'SELECTED_TASK_ID_3': True})
+        assert sid_0.current_task_id and sid_1.current_task_id
+        assert backend.stopped == 3
+
     def test_keepalive(self):
         config = [{'backends': ['ExampleScheduleEmptyBackend',
                                 'ExampleScheduleBackend'],
@@ -145,6 +618,43 @@ class BaseTestCase(unittest.TestCase):
         assert slot.current_task_id == 'SELECTED_TASK_ID_1'
         assert slot._backends['ExampleScheduleBackend'].keptalive == 2
 
+    def test_keepalive_coalescing(self):
+        storage = CountingStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1',
+                   'slot_kwargs': {'keepalive_resolution': 0.5}}]
+        sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        sched.schedule()
+        slot = sched.slots['sid_1']
+        last_keepalive_at = slot.last_keepalive_at
+        storage.calls.clear()
+
+        # right after start, nothing is written nor called
+        sched.keepalive('SELECTED_TASK_ID_1')
+        self.assertEqual(sched.keepalive_many(['SELECTED_TASK_ID_1']),
+                         {'SELECTED_TASK_ID_1': True})
+        assert slot.last_keepalive_at == last_keepalive_at
+        assert slot.current_backend.keptalive == 0
+        self.assertEqual(storage.calls, {})
+
+        time.sleep(0.5)
+        sched.keepalive('SELECTED_TASK_ID_1')
+        sched.keepalive('SELECTED_TASK_ID_1')
+        assert slot.last_keepalive_at > last_keepalive_at
+        assert slot.current_backend.keptalive == 1
+        # the keepalive and the deadline written at once
+        self.assertEqual(storage.calls,
+                         {'reload_many': 1, 'reload': 1, 'save_many': 1})
+
+        sched.stop('SELECTED_TASK_ID_1')
+        assert not sched._keepalives
+
+        # those of tasks stopped by other processes are forgotten as well
+        sched._keepalives['STOPPED_ELSEWHERE'] = (slot, last_keepalive_at)
+        self.assertRaises(WrongTaskIdError, sched.keepalive, 'UNKNOWN')
+        assert not sched._keepalives
+
     def test_timeout(self):
         config = [{'backends': ['ExampleScheduleBackend',
                                 'ExampleScheduleEmptyBackend'],
@@ -179,6 +689,219 @@ class BaseTestCase(unittest.TestCase):
         assert slot.started_at > started_at
         assert slot.last_keepalive_at > keepalive
 
+    def test_reap_timeouts(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'late',
+                   'slot_kwargs': {'timeout_after': 1 / 120}},
+                  {'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'on_time'}]
+        for lock_mode in LOCK_SCHEDULER, LOCK_SLOT, LOCK_OPTIMISTIC:
+            sched = Scheduler(name=lock_mode, storage=storage,
+                              lock_mode=lock_mode).init_from_config(config)
+            sched.schedule()
+            late, on_time = sched.slots['late'], sched.slots['on_time']
+            assert sched.reap_timeouts() == 0
+            self.assertEqual(len(storage._deadlines(sched)), 2)
+
+            time.sleep(0.5)
+            self.assertEqual(storage.expired_slots(
+                sched, late.deadline + late.timeout_after), ['late'])
+            assert sched.reap_timeouts() == 1
+            assert late.current_task_id is None
+            assert late._backends['ExampleScheduleBackend'].timeouted == 1
+            assert late._backends['ExampleScheduleBackend'].stopped == 1
+            assert on_time.current_task_id
+            self.assertEqual(list(storage._deadlines(sched)), ['on_time'])
+
+    def test_signals_during_a_pass(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'busy'}]
+        sched = Scheduler(name='test', storage=storage, lock_mode=LOCK_SLOT). \
+            init_from_config(config)
+        sched.schedule()
+        slow = sched.add_slot('slow', ['ExampleSlowStartBackend'])
+        slow._backends['ExampleSlowStartBackend'].delay = 0.3
+        errors = []
+
+        def schedule():
+            try:
+                sched.schedule()
+            except Exception as error:
+                errors.append(error)
+        passing = threading.Thread(target=schedule)
+        passing.start()
+        time.sleep(0.1)  # the pass is in the slow slot's start_callback
+        self.assertEqual(sched.keepalive_many(['SELECTED_TASK_ID_1']),
+                         {'SELECTED_TASK_ID_1': True})
+        passing.join()
+        assert errors == []
+        other = Scheduler(name='test', storage=storage, lock_mode=LOCK_SLOT)
+        other.add_slot('slow', ['ExampleSlowStartBackend']).reload()
+        assert slow.current_task_id == 'SELECTED_TASK_ID_2'
+        self.assertEqual(other.slots['slow'].current_task_id,
+                         slow.current_task_id)
+
+    def test_reaping_during_a_pass(self):
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'late',
+                   'slot_kwargs': {'timeout_after': 1 / 120}},
+                  {'backends': ['ExampleBlockingBackend'],
+                   'slot_id': 'blocked'}]
+        sched = Scheduler(name='test', storage=MemoryStorage(),
+                          lock_mode=LOCK_SLOT).init_from_config(config)
+        backend = sched.slots['blocked']._backends['ExampleBlockingBackend']
+        backend.unblocked.set()
+        sched.schedule()
+        backend.unblocked.clear()
+        backend.polling.clear()
+        passing = threading.Thread(target=sched.schedule)
+        passing.start()
+        assert backend.polling.wait(5)
+        time.sleep(0.6)
+        # the pass is still polling, the late task is reaped all the same
+        assert sched.reap_timeouts() == 1
+        assert passing.is_alive()
+        assert sched.slots['late'].current_task_id is None
+        backend.unblocked.set()
+        passing.join()
+
+    def test_leases(self):
+        storage = MemoryStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'late',
+                   'slot_kwargs': {'timeout_after': 1 / 120}},
+                  {'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'on_time'}]
+        sched = Scheduler(name='test', storage=storage, leases=True). \
+            init_from_config(config)
+        sched.schedule()
+        late, on_time = sched.slots['late'], sched.slots['on_time']
+        self.assertEqual(sorted(storage._leases(sched)), ['late', 'on_time'])
+        assert sched.reap_expired_leases() == 0
+
+        time.sleep(0.3)
+        sched.keepalive(late.current_task_id)
+        time.sleep(0.3)
+        assert sched.reap_expired_leases() == 0
+        time.sleep(0.3)
+        assert sched.reap_expired_leases() == 1
+        assert late.current_task_id is None
+        assert late._backends['ExampleScheduleBackend'].timeouted == 1
+        self.assertEqual(list(storage._leases(sched)), ['on_time'])
+        sched.stop(on_time.current_task_id)
+        self.assertEqual(storage._leases(sched), {})
+        with self.assertRaises(AssertionError):
+            Scheduler(name='test', storage=MockStorage(), leases=True)
+
+    def test_callback_dispatcher(self):
+        dispatcher = CallbackDispatcher(workers=2, deadline=0.2,
+                                        deadlines={'stop_callback': 5})
+        sched = Scheduler(name='test', storage=MemoryStorage(),
+                          callback_dispatcher=dispatcher).init_from_config(
+            [{'backends': ['ExampleSlowStartBackend'], 'slot_id': 'sid_1'}])
+        slot = sched.slots['sid_1']
+        backend = slot._backends['ExampleSlowStartBackend']
+        start = time.monotonic()
+        sched.schedule()
+        assert time.monotonic() - start < backend.delay
+        self.assertEqual(slot.current_task_id, 'SELECTED_TASK_ID_1')
+
+        # the start_callback overran, the task is released then replaced
+        time.sleep(0.3)
+        sched.schedule()
+        assert backend.error_handled == 1
+        self.assertEqual(slot.current_task_id, 'SELECTED_TASK_ID_2')
+        sched.stop('SELECTED_TASK_ID_2')
+        dispatcher.close()
+        assert backend.started == 2 and backend.stopped == 1
+        assert dispatcher.collect() == []
+
+    def test_dispatched_callbacks_keep_their_order(self):
+        dispatcher = CallbackDispatcher(workers=2)
+        backend = ExampleSlowStartBackend()
+        backend.delay = 0.2
+        dispatcher.submit(backend, 'start_callback', 'TASK_1')
+        dispatcher.submit(backend, 'stop_callback', 'TASK_1')
+        dispatcher.submit(backend, 'stop_callback', 'TASK_2')
+        time.sleep(0.1)
+        # TASK_1 is stopped once started, other tasks aren't held up
+        assert backend.started == 0 and backend.stopped == 1
+        dispatcher.close()
+        assert backend.started == 1 and backend.stopped == 2
+
+    def test_dispatcher_close_is_bounded(self):
+        dispatcher = CallbackDispatcher(workers=1)
+        backend = ExampleSlowStartBackend()
+        backend.delay = 0.3
+        dispatcher.submit(backend, 'start_callback', 'TASK_1')
+        dispatcher.submit(backend, 'stop_callback', 'TASK_1')  # waiting
+        dispatcher.submit(backend, 'start_callback', 'TASK_2')  # queued
+        time.sleep(0.05)
+        assert not dispatcher.close(timeout=0.05)
+        assert backend.started == 0
+        time.sleep(0.4)
+        # the running callback ended, the others were cancelled
+        assert backend.started == 1 and backend.stopped == 0
+        assert dispatcher.collect() == []
+
+    def test_slot_pool(self):
+        config = [{'pool_id': 'pool', 'size': 3,
+                   'backends': ['ExampleScheduleEmptyBackend',
+                                'ExampleScheduleBackend'],
+                   'pool_kwargs': {'timeout_after': 1 / 120}},
+                  {'backends': ['ExampleBatchBackend'],
+                   'slot_id': 'sid_1'}]
+        sched = Scheduler(name='test', storage=MemoryStorage()). \
+            init_from_config(config)
+        pool = sched.pools['pool']
+        backend = pool._backends['ExampleScheduleBackend']
+        self.assertEqual(sched.schedule(),
+                         {'idle': 4, 'timeouted': 0, 'started': 4})
+        self.assertEqual(sorted(pool.task_ids),
+                         ['SELECTED_TASK_ID_%d' % i for i in (1, 2, 3)])
+        assert pool.free_capacity == 0 and backend.polled == 3
+
+        sched.keepalive('SELECTED_TASK_ID_1')
+        sched.stop('SELECTED_TASK_ID_2')
+        assert backend.keptalive == backend.stopped == 1
+        self.assertRaises(WrongTaskIdError,
+                          sched.stop, 'SELECTED_TASK_ID_2')
+        self.assertEqual(sched.schedule(),
+                         {'idle': 1, 'timeouted': 0, 'started': 1})
+        self.assertEqual(sorted(pool.task_ids),
+                         ['SELECTED_TASK_ID_%d' % i for i in (1, 3, 4)])
+        self.assertEqual(
+            set(sched.inspect()['pools']['pool']['_tasks']),
+            set(pool.task_ids))
+
+        time.sleep(0.5)
+        assert sched.reap_timeouts() == 3
+        assert backend.timeouted == 3 and backend.stopped == 4
+        assert pool.free_capacity == 3
+
+    def test_runner(self):
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'}]
+        sched = Scheduler(name='test', storage=MockStorage()). \
+            init_from_config(config)
+        passes = []
+
+        def on_pass(summary):
+            passes.append(summary)
+            if len(passes) == 3:
+                runner.stop()
+
+        runner = Runner(sched, min_interval=0.01, max_interval=0.03,
+                        reap_interval=0.01, on_pass=on_pass)
+        runner.run()
+        self.assertEqual([(summary['started'], summary['next_interval'])
+                          for summary in passes],
+                         [(1, 0.01), (0, 0.02), (0, 0.03)])
+        assert all(summary['duration'] >= 0 for summary in passes)
+        assert runner.last_pass is passes[-1]
+
     def test_start_error_handling(self):
         config = [{'backends': ['ExampleStartRaisingBackend'],
                   'slot_id': 'sid_1'}]
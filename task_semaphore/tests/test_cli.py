@@ -0,0 +1,48 @@
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import redis
+
+from .. import Scheduler
+from ..cli import main
+from ..services.scheduler import LOCK_SLOT
+from ..utils.storage import KEY_LAYOUT_HASH_TAG, RedisHashStorage
+
+
+class CliTestCase(unittest.TestCase):
+
+    def test_main(self):
+        redis_c = mock.MagicMock()
+        redis_c.hget.return_value = None  # no config published
+        redis_c.mget.side_effect = lambda keys: [None] * len(keys)
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'}]
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as config_file:
+            json.dump(config, config_file)
+            config_file.flush()
+            with mock.patch.object(redis.StrictRedis, 'from_url',
+                                   return_value=redis_c) as from_url, \
+                    mock.patch.object(Scheduler, 'run_forever',
+                                      autospec=True) as run_forever:
+                main(['--name', 'test', '--config', config_file.name,
+                      '--import', 'task_semaphore.tests.fixtures',
+                      '--redis-url', 'redis://example:6379/1',
+                      '--storage', 'hash', '--key-layout',
+                      KEY_LAYOUT_HASH_TAG, '--lock-mode', LOCK_SLOT,
+                      '--reap-interval', '5', '--callback-workers', '2'])
+        from_url.assert_called_once_with('redis://example:6379/1')
+        sched = run_forever.call_args.args[0]
+        self.assertEqual(run_forever.call_args.kwargs,
+                         {'min_interval': 1, 'max_interval': 60,
+                          'reap_interval': 5})
+        assert sched.id_ == 'test' and sched.lock_mode == LOCK_SLOT
+        assert isinstance(sched.storage, RedisHashStorage)
+        assert sched.storage.redis_c is redis_c
+        assert sched.storage.key_layout == KEY_LAYOUT_HASH_TAG
+        assert sched.callback_dispatcher is not None
+        self.assertEqual(list(sched.slots), ['sid_1'])
+        self.assertEqual(sched.slots['sid_1']._backends_names,
+                         ['ExampleScheduleBackend'])
+        sched.callback_dispatcher.close()
@@ -0,0 +1,50 @@
+import time
+import unittest
+
+from ..exceptions import LockLostError
+from .fixtures import DictLock
+
+
+class LockTestCase(unittest.TestCase):
+
+    def test_lock_is_exclusive(self):
+        store = {}
+        with DictLock(store) as lock:
+            assert lock.token and store['lock'] == lock.token
+            assert not DictLock(store).acquire(blocking=False)
+        assert not store
+        assert DictLock(store).acquire(blocking=False)
+
+    def test_release_needs_ownership(self):
+        store = {}
+        lock = DictLock(store)
+        assert lock.acquire()
+        store['lock'] = 'SOMEONE_ELSE'  # as if the lease expired
+        lock.release()
+        self.assertEqual(store, {'lock': 'SOMEONE_ELSE'})
+        self.assertRaises(LockLostError, lock.renew)
+
+    def test_acquire_times_out_with_backoff(self):
+        store = {'lock': 'SOMEONE_ELSE'}
+        lock = DictLock(store, max_wait=0.1 / 60,
+                        backoff_min=0.001, backoff_max=0.02)
+        start = time.monotonic()
+        self.assertRaises(TimeoutError, lock.acquire)
+        assert time.monotonic() - start < 1
+
+    def test_positional_arguments(self):
+        # wait_for is still accepted, and ignored
+        lock = DictLock({}, 2, 1)
+        self.assertEqual(lock.max_lock_wait, 60)
+        self.assertEqual(lock.ttl, 5 * 60)
+
+    def test_renew_if_needed(self):
+        store = {}
+        lock = DictLock(store, ttl=0.02)
+        lock.acquire()
+        renewed_at = lock._renewed_at
+        lock.renew_if_needed()
+        assert lock._renewed_at == renewed_at
+        time.sleep(0.02)
+        lock.renew_if_needed()
+        assert lock._renewed_at > renewed_at
@@ -0,0 +1,162 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from .. import Scheduler
+from ..stats import (DURATION_BUCKETS, AdaptiveTimeoutPolicy, StatsRecorder,
+                     bucket_of, percentile)
+from .fixtures import CountingStorage, MemoryStorage
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def test_histogram(self):
+        assert bucket_of(0.5) == 0
+        assert bucket_of(1) == 0
+        assert bucket_of(2) == 1
+        assert bucket_of(10 ** 6) == len(DURATION_BUCKETS)
+        counts = {0: 90, 3: 9, len(DURATION_BUCKETS): 1}
+        assert percentile(counts, 50) == 1
+        assert percentile(counts, 95) == DURATION_BUCKETS[3]
+        assert percentile(counts, 99) == DURATION_BUCKETS[3]
+        assert percentile(counts, 100) == float('inf')
+        assert percentile({}, 50) is None
+
+    def test_scheduler_records_events(self):
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['ExampleEnqueuedBackend'],
+                   'slot_id': 'sid_2',
+                   'slot_kwargs': {'timeout_after': 1 / 120}}]
+        sched = Scheduler(name='test', storage=MemoryStorage()). \
+            init_from_config(config)
+        sched.schedule()
+        sched.stop('SELECTED_TASK_ID_1')
+        time.sleep(0.6)
+        sched.schedule()  # timeouts ENQUEUED_SELECTED_TASK_ID_1
+
+        stats = sched.inspect()['stats']
+        self.assertEqual(stats['ExampleScheduleBackend'], {
+            'started': 2, 'stopped': 1, 'timeouted': 0, 'duplicates': 0,
+            'duration': {'count': 1, 'p50': 1, 'p95': 1, 'p99': 1},
+            'wait': {'count': 0, 'p50': None, 'p95': None, 'p99': None}})
+        enqueued = stats['ExampleEnqueuedBackend']
+        assert enqueued['started'] == 2 and enqueued['timeouted'] == 1
+        # timeouts don't count as stops, nor their durations
+        assert enqueued['stopped'] == 0
+        assert enqueued['duration']['count'] == 0
+        self.assertEqual(enqueued['wait'], {'count': 2, 'p50': 15,
+                                            'p95': 15, 'p99': 15})
+
+    def test_stats_are_written_once_per_pass(self):
+        storage = CountingStorage()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(5)]
+        sched = Scheduler(name='test', storage=storage). \
+            init_from_config(config)
+        storage.incr_stats = lambda *args: storage._count('incr_stats')
+        sched.schedule()
+        self.assertEqual(storage.calls, {'reload_many': 2, 'save_many': 1,
+                                         'incr_stats': 1})
+
+        disabled = Scheduler(name='test', storage=MemoryStorage(),
+                             stats_window=0).init_from_config(config)
+        disabled.schedule()
+        assert disabled.stats.pop_pending() == {}
+        assert disabled.inspect()['stats'] == {}
+
+    def test_query_windows(self):
+        sched = Scheduler(name='test', storage=MemoryStorage())
+        recorder = StatsRecorder(sched, window=60)
+        until = datetime(2020, 1, 1, 12, 30, 15)
+        windows = recorder.windows(since=120, until=until)
+        self.assertEqual(len(windows), 3)
+        assert windows[-1] == recorder._window_of(until)
+        sched.storage.incr_stats(sched, {windows[0]: {'Bk|started': 2},
+                                         windows[2]: {'Bk|started': 1,
+                                                      'Bk|duration|1': 1}},
+                                 60)
+        summary = recorder.query(since=120, until=until)
+        assert summary['Bk']['started'] == 3
+        assert summary['Bk']['duration']['p99'] == DURATION_BUCKETS[1]
+        assert recorder.query(since=30, until=until)['Bk']['started'] == 1
+
+    def test_old_windows_are_dropped(self):
+        sched = Scheduler(name='test', storage=MemoryStorage())
+        now = int(time.time())
+        sched.storage.incr_stats(sched, {now - 120: {'Bk|started': 1},
+                                         now: {'Bk|started': 1}}, 60)
+        sched.storage.incr_stats(sched, {now: {'Bk|started': 1}}, 60)
+        self.assertEqual(sched.storage.load_stats(sched, [now - 120, now]),
+                         [{}, {'Bk|started': 2}])
+
+
+class AdaptiveTimeoutTestCase(unittest.TestCase):
+
+    @staticmethod
+    def _stats(count, p99):
+        return {'duration': {'count': count, 'p50': 1, 'p95': p99,
+                             'p99': p99}}
+
+    def test_timeouts(self):
+        policy = AdaptiveTimeoutPolicy(factor=3, floor=5, min_samples=20)
+        policy.update({'Fast': self._stats(100, 300),
+                       'Quick': self._stats(100, 1),
+                       'Slow': self._stats(100, 86400),
+                       'Rare': self._stats(3, 60),
+                       'Unbound': self._stats(100, float('inf'))})
+        eight_hours = timedelta(hours=8)
+        self.assertEqual(policy.timeout_for('Fast', eight_hours),
+                         timedelta(minutes=15))
+        self.assertEqual(policy.timeout_for('Quick', eight_hours),
+                         timedelta(minutes=5))  # floor
+        self.assertEqual(policy.timeout_for('Slow', eight_hours),
+                         eight_hours)  # capped
+        for backend_name in 'Rare', 'Unbound', 'Unknown':
+            self.assertEqual(policy.timeout_for(backend_name, eight_hours),
+                             eight_hours)
+
+    def test_scheduler_timeouts_dead_tasks_early(self):
+        policy = AdaptiveTimeoutPolicy(factor=1, floor=0, min_samples=1)
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['ExampleEnqueuedBackend'],
+                   'slot_id': 'sid_2'},
+                  {'backends': ['ExampleScheduleBackend'],
+                   'pool_id': 'pool', 'size': 1}]
+        sched = Scheduler(name='test', storage=MemoryStorage(),
+                          timeout_policy=policy).init_from_config(config)
+        sched.schedule()
+        self.assertEqual(policy._timeouts, {})  # nothing observed yet
+        policy.update({'ExampleScheduleBackend': self._stats(1, 1)})
+        sid_1, sid_2 = sched.slots['sid_1'], sched.slots['sid_2']
+        assert sid_1.current_timeout == timedelta(seconds=1)
+        assert sid_2.current_timeout == sid_2.timeout_after
+
+        # all tasks were last kept alive 2 seconds ago
+        for slot in sid_1, sid_2:
+            slot._last_keepalive_at -= timedelta(seconds=2)
+            slot.save()
+        pool = sched.pools['pool']
+        for task_id, (name, started_at, at) in list(pool._tasks.items()):
+            pool._tasks[task_id] = (name, started_at,
+                                    at - timedelta(seconds=2))
+        assert sched.schedule()['timeouted'] == 2
+        assert sid_2.current_task_id == 'ENQUEUED_SELECTED_TASK_ID_1'
+
+    def test_reaper_uses_shortened_timeouts(self):
+        policy = AdaptiveTimeoutPolicy(factor=1, floor=0, min_samples=1)
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'},
+                  {'backends': ['ExampleEnqueuedBackend'],
+                   'slot_id': 'sid_2'}]
+        sched = Scheduler(name='test', storage=MemoryStorage(),
+                          timeout_policy=policy).init_from_config(config)
+        sched.schedule()
+        sid_1, sid_2 = sched.slots['sid_1'], sched.slots['sid_2']
+        time.sleep(1.1)
+        # deadlines were indexed before the timeout got shortened
+        policy.update({'ExampleScheduleBackend': self._stats(1, 1)})
+        assert sched.reap_timeouts() == 1
+        assert sid_1.current_task_id is None
+        assert sid_2.current_task_id == 'ENQUEUED_SELECTED_TASK_ID_1'
@@ -1,9 +1,17 @@
+import time
 import unittest
+from datetime import UTC, datetime, timedelta
+from unittest import mock
 
 import redis
+import redis.asyncio
 
-from .. import Scheduler
-from ..utils.storage import RedisStorage
+from .. import AsyncScheduler, RedisQueueBackend, Scheduler
+from ..services.scheduler import LOCK_OPTIMISTIC
+from ..utils.async_storage import AsyncRedisStorage
+from ..utils.lock import RedisLock
+from ..utils.storage import (KEY_LAYOUT_FLAT, KEY_LAYOUT_HASH_TAG,
+                             RedisHashStorage, RedisStorage)
 from .fixtures import ExampleScheduleBackend, ExampleScheduleEmptyBackend
 
 
@@ -40,6 +48,138 @@ class StorageTstMixin:
         assert slot._last_keepalive_at is not None
         assert slot._started_at is not None
 
+    def test_bulk_save_and_reload(self):
+        self._clean()
+
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_%d' % i} for i in range(3)]
+        storage = self._storage()
+        sched_before = Scheduler(name='test', storage=storage).\
+            init_from_config(config)
+        for slot in sched_before.slots.values():
+            slot._current_task_id = 'TASK_%s' % slot.id_
+        storage.save_many(sched_before.slots.values())
+
+        sched = Scheduler(name='test', storage=self._storage()).\
+            init_from_config(config)
+        for slot_id, slot in sched.slots.items():
+            assert slot.current_task_id == 'TASK_%s' % slot_id
+
+    def test_deadlines_are_saved_along(self):
+        self._clean()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'}]
+        storage = self._storage()
+        sched = Scheduler(name='test', storage=storage, leases=True).\
+            init_from_config(config)
+        later = datetime.now(UTC).replace(tzinfo=None) + timedelta(days=1)
+        # the task index is written in the same pipeline, not on its own
+        storage.index_task = storage.unindex_task = None
+        sched.schedule()
+        assert storage.expired_slots(sched, later) == ['sid_1']
+        assert self._redis.exists(storage._lease_key(sched, 'sid_1'))
+        assert storage.find_task(sched, 'SELECTED_TASK_ID_1') == 'sid_1'
+        sched.keepalive('SELECTED_TASK_ID_1')
+        assert storage.expired_slots(sched, later) == ['sid_1']
+        sched.stop('SELECTED_TASK_ID_1')
+        assert storage.expired_slots(sched, later) == []
+        assert not self._redis.exists(storage._lease_key(sched, 'sid_1'))
+        assert storage.find_task(sched, 'SELECTED_TASK_ID_1') is None
+
+    def test_pool_capacity_is_shared(self):
+        self._clean()
+        config = [{'pool_id': 'pool', 'size': 2,
+                   'backends': ['ExampleScheduleBackend']}]
+        sched = Scheduler(name='test', storage=self._storage()).\
+            init_from_config(config)
+        other_sched = Scheduler(name='test', storage=self._storage()).\
+            init_from_config(config)
+        sched.schedule()
+        pool, other_pool = sched.pools['pool'], other_sched.pools['pool']
+        backend = other_pool._backends['ExampleScheduleBackend']
+        # other_pool is out of date but storage knows the pool is full
+        assert other_pool.free_capacity == 2
+        assert not other_pool.start('OTHER_TASK', backend)
+
+        other_sched.stop('SELECTED_TASK_ID_1')
+        pool.reload()
+        self.assertEqual(pool.task_ids, ['SELECTED_TASK_ID_2'])
+        assert pool.start('OTHER_TASK', backend)
+
+    def test_pool_review_only_loads_late_tasks(self):
+        self._clean()
+        config = [{'pool_id': 'pool', 'size': 3,
+                   'backends': ['ExampleScheduleBackend'],
+                   'pool_kwargs': {'timeout_after': 1 / 120}}]
+        storage = self._storage()
+        sched = Scheduler(name='test', storage=storage).\
+            init_from_config(config)
+        sched.schedule()
+        pool = sched.pools['pool']
+        time.sleep(0.6)
+        sched.keepalive('SELECTED_TASK_ID_1')
+        with mock.patch.object(storage, 'load_pool',
+                               side_effect=AssertionError):
+            pool.reload_late()
+            self.assertEqual(sorted(pool.task_ids), ['SELECTED_TASK_ID_2',
+                                                     'SELECTED_TASK_ID_3'])
+            assert pool.free_capacity == 0
+            sched.schedule()
+        pool.reload()
+        self.assertEqual(sorted(pool.task_ids), ['SELECTED_TASK_ID_1',
+                                                 'SELECTED_TASK_ID_4',
+                                                 'SELECTED_TASK_ID_5'])
+        sched.stop_many(pool.task_ids)
+        self.assertEqual(storage.load_pool_late(pool, datetime.max),
+                         (0, {}))
+
+    def test_stats_are_shared(self):
+        self._clean()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'}]
+        sched = Scheduler(name='test', storage=self._storage()).\
+            init_from_config(config)
+        other_sched = Scheduler(name='test', storage=self._storage()).\
+            init_from_config(config)
+        sched.schedule()
+        other_sched.stop('SELECTED_TASK_ID_1')
+        stats = other_sched.stats.query()['ExampleScheduleBackend']
+        assert stats['started'] == 1 and stats['stopped'] == 1
+        assert stats['duration']['p50'] == 1
+
+    def test_published_config(self):
+        self._clean()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'}]
+        storage = self._storage()
+        sched = Scheduler(name='test', storage=storage)
+        assert storage.load_config(sched) == (None, None)
+        assert sched.publish_config(config) == 1
+        assert sched.publish_config(config + [
+            {'backends': ['ExampleScheduleBackend'], 'slot_id': 'sid_2'}]) \
+            == 2
+        other_sched = Scheduler(name='test', storage=self._storage()).\
+            init_from_config()
+        assert storage.config_version(sched) == other_sched.config_version \
+            == 2
+        self.assertEqual(sorted(other_sched.slots), ['sid_1', 'sid_2'])
+
+    def test_compare_and_set(self):
+        self._clean()
+        sched = Scheduler(name='test', storage=self._storage(),
+                          lock_mode=LOCK_OPTIMISTIC)
+        slot = sched.add_slot('sid_1', ['ExampleScheduleBackend'])
+        slot._version = 1
+        # a single script, no WATCH which cluster clients don't support
+        with mock.patch.object(sched.storage.redis_c, 'pipeline',
+                               side_effect=AssertionError):
+            assert sched.storage.compare_and_set(slot, 0)
+            assert not sched.storage.compare_and_set(slot, 0)
+            slot._version, slot._current_task_id = 2, 'TASK'
+            assert sched.storage.compare_and_set(slot, 1)
+        sched.storage.reload(slot)
+        assert slot._version == 2 and slot.current_task_id == 'TASK'
+
     def _clean(self):
         pass
 
@@ -57,3 +197,173 @@ class RedisStorageTest(unittest.TestCase, StorageTstMixin):
     def _storage(self):
         # FIXME: add this to config
         return RedisStorage(self._redis)
+
+    def test_lock_is_atomic_and_token_owned(self):
+        self._clean()
+        lock = RedisLock(self._redis, 'test.lock', ttl=1)
+        other = RedisLock(self._redis, 'test.lock', ttl=1)
+        assert lock.acquire(blocking=False)
+        assert not other.acquire(blocking=False)
+        other.release()
+        assert lock.is_locked()
+        assert 0 < self._redis.pttl('test.lock') <= 1000
+
+        lock.renew()
+        lock.release()
+        assert not lock.is_locked()
+        assert other.acquire(blocking=False)
+        other.release()
+
+    def test_expired_leases(self):
+        self._clean()
+        self._redis.config_set('notify-keyspace-events', 'Ex')
+        storage = self._storage()
+        sched = Scheduler(name='test', storage=storage, leases=True)
+        other_sched = Scheduler(name='other', storage=storage)
+        assert storage.expired_leases(sched, timeout=0.1) == []
+        storage.set_lease(sched, 'sid_1', timedelta(milliseconds=100))
+        storage.set_lease(sched, 'sid_2', timedelta(milliseconds=100))
+        storage.set_lease(other_sched, 'sid_1', timedelta(milliseconds=100))
+        storage.clear_lease(sched, 'sid_2')
+        time.sleep(0.3)
+        self.assertEqual(storage.expired_leases(sched, timeout=1), ['sid_1'])
+
+        # slot ids needn't be strings
+        storage.set_lease(sched, 3, timedelta(milliseconds=100))
+        storage.set_lease(sched, 4, timedelta(milliseconds=100))
+        storage.clear_lease(sched, 4)
+        time.sleep(0.3)
+        self.assertEqual(storage.expired_leases(sched, timeout=1), ['3'])
+
+
+class RedisQueueBackendTest(unittest.TestCase):
+    """Integration test for the redis queue backend"""
+
+    def setUp(self):
+        self.redis_c = redis.StrictRedis(host='localhost', port=6379, db=0)
+        self.redis_c.flushdb()
+
+    def test_claims_by_priority_and_requeues(self):
+        queue = RedisQueueBackend(self.redis_c, 'test',
+                                  requeue_on_timeout=True)
+        self.assertEqual(queue.enqueue_many({'LOW': 10, 'HIGH': 1,
+                                             'MID': 5}), 3)
+        self.assertEqual(queue.poll_many(2), ['HIGH', 'MID'])
+        assert not queue.enqueue('HIGH')  # running
+        self.assertEqual(queue.inspect(), {'pending': 1, 'claimed': 2})
+
+        queue.release_many(['MID'])
+        queue.timeout_callback('HIGH')
+        queue.stop_callback('HIGH')
+        self.assertEqual(queue.poll_many(5), ['HIGH', 'MID', 'LOW'])
+        for task_id in 'HIGH', 'MID', 'LOW':
+            queue.stop_callback(task_id)
+        self.assertEqual(queue.inspect(), {'pending': 0, 'claimed': 0})
+        assert queue.poll() is None
+
+    def test_timeouted_task_claimed_again_is_kept(self):
+        queue = RedisQueueBackend(self.redis_c, 'test',
+                                  requeue_on_timeout=True)
+        queue.enqueue('TASK')
+        assert queue.poll() == 'TASK'
+        queue.timeout_callback('TASK')
+        # claimed by another scheduler before the stop_callback
+        assert RedisQueueBackend(self.redis_c, 'test').poll() == 'TASK'
+        queue.stop_callback('TASK')
+        self.assertEqual(queue.inspect(), {'pending': 0, 'claimed': 1})
+        assert not queue.enqueue('TASK')
+
+    def test_stale_claims_are_requeued(self):
+        queue = RedisQueueBackend(self.redis_c, 'test', claim_ttl=0.5)
+        queue.enqueue_many({'STARTED': 1, 'LOST': 2})
+        self.assertEqual(queue.poll_many(2), ['STARTED', 'LOST'])
+        time.sleep(0.3)
+        queue.keepalive_callback('STARTED')
+        assert queue.poll() is None
+        time.sleep(0.3)
+        # LOST was never started nor kept alive, STARTED still is running
+        assert queue.poll() == 'LOST'
+        assert not queue.enqueue('STARTED')
+        for task_id in 'STARTED', 'LOST':
+            queue.stop_callback(task_id)
+        self.assertEqual(queue.inspect(), {'pending': 0, 'claimed': 0})
+        assert not self.redis_c.exists(queue._keys[2])
+
+
+class RedisHashTaggedStorageTest(RedisStorageTest):
+    """Integration test for redis store with hash tagged keys, through a
+    connection pool"""
+
+    def _storage(self):
+        return RedisStorage(redis.ConnectionPool(host='localhost', port=6379,
+                                                 db=0),
+                            key_layout=KEY_LAYOUT_HASH_TAG)
+
+    def test_key_layouts(self):
+        sched = Scheduler(name='test', storage=self._storage())
+        slot = sched.add_slot('sid_1', [])
+        self.assertEqual(sched.storage._db_key(slot, 'lock'),
+                         'task_semaphore.{scheduler.test}.slot.sid_1.lock')
+        self.assertEqual(sched.storage._db_key(sched),
+                         'task_semaphore.{scheduler.test}')
+        assert sched.storage.key_layout == KEY_LAYOUT_HASH_TAG
+        flat = RedisStorage(self._redis)
+        assert flat.key_layout == KEY_LAYOUT_FLAT
+        self.assertEqual(flat._db_key(slot, 'lock'),
+                         'task_semaphore.scheduler.test.slot.sid_1.lock')
+
+
+class RedisHashStorageTest(RedisStorageTest):
+    """Integration test for redis hash store"""
+
+    def _storage(self):
+        return RedisHashStorage(self._redis)
+
+    def test_encoding(self):
+        now = datetime.now(UTC).replace(tzinfo=None)
+        for value in (None, 'TASK_ID', 42, ['A', 'B'], now):
+            encoded = RedisHashStorage.encode(value)
+            assert 'pickle' not in type(encoded).__module__
+            self.assertEqual(RedisHashStorage.decode(encoded.encode()),
+                             value)
+
+    def test_keepalive_writes_a_single_field(self):
+        self._clean()
+        config = [{'backends': ['ExampleScheduleBackend'],
+                   'slot_id': 'sid_1'}]
+        sched = Scheduler(name='test', storage=self._storage()).\
+            init_from_config(config)
+        sched.schedule()
+        slot = sched.slots['sid_1']
+        key = sched.storage._db_key(slot)
+        untouched = RedisHashStorage.encode(datetime(2000, 1, 1))
+        self._redis.hset(key, '_started_at', untouched)
+        sched.keepalive('SELECTED_TASK_ID_1')
+        self.assertEqual(self._redis.hget(key, '_started_at'),
+                         untouched.encode())
+        self.assertEqual(self._redis.hget(key, '_last_keepalive_at'),
+                         RedisHashStorage.encode(
+                             slot.last_keepalive_at).encode())
+
+
+class AsyncRedisStorageTest(unittest.IsolatedAsyncioTestCase):
+    """Integration test for the asyncio redis store"""
+
+    async def test_shares_data_with_sync_storage(self):
+        redis_c = redis.StrictRedis(host='localhost', port=6379, db=0)
+        redis_c.flushdb()
+        config = [{'backends': ['ExampleAsyncBackend'], 'slot_id': 'sid_1'}]
+        async_redis_c = redis.asyncio.StrictRedis(host='localhost',
+                                                  port=6379, db=0)
+        sched = await AsyncScheduler(
+                name='test', storage=AsyncRedisStorage(async_redis_c)) \
+            .init_from_config(config)
+        await sched.schedule()
+        await async_redis_c.aclose()
+
+        sync_sched = Scheduler(name='test', storage=RedisStorage(redis_c))\
+            .init_from_config(config)
+        slot = sync_sched.slots['sid_1']
+        assert slot.current_task_id == 'ASYNC_TASK_ID_1'
+        sync_sched.stop('ASYNC_TASK_ID_1')
+        assert slot.current_task_id is None
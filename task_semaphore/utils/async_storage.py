@@ -0,0 +1,119 @@
+import asyncio
+
+from .lock import AbstractAsyncLock, AsyncRedisLock, async_redis_client
+from .storage import (AbstractStorage, PickleSerializer, RedisStorage,
+                      default_key_layout)
+
+
+class AbstractAsyncStorage(AbstractStorage):
+    """Same interface as AbstractStorage with coroutines, for the
+    AsyncScheduler"""
+
+    def lock_on(self, model):
+        return AbstractAsyncLock()
+
+    async def save(self, model):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def reload(self, model):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def save_many(self, models):
+        await asyncio.gather(*(self.save(model) for model in models))
+
+    async def reload_many(self, models):
+        await asyncio.gather(*(self.reload(model) for model in models))
+
+    async def index_task(self, model, task_id, slot_id):
+        pass
+
+    async def unindex_task(self, model, task_id):
+        pass
+
+    async def find_task(self, model, task_id):
+        return None
+
+    async def find_tasks(self, model, task_ids):
+        return await asyncio.gather(*(self.find_task(model, task_id)
+                                      for task_id in task_ids))
+
+    async def incr_stats(self, model, windows_counters, ttl):
+        AbstractStorage.incr_stats(self, model, windows_counters, ttl)
+
+    async def load_stats(self, model, windows):
+        return AbstractStorage.load_stats(self, model, windows)
+
+
+class AsyncRedisStorage(AbstractAsyncStorage, PickleSerializer):
+    """RedisStorage for a `redis.asyncio` client, cluster client or
+    connection pool. Both share the same layout and can be used on the same
+    data if given the same `key_layout`."""
+    indexes_tasks = True
+    _db_key = RedisStorage._db_key
+
+    def __init__(self, redis_c, *args, key_layout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.redis_c = async_redis_client(redis_c)
+        self.key_layout = key_layout or default_key_layout(self.redis_c)
+
+    def lock_on(self, model):
+        return AsyncRedisLock(self.redis_c, self._db_key(model, 'lock'))
+
+    async def save(self, model):
+        serialized = self.dumps(model.to_plain())
+        return await self.redis_c.set(self._db_key(model), serialized)
+
+    async def reload(self, model):
+        serialized = await self.redis_c.get(self._db_key(model))
+        model.from_plain(self.loads(serialized) or {})
+
+    async def save_many(self, models):
+        pipe = self.redis_c.pipeline(transaction=False)
+        for model in models:
+            pipe.set(self._db_key(model), self.dumps(model.to_plain()))
+        return await pipe.execute()
+
+    async def reload_many(self, models):
+        models = list(models)
+        if not models:
+            return
+        serialized = await self.redis_c.mget([self._db_key(model)
+                                              for model in models])
+        for model, attrs_s in zip(models, serialized):
+            model.from_plain(self.loads(attrs_s) or {})
+
+    async def index_task(self, model, task_id, slot_id):
+        await self.redis_c.hset(self._db_key(model, 'tasks'),
+                                task_id, slot_id)
+
+    async def unindex_task(self, model, task_id):
+        await self.redis_c.hdel(self._db_key(model, 'tasks'), task_id)
+
+    async def find_task(self, model, task_id):
+        slot_id = await self.redis_c.hget(self._db_key(model, 'tasks'),
+                                          task_id)
+        return slot_id.decode() if isinstance(slot_id, bytes) else slot_id
+
+    async def find_tasks(self, model, task_ids):
+        if not task_ids:
+            return []
+        return [slot_id.decode() if isinstance(slot_id, bytes) else slot_id
+                for slot_id in await self.redis_c.hmget(
+                    self._db_key(model, 'tasks'), task_ids)]
+
+    async def incr_stats(self, model, windows_counters, ttl):
+        pipe = self.redis_c.pipeline(transaction=False)
+        for window, counters in windows_counters.items():
+            key = self._db_key(model, 'stats', str(window))
+            for field, count in counters.items():
+                pipe.hincrby(key, field, count)
+            pipe.expire(key, ttl)
+        await pipe.execute()
+
+    async def load_stats(self, model, windows):
+        pipe = self.redis_c.pipeline(transaction=False)
+        for window in windows:
+            pipe.hgetall(self._db_key(model, 'stats', str(window)))
+        return [{field.decode() if isinstance(field, bytes) else field:
+                 int(count) for field, count in counters.items()}
+                for counters in await pipe.execute()]
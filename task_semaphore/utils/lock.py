@@ -1,50 +1,252 @@
+import asyncio
+import random
 import time
-from datetime import UTC, datetime, timedelta
+import uuid
+
+from ..exceptions import LockLostError
 
 DEFAULT_MAX_WAIT = 5  # in minutes
-DEFAULT_LOCK_LOOP_WAIT_TIME = 2  # in seconds
+DEFAULT_LOCK_TTL = 5 * 60  # in seconds
+DEFAULT_BACKOFF_MIN = 0.005  # in seconds
+DEFAULT_BACKOFF_MAX = 0.5  # in seconds
+
+
+def redis_client(redis_c):
+    """Return `redis_c` if it's a redis client, plain or cluster, else a
+    client using it as its connection pool"""
+    if hasattr(redis_c, 'execute_command'):
+        return redis_c
+    import redis  # only needed to wrap a connection pool
+    return redis.Redis(connection_pool=redis_c)
+
+
+def async_redis_client(redis_c):
+    """Same as redis_client for `redis.asyncio`"""
+    if hasattr(redis_c, 'execute_command'):
+        return redis_c
+    import redis.asyncio
+    return redis.asyncio.Redis(connection_pool=redis_c)
 
 
 class AbstractLock:
+    """Lease based lock: each acquisition is identified by a unique token and
+    only the owner of that token can release or renew it.
+
+    Implementations must provide `lock`, `unlock` and `extend`, all three
+    taking the owner token and being atomic.
+
+    `wait_for` is deprecated and ignored, waits being a backoff between
+    `backoff_min` and `backoff_max` seconds."""
 
-    def __init__(self, wait_for=DEFAULT_LOCK_LOOP_WAIT_TIME,
-                 max_wait=DEFAULT_MAX_WAIT):
-        self.wait_for = wait_for
-        self.max_lock_wait = timedelta(minutes=max_wait)
+    def __init__(self, wait_for=None, max_wait=DEFAULT_MAX_WAIT, *,
+                 ttl=DEFAULT_LOCK_TTL, backoff_min=DEFAULT_BACKOFF_MIN,
+                 backoff_max=DEFAULT_BACKOFF_MAX):
+        self.max_lock_wait = max_wait * 60
+        self.ttl = ttl
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.token = None
+        self._renewed_at = None
 
     def __enter__(self):
-        start = datetime.now(UTC)
-        while self.is_locked():
-            if datetime.now(UTC) - start > self.max_lock_wait:
-                raise TimeoutError('waited to long for lock')
-            time.sleep(self.wait_for)
-        self.lock()
+        self.acquire()
+        return self
 
     def __exit__(self, *args, **kwargs):
-        self.unlock()
+        self.release()
+
+    def acquire(self, blocking=True):
+        """Take the lock, retrying with a jittered exponential backoff until
+        `max_wait` is reached. If not `blocking`, will only try once.
+
+        Returns whether the lock has been taken."""
+        token = uuid.uuid4().hex
+        start = time.monotonic()
+        backoff = self.backoff_min
+        while not self.lock(token):
+            if not blocking:
+                return False
+            if time.monotonic() - start > self.max_lock_wait:
+                raise TimeoutError('waited to long for lock')
+            time.sleep(random.uniform(backoff / 2, backoff))
+            backoff = min(backoff * 2, self.backoff_max)
+        self.token = token
+        self._renewed_at = time.monotonic()
+        return True
+
+    def release(self):
+        if self.token is not None:
+            self.unlock(self.token)
+            self.token = None
+
+    def renew(self):
+        """Extend the lease for another `ttl`, raise LockLostError if the lock
+        expired and isn't ours anymore."""
+        if self.token is None or not self.extend(self.token):
+            self.token = None
+            raise LockLostError(self)
+        self._renewed_at = time.monotonic()
+
+    def renew_if_needed(self):
+        """Renew the lease only if half of it has already elapsed, cheap
+        enough to be called in loops."""
+        if time.monotonic() - self._renewed_at > self.ttl / 2:
+            self.renew()
 
     def is_locked(self):
         pass
 
-    def lock(self):
-        pass
+    def lock(self, token):
+        return True
 
-    def unlock(self):
+    def unlock(self, token):
         pass
 
+    def extend(self, token):
+        return True
+
+
+class LockGroup:
+    """Several locks held together, like those of the slots of a pass with
+    LOCK_SLOT, renewed at once"""
+
+    def __init__(self, locks=()):
+        self.locks = list(locks)
+
+    def add(self, lock):
+        self.locks.append(lock)
+
+    def renew_if_needed(self):
+        for lock in self.locks:
+            lock.renew_if_needed()
+
+
+# deletes / expires the lock only if it still belongs to the token owner
+UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
 
 class RedisLock(AbstractLock):
+    """`redis_c` may be a client, a cluster client or a connection pool"""
 
     def __init__(self, redis_c, lock_key, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.redis_c = redis_c
+        self.redis_c = redis_client(redis_c)
         self.lock_key = lock_key
+        self._unlock_script = self.redis_c.register_script(UNLOCK_SCRIPT)
+        self._extend_script = self.redis_c.register_script(EXTEND_SCRIPT)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.lock_key)
 
     def is_locked(self):
-        return self.redis_c.get(self.lock_key)
+        return bool(self.redis_c.exists(self.lock_key))
+
+    def lock(self, token):
+        return bool(self.redis_c.set(self.lock_key, token, nx=True,
+                                     px=int(self.ttl * 1000)))
+
+    def unlock(self, token):
+        return self._unlock_script(keys=[self.lock_key], args=[token])
+
+    def extend(self, token):
+        return bool(self._extend_script(keys=[self.lock_key],
+                                        args=[token, int(self.ttl * 1000)]))
+
+
+class AbstractAsyncLock(AbstractLock):
+    """Same as AbstractLock for asyncio, to be used with `async with`.
+
+    `lock`, `unlock` and `extend` must be coroutines."""
+
+    def __enter__(self):
+        raise TypeError("TaskSemaphore: %r must be used with `async with`"
+                        % self)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        await self.release()
+
+    async def acquire(self, blocking=True):
+        token = uuid.uuid4().hex
+        start = time.monotonic()
+        backoff = self.backoff_min
+        while not await self.lock(token):
+            if not blocking:
+                return False
+            if time.monotonic() - start > self.max_lock_wait:
+                raise TimeoutError('waited to long for lock')
+            await asyncio.sleep(random.uniform(backoff / 2, backoff))
+            backoff = min(backoff * 2, self.backoff_max)
+        self.token = token
+        self._renewed_at = time.monotonic()
+        return True
+
+    async def release(self):
+        if self.token is not None:
+            await self.unlock(self.token)
+            self.token = None
+
+    async def renew(self):
+        if self.token is None or not await self.extend(self.token):
+            self.token = None
+            raise LockLostError(self)
+        self._renewed_at = time.monotonic()
+
+    async def renew_if_needed(self):
+        if time.monotonic() - self._renewed_at > self.ttl / 2:
+            await self.renew()
+
+    async def is_locked(self):
+        pass
+
+    async def lock(self, token):
+        return True
+
+    async def unlock(self, token):
+        pass
+
+    async def extend(self, token):
+        return True
+
+
+class AsyncRedisLock(AbstractAsyncLock):
+    """RedisLock for a `redis.asyncio` client, cluster client or connection
+    pool"""
+
+    def __init__(self, redis_c, lock_key, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.redis_c = async_redis_client(redis_c)
+        self.lock_key = lock_key
+        self._unlock_script = self.redis_c.register_script(UNLOCK_SCRIPT)
+        self._extend_script = self.redis_c.register_script(EXTEND_SCRIPT)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.lock_key)
+
+    async def is_locked(self):
+        return bool(await self.redis_c.exists(self.lock_key))
+
+    async def lock(self, token):
+        return bool(await self.redis_c.set(self.lock_key, token, nx=True,
+                                           px=int(self.ttl * 1000)))
 
-    def lock(self):
-        self.redis_c.set(self.lock_key, 'IS_LOCKED', 5 * 60)  # lock for 5 min
+    async def unlock(self, token):
+        return await self._unlock_script(keys=[self.lock_key], args=[token])
 
-    def unlock(self):
-        return self.redis_c.delete(self.lock_key)
+    async def extend(self, token):
+        return bool(await self._extend_script(
+                keys=[self.lock_key], args=[token, int(self.ttl * 1000)]))
@@ -1,13 +1,35 @@
+import json
+import math
 import pickle
+import time
+from datetime import UTC, datetime
 
 from .plainattrs import PlainAttrs
-from .lock import AbstractLock, RedisLock
+from .lock import AbstractLock, RedisLock, redis_client
+
+# keys like "task_semaphore.scheduler.<id>.slot.<slot id>"
+KEY_LAYOUT_FLAT = 'flat'
+# keys like "task_semaphore.{scheduler.<id>}.slot.<slot id>", the hash tag
+# putting all the keys of a scheduler in the same redis cluster slot
+KEY_LAYOUT_HASH_TAG = 'hash_tag'
 
 
 class AbstractStorage(PlainAttrs):
+    # whether the storage keeps an index of which slot runs which task
+    indexes_tasks = False
+    # whether the storage keeps an index of the running tasks' deadlines
+    indexes_deadlines = False
+    # whether compare_and_set is implemented, needed by LOCK_OPTIMISTIC
+    supports_compare_and_set = False
+    # whether leases expire on their own and are notified, see set_lease
+    supports_leases = False
 
     def __init__(self, scheduler=None):
         self.scheduler = scheduler
+        # stats and configs are only kept in memory unless overridden, see
+        # incr_stats and publish_config
+        self._stats = {}
+        self._configs = {}
 
     def lock_on(self, model):
         return AbstractLock()
@@ -18,6 +40,212 @@ class AbstractStorage(PlainAttrs):
     def reload(self, model):  # pragma: no cover
         raise NotImplementedError()
 
+    def save_fields(self, model, fields):
+        """Save only `fields` of the model, to override if your storage can
+        write them separately"""
+        self.save(model)
+
+    def compare_and_set(self, model, version):  # pragma: no cover
+        """Save `model` only if its `_version` in the storage is still
+        `version` (0 if never saved), atomically. Return whether it was."""
+        raise NotImplementedError()
+
+    def save_many(self, models, fields=None, deadlines=None, indexes=None):
+        """Save several models at once, to override if your storage can
+        do it in less than one call per model.
+
+        `fields` may give by model the only fields to save, see save_fields.
+        `deadlines` gives by slot its deadline to write along, see
+        set_deadline, and its lease if its scheduler has `leases`, see
+        set_lease. Both are cleared if the deadline is None.
+        `indexes` gives by (scheduler, task id) the id of the slot (or the
+        ref of the pool) now running the task, see index_task, None if it
+        was freed."""
+        fields = fields or {}
+        for model in models:
+            if fields.get(model):
+                self.save_fields(model, fields[model])
+            else:
+                self.save(model)
+        for slot, deadline in (deadlines or {}).items():
+            if deadline is None:
+                self.clear_deadline(slot.scheduler, slot.id_)
+                if slot.scheduler.leases:
+                    self.clear_lease(slot.scheduler, slot.id_)
+                continue
+            self.set_deadline(slot.scheduler, slot.id_, deadline)
+            if slot.scheduler.leases:
+                now = datetime.now(UTC).replace(tzinfo=None)
+                self.set_lease(slot.scheduler, slot.id_, deadline - now)
+        for (model, task_id), slot_id in (indexes or {}).items():
+            if slot_id is None:
+                self.unindex_task(model, task_id)
+            else:
+                self.index_task(model, task_id, slot_id)
+
+    def reload_many(self, models):
+        """Reload several models at once, to override if your storage can
+        do it in less than one call per model"""
+        for model in models:
+            self.reload(model)
+
+    def index_task(self, model, task_id, slot_id):
+        """Remember the scheduler `model` runs `task_id` on `slot_id`"""
+        pass
+
+    def unindex_task(self, model, task_id):
+        pass
+
+    def find_task(self, model, task_id):
+        """Return the id (as a string) of the slot of the scheduler `model`
+        running `task_id`, None if unknown"""
+        return None
+
+    def find_tasks(self, model, task_ids):
+        """Same as find_task for several tasks at once, returns a list"""
+        return [self.find_task(model, task_id) for task_id in task_ids]
+
+    def set_deadline(self, model, slot_id, deadline):
+        """Remember the task on `slot_id` of the scheduler `model` will be
+        late after the `deadline` datetime"""
+        pass
+
+    def clear_deadline(self, model, slot_id):
+        pass
+
+    def expired_slots(self, model, now):
+        """Return the ids (as strings) of the slots of the scheduler `model`
+        whose deadline is before `now`"""
+        return []
+
+    def set_lease(self, model, slot_id, ttl):
+        """Hold a lease on `slot_id` of the scheduler `model`, expiring after
+        the `ttl` timedelta unless set again"""
+        pass
+
+    def clear_lease(self, model, slot_id):
+        pass
+
+    def expired_leases(self, model, timeout):
+        """Wait up to `timeout` seconds for leases of the scheduler `model`
+        to expire, return the ids (as strings) of their slots"""
+        time.sleep(timeout)
+        return []
+
+    def load_pool(self, pool):
+        """Return the tasks running in the SlotPool `pool` as a dict
+        (task id => (backend name, started at, last keepalive at)), None if
+        the storage doesn't persist pools and they're only kept in memory"""
+        return None
+
+    def load_pool_late(self, pool, before):
+        """Return how many tasks run in `pool` and, like load_pool, those
+        whose deadline (see SlotPool.deadline_of) is before the `before`
+        datetime. None if the storage doesn't index the deadlines of the
+        pools' tasks, load_pool being used instead."""
+        return None
+
+    def acquire_in_pool(self, pool, task_id, record):
+        """Atomically record `task_id` in `pool` if it has capacity left and
+        isn't running it yet. Return whether it did."""
+        return task_id not in pool._tasks and len(pool._tasks) < pool.size
+
+    def update_in_pool(self, pool, task_id, record):
+        """Update the record of `task_id` if still running in `pool`. Return
+        whether it did."""
+        return task_id in pool._tasks
+
+    def release_from_pool(self, pool, task_id):
+        pass
+
+    def incr_stats(self, model, windows_counters, ttl):
+        """Add `windows_counters` (window start => field => count) to the
+        stats of the scheduler `model`, windows may be dropped after `ttl`
+        seconds. See StatsRecorder.
+
+        Windows older than `ttl` are dropped on each call."""
+        stats = self._stats.setdefault(model._storage_key, {})
+        expired = time.time() - ttl
+        for window in [window for window in stats if window < expired]:
+            del stats[window]
+        for window, counters in windows_counters.items():
+            window_stats = stats.setdefault(window, {})
+            for field, count in counters.items():
+                window_stats[field] = window_stats.get(field, 0) + count
+
+    def load_stats(self, model, windows):
+        """Return the counters of each of the `windows` (by their start) of
+        the scheduler `model`, as a list of dicts"""
+        stats = self._stats.get(model._storage_key, {})
+        return [dict(stats.get(window, {})) for window in windows]
+
+    def publish_config(self, model, config):
+        """Store `config` as the config of the scheduler `model` with a
+        version greater than the previous one, which is returned"""
+        version, _ = self._configs.get(model._storage_key, (0, None))
+        self._configs[model._storage_key] = (version + 1, config)
+        return version + 1
+
+    def config_version(self, model):
+        """Return the version of the config of the scheduler `model`, None
+        if none has been published"""
+        return self.load_config(model)[0]
+
+    def load_config(self, model):
+        """Return the version and config of the scheduler `model`, both None
+        if none has been published"""
+        return self._configs.get(model._storage_key, (None, None))
+
+
+# only records the task if the pool isn't full and isn't already running it,
+# indexing its deadline ARGV[4] in KEYS[2]
+POOL_ACQUIRE_SCRIPT = """
+if redis.call('hexists', KEYS[1], ARGV[1]) == 1
+        or redis.call('hlen', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[4], ARGV[1])
+return 1
+"""
+# only writes the hash if its '_version' field is still ARGV[1]
+COMPARE_AND_SET_SCRIPT = """
+if (redis.call('hget', KEYS[1], '_version') or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('hset', KEYS[1], unpack(ARGV, 2))
+return 1
+"""
+# same for RedisStorage, the version being kept in KEYS[2] next to the
+# pickle in KEYS[1]
+PICKLE_COMPARE_AND_SET_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[2])
+redis.call('set', KEYS[2], ARGV[3])
+return 1
+"""
+POOL_UPDATE_SCRIPT = """
+if redis.call('hexists', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+return 1
+"""
+POOL_RELEASE_SCRIPT = """
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('zrem', KEYS[2], ARGV[1])
+"""
+
+
+def default_key_layout(redis_c):
+    """KEY_LAYOUT_HASH_TAG for cluster clients, KEY_LAYOUT_FLAT otherwise"""
+    if hasattr(redis_c, 'nodes_manager'):
+        return KEY_LAYOUT_HASH_TAG
+    return KEY_LAYOUT_FLAT
+
 
 class PickleSerializer:
 
@@ -31,11 +259,37 @@ class PickleSerializer:
 
 
 class RedisStorage(AbstractStorage, PickleSerializer):
-    """Slot with a redis backend"""
+    """Slot with a redis backend.
+
+    `redis_c` may be a client, a cluster client or a connection pool.
+    `key_layout` defaults to KEY_LAYOUT_HASH_TAG for cluster clients, as
+    bulk operations need all the keys they touch to be on the same node, and
+    to KEY_LAYOUT_FLAT otherwise. Every process working on a scheduler must
+    use the same layout."""
+    indexes_tasks = True
+    indexes_deadlines = True
+    supports_compare_and_set = True
+    supports_leases = True
 
-    def __init__(self, redis_c, *args, **kwargs):
+    def __init__(self, redis_c, *args, key_layout=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.redis_c = redis_c
+        # scheduler key => pubsub listening to expirations, see
+        # expired_leases
+        self._lease_subscriptions = {}
+        self.redis_c = redis_client(redis_c)
+        self.key_layout = key_layout or default_key_layout(self.redis_c)
+        assert self.key_layout in (KEY_LAYOUT_FLAT, KEY_LAYOUT_HASH_TAG), \
+                "TaskSemaphore: unknown key layout %r" % self.key_layout
+        self._pool_acquire_script = self.redis_c.register_script(
+                POOL_ACQUIRE_SCRIPT)
+        self._pool_update_script = self.redis_c.register_script(
+                POOL_UPDATE_SCRIPT)
+        self._pool_release_script = self.redis_c.register_script(
+                POOL_RELEASE_SCRIPT)
+        self._compare_and_set_script = self.redis_c.register_script(
+                COMPARE_AND_SET_SCRIPT)
+        self._pickle_compare_and_set_script = self.redis_c.register_script(
+                PICKLE_COMPARE_AND_SET_SCRIPT)
 
     def lock_on(self, model):
         return RedisLock(self.redis_c, self._db_key(model, 'lock'))
@@ -49,5 +303,308 @@ class RedisStorage(AbstractStorage, PickleSerializer):
         attrs = self.loads(serialized) or {}
         model.from_plain(attrs)
 
+    def compare_and_set(self, model, version):
+        """The pickle can't be read by a script, so the version is also kept
+        in its own key, written along by compare_and_set only: with
+        LOCK_OPTIMISTIC slots are never written otherwise."""
+        return bool(self._pickle_compare_and_set_script(
+                keys=[self._db_key(model), self._db_key(model, 'version')],
+                args=[str(version), self.dumps(model.to_plain()),
+                      str(model._version)]))
+
+    def save_many(self, models, fields=None, deadlines=None, indexes=None):
+        """Every model is saved whole, `fields` are ignored"""
+        pipe = self.redis_c.pipeline(transaction=False)
+        for model in models:
+            pipe.set(self._db_key(model), self.dumps(model.to_plain()))
+        self._write_deadlines(pipe, deadlines)
+        self._write_indexes(pipe, indexes)
+        return pipe.execute()
+
+    def _write_deadlines(self, pipe, deadlines):
+        """Queue in `pipe` the writes of `deadlines`, see save_many"""
+        for slot, deadline in (deadlines or {}).items():
+            key = self._db_key(slot.scheduler, 'deadlines')
+            if deadline is None:
+                pipe.zrem(key, slot.id_)
+                if slot.scheduler.leases:
+                    pipe.delete(self._lease_key(slot.scheduler, slot.id_))
+                continue
+            pipe.zadd(key,
+                      {slot.id_: deadline.replace(tzinfo=UTC).timestamp()})
+            if slot.scheduler.leases:
+                now = datetime.now(UTC).replace(tzinfo=None)
+                pipe.set(self._lease_key(slot.scheduler, slot.id_), 1,
+                         px=self._lease_ms(deadline - now))
+
+    def _write_indexes(self, pipe, indexes):
+        """Queue in `pipe` the writes of `indexes`, see save_many"""
+        for (model, task_id), slot_id in (indexes or {}).items():
+            if slot_id is None:
+                pipe.hdel(self._db_key(model, 'tasks'), task_id)
+            else:
+                pipe.hset(self._db_key(model, 'tasks'), task_id, slot_id)
+
+    def reload_many(self, models):
+        models = list(models)
+        if not models:
+            return
+        serialized = self.redis_c.mget([self._db_key(model)
+                                        for model in models])
+        for model, attrs_s in zip(models, serialized):
+            model.from_plain(self.loads(attrs_s) or {})
+
+    def index_task(self, model, task_id, slot_id):
+        self.redis_c.hset(self._db_key(model, 'tasks'), task_id, slot_id)
+
+    def unindex_task(self, model, task_id):
+        self.redis_c.hdel(self._db_key(model, 'tasks'), task_id)
+
+    def find_task(self, model, task_id):
+        slot_id = self.redis_c.hget(self._db_key(model, 'tasks'), task_id)
+        return slot_id.decode() if isinstance(slot_id, bytes) else slot_id
+
+    def find_tasks(self, model, task_ids):
+        if not task_ids:
+            return []
+        return [slot_id.decode() if isinstance(slot_id, bytes) else slot_id
+                for slot_id in self.redis_c.hmget(
+                    self._db_key(model, 'tasks'), task_ids)]
+
+    def set_deadline(self, model, slot_id, deadline):
+        self.redis_c.zadd(self._db_key(model, 'deadlines'),
+                          {slot_id: deadline.replace(tzinfo=UTC).timestamp()})
+
+    def clear_deadline(self, model, slot_id):
+        self.redis_c.zrem(self._db_key(model, 'deadlines'), slot_id)
+
+    def expired_slots(self, model, now):
+        return [slot_id.decode() if isinstance(slot_id, bytes) else slot_id
+                for slot_id in self.redis_c.zrangebyscore(
+                    self._db_key(model, 'deadlines'), '-inf',
+                    now.replace(tzinfo=UTC).timestamp())]
+
+    def set_lease(self, model, slot_id, ttl):
+        self.redis_c.set(self._lease_key(model, slot_id), 1,
+                         px=self._lease_ms(ttl))
+
+    def clear_lease(self, model, slot_id):
+        self.redis_c.delete(self._lease_key(model, slot_id))
+
+    def _lease_key(self, model, slot_id):
+        return self._db_key(model, 'lease', str(slot_id))
+
+    @staticmethod
+    def _lease_ms(ttl):
+        return max(1, math.ceil(ttl.total_seconds() * 1000))
+
+    def expired_leases(self, model, timeout):
+        """Relies on keyspace notifications, which must include expired
+        events ("Ex" at least in redis' `notify-keyspace-events`). Those
+        being fire and forget, deadlines still have to be swept now and then
+        with `Scheduler.reap_timeouts`."""
+        pubsub = self._lease_subscriptions.get(model._storage_key)
+        if pubsub is None:
+            pubsub = self.redis_c.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe('__keyevent@*__:expired')
+            self._lease_subscriptions[model._storage_key] = pubsub
+        prefix = self._db_key(model, 'lease') + '.'
+        slot_ids = []
+        message = pubsub.get_message(timeout=timeout)
+        while message is not None:
+            key = message['data']
+            if isinstance(key, bytes):
+                key = key.decode()
+            if key.startswith(prefix):
+                slot_ids.append(key[len(prefix):])
+            message = pubsub.get_message(timeout=0)
+        return slot_ids
+
+    @staticmethod
+    def _dump_pool_record(record):
+        backend_name, started_at, last_keepalive_at = record
+        return json.dumps([backend_name,
+                           started_at.replace(tzinfo=UTC).timestamp(),
+                           last_keepalive_at.replace(tzinfo=UTC).timestamp()])
+
+    @staticmethod
+    def _load_pool_record(record_s):
+        backend_name, started_at, last_keepalive_at = json.loads(record_s)
+        return (backend_name,
+                datetime.fromtimestamp(started_at, UTC).replace(tzinfo=None),
+                datetime.fromtimestamp(last_keepalive_at, UTC)
+                .replace(tzinfo=None))
+
+    def load_pool(self, pool):
+        return {task_id.decode() if isinstance(task_id, bytes) else task_id:
+                self._load_pool_record(record_s) for task_id, record_s
+                in self.redis_c.hgetall(self._db_key(pool)).items()}
+
+    def load_pool_late(self, pool, before):
+        """The deadlines of the pools' tasks are kept in a sorted set next
+        to their hash, so only the late ones are loaded, and the others only
+        counted"""
+        key, deadlines_key = self._pool_keys(pool)
+        pipe = self.redis_c.pipeline(transaction=False)
+        pipe.hlen(key)
+        pipe.zcard(deadlines_key)
+        pipe.zrangebyscore(deadlines_key, '-inf',
+                           before.replace(tzinfo=UTC).timestamp())
+        count, indexed, late_ids = pipe.execute()
+        if indexed < count:  # acquired before their deadlines were indexed
+            return self._index_pool_deadlines(pool, before)
+        if not late_ids:
+            return count, {}
+        return count, {
+                task_id.decode() if isinstance(task_id, bytes) else task_id:
+                self._load_pool_record(record_s) for task_id, record_s
+                in zip(late_ids, self.redis_c.hmget(key, late_ids))
+                if record_s is not None}
+
+    def _index_pool_deadlines(self, pool, before):
+        """Index the deadlines of all the tasks of `pool`, return the same
+        as load_pool_late"""
+        tasks = self.load_pool(pool)
+        if tasks:
+            self.redis_c.zadd(self._pool_keys(pool)[1], {
+                task_id: self._pool_deadline(pool, record)
+                for task_id, record in tasks.items()})
+        return len(tasks), {task_id: record for task_id, record
+                            in tasks.items()
+                            if pool.deadline_of(record) < before}
+
+    def _pool_keys(self, pool):
+        return [self._db_key(pool), self._db_key(pool, 'deadlines')]
+
+    def acquire_in_pool(self, pool, task_id, record):
+        return bool(self._pool_acquire_script(
+                keys=self._pool_keys(pool),
+                args=[task_id, self._dump_pool_record(record), pool.size,
+                      self._pool_deadline(pool, record)]))
+
+    def update_in_pool(self, pool, task_id, record):
+        return bool(self._pool_update_script(
+                keys=self._pool_keys(pool),
+                args=[task_id, self._dump_pool_record(record),
+                      self._pool_deadline(pool, record)]))
+
+    @staticmethod
+    def _pool_deadline(pool, record):
+        return pool.deadline_of(record).replace(tzinfo=UTC).timestamp()
+
+    def release_from_pool(self, pool, task_id):
+        self._pool_release_script(keys=self._pool_keys(pool), args=[task_id])
+
+    def incr_stats(self, model, windows_counters, ttl):
+        pipe = self.redis_c.pipeline(transaction=False)
+        for window, counters in windows_counters.items():
+            key = self._db_key(model, 'stats', str(window))
+            for field, count in counters.items():
+                pipe.hincrby(key, field, count)
+            pipe.expire(key, ttl)
+        pipe.execute()
+
+    def load_stats(self, model, windows):
+        pipe = self.redis_c.pipeline(transaction=False)
+        for window in windows:
+            pipe.hgetall(self._db_key(model, 'stats', str(window)))
+        return [{field.decode() if isinstance(field, bytes) else field:
+                 int(count) for field, count in counters.items()}
+                for counters in pipe.execute()]
+
+    def publish_config(self, model, config):
+        key = self._db_key(model, 'config')
+        pipe = self.redis_c.pipeline(transaction=True)
+        pipe.hincrby(key, 'version', 1)
+        pipe.hset(key, 'config', json.dumps(config))
+        return pipe.execute()[0]
+
+    def config_version(self, model):
+        version = self.redis_c.hget(self._db_key(model, 'config'), 'version')
+        return int(version) if version is not None else None
+
+    def load_config(self, model):
+        version, config = self.redis_c.hmget(self._db_key(model, 'config'),
+                                             ['version', 'config'])
+        if version is None:
+            return None, None
+        return int(version), json.loads(config)
+
     def _db_key(self, model, *args):
-        return "task_semaphore.%s" % ".".join(model._storage_key + args)
+        key = model._storage_key + args
+        if self.key_layout == KEY_LAYOUT_HASH_TAG:
+            # the first two parts are always ("scheduler", <scheduler id>)
+            return "task_semaphore.{%s}" % ".".join(
+                    key[:2]) + "".join("." + part for part in key[2:])
+        return "task_semaphore.%s" % ".".join(key)
+
+
+class RedisHashStorage(RedisStorage):
+    """Stores each model as a redis hash, with an entry per serialized
+    attribute, so attributes can be written separately. Values are encoded
+    without pickle: datetimes (naive, in UTC) as epoch floats, everything
+    else as JSON.
+
+    Keys are the same as RedisStorage, both mustn't be used on the same
+    scheduler."""
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, datetime):
+            # 'd' can't start a JSON document, no collision possible
+            return 'd%r' % value.replace(tzinfo=UTC).timestamp()
+        return json.dumps(value)
+
+    @staticmethod
+    def decode(value):
+        if isinstance(value, bytes):
+            value = value.decode()
+        if value.startswith('d'):
+            return datetime.fromtimestamp(float(value[1:]), UTC) \
+                    .replace(tzinfo=None)
+        return json.loads(value)
+
+    def _encoded(self, model, fields=None):
+        return {field: self.encode(getattr(model, field))
+                for field in fields or model.KEYS_TO_SERIALIZE}
+
+    def _decoded(self, attrs):
+        return {field.decode() if isinstance(field, bytes) else field:
+                self.decode(value) for field, value in attrs.items()}
+
+    def save(self, model):
+        return self.redis_c.hset(self._db_key(model),
+                                 mapping=self._encoded(model))
+
+    def save_fields(self, model, fields):
+        return self.redis_c.hset(self._db_key(model),
+                                 mapping=self._encoded(model, fields))
+
+    def compare_and_set(self, model, version):
+        args = [self.encode(version)]
+        for field, value in self._encoded(model).items():
+            args.extend((field, value))
+        return bool(self._compare_and_set_script(keys=[self._db_key(model)],
+                                                 args=args))
+
+    def reload(self, model):
+        model.from_plain(self._decoded(
+                self.redis_c.hgetall(self._db_key(model))))
+
+    def save_many(self, models, fields=None, deadlines=None, indexes=None):
+        fields = fields or {}
+        pipe = self.redis_c.pipeline(transaction=False)
+        for model in models:
+            pipe.hset(self._db_key(model),
+                      mapping=self._encoded(model, fields.get(model)))
+        self._write_deadlines(pipe, deadlines)
+        self._write_indexes(pipe, indexes)
+        return pipe.execute()
+
+    def reload_many(self, models):
+        models = list(models)
+        pipe = self.redis_c.pipeline(transaction=False)
+        for model in models:
+            pipe.hgetall(self._db_key(model))
+        for model, attrs in zip(models, pipe.execute()):
+            model.from_plain(self._decoded(attrs))